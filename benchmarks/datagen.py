@@ -0,0 +1,162 @@
+"""
+Synthetic camp-scale data for benchmarks.
+
+    python benchmarks/datagen.py --database-url sqlite+aiosqlite:///./bench.db [--scale camp] [--seed 42]
+
+The schema must exist (python -m db.migrate upgrade). Existing data is kept unless --reset is given.
+Never point it to a real database.
+"""
+import argparse
+import asyncio
+import random
+import sys
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from passlib.hash import bcrypt
+from sqlalchemy import insert, delete, select, func, update, bindparam
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from db.models import User, Task, TaskResponse, Shift, ShiftReservation, News, UserAchievement, \
+    UserCounter  # noqa: E402
+
+SCALES = {
+    'small': dict(users=2000, admins=3, tasks=200, responses=5000, shifts=20, reservations=2000, news=100),
+    'camp': dict(users=30000, admins=10, tasks=3000, responses=60000, shifts=60, reservations=30000, news=1000),
+}
+PASSWORD = 'camper-password'
+BATCH_SIZE = 5000
+
+
+def camper_email(i: int) -> str:
+    return 'camper{}@camp.ru'.format(i)
+
+
+def admin_email(i: int) -> str:
+    return 'admin{}@camp.ru'.format(i)
+
+
+async def _insert(engine: AsyncEngine, model, rows: list[dict]) -> list[int]:
+    """Insert rows in batches, returns ids of all rows of the model"""
+    async with engine.begin() as connection:
+        for offset in range(0, len(rows), BATCH_SIZE):
+            await connection.execute(insert(model), rows[offset:offset + BATCH_SIZE])
+        return list(await connection.scalars(select(model.id)))
+
+
+async def generate(engine: AsyncEngine, scale: str = 'small', seed: int = 42, bcrypt_rounds: int = 12,
+                   reset: bool = False) -> dict:
+    """Fill the database with reproducible synthetic data, returns the sizes used"""
+    sizes = SCALES[scale]
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    async with engine.begin() as connection:
+        if reset:
+            for model in (UserAchievement, UserCounter, ShiftReservation, TaskResponse, Task, Shift, News, User):
+                await connection.execute(delete(model))
+        elif await connection.scalar(select(func.count()).select_from(User)):
+            return sizes
+    # one hash for everybody: bcrypt cost is paid on verify, not on generation
+    hashed_password = bcrypt.using(rounds=bcrypt_rounds).hash(PASSWORD)
+    users = [dict(email=admin_email(i), first_name='Admin', last_name=str(i), username='admin{}'.format(i),
+                  hashed_password=hashed_password, is_admin=True, points=0, registered_at=now - timedelta(days=365))
+             for i in range(sizes['admins'])]
+    users += [dict(email=camper_email(i), first_name='Camper', last_name=str(i), username='camper{}'.format(i),
+                   hashed_password=hashed_password, is_admin=False, points=rng.randint(0, 500),
+                   registered_at=now - timedelta(minutes=rng.randint(0, 525600)))
+              for i in range(sizes['users'])]
+    await _insert(engine, User, users)
+
+    tasks = []
+    for i in range(sizes['tasks']):
+        start = now + timedelta(hours=rng.randint(-24 * 30, 24 * 30))
+        end = start + timedelta(hours=rng.randint(1, 24 * 14))
+        tasks.append(dict(title='Task {}'.format(i), description='Synthetic task {}'.format(i),
+                          points=rng.randint(1, 20), start_date=start, end_date=end,
+                          author_email=admin_email(rng.randrange(sizes['admins'])), is_active=start <= now < end))
+    task_ids = await _insert(engine, Task, tasks)
+
+    responses = []
+    for i in range(sizes['responses']):
+        state = rng.random()
+        responses.append(dict(user_email=camper_email(rng.randrange(sizes['users'])),
+                              task_id=rng.choice(task_ids),
+                              response_time=now - timedelta(minutes=rng.randint(0, 60 * 24 * 30)),
+                              is_approved=state >= 0.4, is_completed=state >= 0.4,
+                              answer='answer' if state >= 0.4 else None, is_checked=state >= 0.7))
+    await _insert(engine, TaskResponse, responses)
+
+    # about half of the shifts fill up, later reservations of a full shift are waitlisted
+    per_shift = sizes['reservations'] // sizes['shifts']
+    shifts = []
+    for i in range(sizes['shifts']):
+        start = now + timedelta(days=rng.randint(-60, 120))
+        shifts.append(dict(name='Shift {}'.format(i), number=str(i), description='Synthetic shift',
+                           start_date=start, end_date=start + timedelta(days=rng.choice((7, 14, 21))),
+                           capacity=rng.choice((None, per_shift // 2, per_shift * 2)), participants_number=0))
+    shift_ids = await _insert(engine, Shift, shifts)
+    capacities = dict(zip(shift_ids, (shift['capacity'] for shift in shifts)))
+
+    # one reservation per camper and shift
+    pairs = {}
+    while len(pairs) < min(sizes['reservations'], sizes['users'] * len(shift_ids)):
+        pairs.setdefault((rng.randrange(sizes['users']), rng.choice(shift_ids)), None)
+    reservations = []
+    counters = {shift_id: {'reserved': 0, 'participants': 0} for shift_id in shift_ids}
+    for user, shift_id in pairs:
+        counter = counters[shift_id]
+        waitlisted = capacities[shift_id] is not None and counter['reserved'] >= capacities[shift_id]
+        approved = not waitlisted and rng.random() < 0.5
+        counter['reserved'] += not waitlisted
+        counter['participants'] += approved
+        reservations.append(dict(user_email=camper_email(user), shift_id=shift_id, is_approved=approved,
+                                 is_waitlisted=waitlisted,
+                                 created_at=now - timedelta(minutes=rng.randint(0, 60 * 24 * 30))))
+    await _insert(engine, ShiftReservation, reservations)
+    async with engine.begin() as connection:
+        await connection.execute(update(Shift.__table__).where(Shift.id == bindparam('shift_id')).values(
+            reserved_number=bindparam('reserved'), participants_number=bindparam('participants')),
+            [dict(shift_id=shift_id, **counter) for shift_id, counter in counters.items()])
+
+    # achievement counters of the generated history (names of user/achievements.py), achievements are awarded
+    # from them when the app starts
+    task_points = dict(zip(task_ids, (task['points'] for task in tasks)))
+    user_counters = Counter()
+    for response in responses:
+        user_counters[response['user_email'], 'tasks_submitted'] += response['is_completed']
+        user_counters[response['user_email'], 'tasks_checked'] += response['is_checked']
+        user_counters[response['user_email'], 'points_earned'] += response['is_checked'] and task_points[
+            response['task_id']]
+    for reservation in reservations:
+        user_counters[reservation['user_email'], 'shifts_approved'] += reservation['is_approved']
+    async with engine.begin() as connection:
+        rows = [dict(user_email=email, name=name, value=value) for (email, name), value in user_counters.items()
+                if value]
+        for offset in range(0, len(rows), BATCH_SIZE):
+            await connection.execute(insert(UserCounter), rows[offset:offset + BATCH_SIZE])
+
+    await _insert(engine, News, [dict(title='News {}'.format(i), content='Camp news ' * 20,
+                                      created_at=now - timedelta(minutes=i * 37)) for i in range(sizes['news'])])
+    return sizes
+
+
+async def main(args: argparse.Namespace):
+    engine = create_async_engine(args.database_url)
+    try:
+        sizes = await generate(engine, args.scale, args.seed, args.bcrypt_rounds, args.reset)
+        print('Generated {} data: {}'.format(args.scale, sizes))
+    finally:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--scale', choices=SCALES, default='camp')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--bcrypt-rounds', type=int, default=12)
+    parser.add_argument('--reset', action='store_true', help='delete existing data first')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,247 @@
+"""
+Scripted load test of the API app (main.app) running in-process against a local SQLite or Postgres database.
+
+    python benchmarks/load_test.py [--database-url URL] [--scale small|camp] [--concurrency 20]
+                                   [--scenarios login_storm tasks_active_polling ...] [--requests 500]
+                                   [--output results.json] [--baseline previous_results.json]
+
+The database is migrated and refilled with synthetic data (benchmarks/datagen.py) before every run unless
+--reuse-data is given, so never point it to a real database. Requires httpx.
+For every scenario and endpoint it reports p50/p95/p99 latency, requests per second and SQL queries per request
+(taken from the Server-Timing header), and writes them as JSON to compare runs across commits.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+
+BENCHMARKS_PATH = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCHMARKS_PATH.parent / 'src'))
+
+SERVER_TIMING_QUERIES = re.compile(r'db;dur=[\d.]+;desc="(\d+) queries"')
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))] if ordered else 0.0
+
+
+class Recorder:
+    """Latency, status and query count of every request, grouped by endpoint"""
+
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    async def request(self, endpoint: str, method: str, url: str, **kwargs) -> httpx.Response:
+        start = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        self.latencies[endpoint].append(time.perf_counter() - start)
+        self.statuses[endpoint][response.status_code] += 1
+        if match := SERVER_TIMING_QUERIES.search(response.headers.get('server-timing', '')):
+            self.queries[endpoint].append(int(match[1]))
+        return response
+
+    def report(self, duration: float) -> dict:
+        endpoints = {}
+        for endpoint, latencies in self.latencies.items():
+            queries = self.queries[endpoint]
+            endpoints[endpoint] = {
+                'requests': len(latencies),
+                'errors': sum(count for status, count in self.statuses[endpoint].items() if status >= 500),
+                'statuses': {str(status): count for status, count in sorted(self.statuses[endpoint].items())},
+                'rps': len(latencies) / duration,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'queries_per_request': sum(queries) / len(queries) if queries else None,
+                'max_queries': max(queries, default=None),
+            }
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {'duration_s': duration, 'requests': total, 'rps': total / duration, 'endpoints': endpoints}
+
+
+async def run_workers(concurrency: int, requests: int, unit):
+    """Run `unit(worker, rng)` `requests` times spread over `concurrency` workers"""
+    remaining = requests
+
+    async def worker(number: int):
+        nonlocal remaining
+        rng = random.Random(number)
+        while remaining > 0:
+            remaining -= 1
+            await unit(number, rng)
+
+    await asyncio.gather(*(worker(number) for number in range(concurrency)))
+
+
+class Scenarios:
+    def __init__(self, recorder: Recorder, campers: list, admin, shift_ids: list[int], concurrency: int):
+        from auth.router import create_user_access_token
+
+        self.recorder = recorder
+        self.campers = campers
+        self.shift_ids = shift_ids
+        self.concurrency = concurrency
+        self._create_token = create_user_access_token
+        self.admin_headers = self.headers(admin)
+
+    def headers(self, user) -> dict:
+        return {'Authorization': 'Bearer ' + self._create_token(user, timedelta(hours=1))}
+
+    async def login_storm(self, requests: int):
+        from datagen import PASSWORD
+
+        async def login(worker, rng):
+            camper = rng.choice(self.campers)
+            await self.recorder.request('POST /auth/login', 'POST', '/auth/login',
+                                        data={'username': camper.email, 'password': PASSWORD})
+
+        await run_workers(self.concurrency, requests, login)
+
+    async def tasks_active_polling(self, requests: int):
+        # every worker is a polling client which revalidates with the ETag of its previous response
+        clients = [(self.headers(self.campers[number % len(self.campers)]), {}) for number in range(self.concurrency)]
+
+        async def poll(worker, rng):
+            headers, state = clients[worker]
+            if 'etag' in state:
+                headers = {**headers, 'If-None-Match': state['etag']}
+            response = await self.recorder.request('GET /tasks/active', 'GET', '/tasks/active?limit=50',
+                                                   headers=headers)
+            if 'etag' in response.headers:
+                state['etag'] = response.headers['etag']
+
+        await run_workers(self.concurrency, requests, poll)
+
+    async def shift_reservation_burst(self, requests: int):
+        async def reserve(worker, rng):
+            await self.recorder.request('POST /shifts/reserve/{shift_id}', 'POST',
+                                        '/shifts/reserve/{}'.format(rng.choice(self.shift_ids)),
+                                        headers=self.headers(rng.choice(self.campers)))
+
+        await run_workers(self.concurrency, requests, reserve)
+
+    async def admin_review(self, requests: int):
+        async def review(worker, rng):
+            response = await self.recorder.request(
+                'GET /tasks/response/list/for_approval', 'GET', '/tasks/response/list/for_approval?limit=20',
+                headers=self.admin_headers)
+            if items := response.json().get('items'):
+                await self.recorder.request('PUT /tasks/response/approve/{task_response_id}', 'PUT',
+                                            '/tasks/response/approve/{}'.format(rng.choice(items)['id']),
+                                            headers=self.admin_headers)
+            response = await self.recorder.request(
+                'GET /tasks/response/list/for_check', 'GET', '/tasks/response/list/for_check?limit=20',
+                headers=self.admin_headers)
+            if items := response.json().get('items'):
+                await self.recorder.request('PUT /tasks/check/{task_response_id}', 'PUT',
+                                            '/tasks/check/{}'.format(rng.choice(items)['id']),
+                                            headers=self.admin_headers)
+
+        # every review round issues up to four requests
+        await run_workers(self.concurrency, max(1, requests // 4), review)
+
+
+SCENARIOS = ('login_storm', 'tasks_active_polling', 'shift_reservation_burst', 'admin_review')
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_PATH, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(name: str, report: dict, baseline: dict | None):
+    print('\n{} ({:.1f} s, {:.0f} req/s)'.format(name, report['duration_s'], report['rps']))
+    print('  {:<48} {:>7} {:>9} {:>9} {:>9} {:>9} {:>8}'.format(
+        'endpoint', 'reqs', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+    for endpoint, stats in report['endpoints'].items():
+        line = '  {:<48} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>8}'.format(
+            endpoint, stats['requests'], stats['rps'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            '-' if stats['queries_per_request'] is None else '{:.1f}'.format(stats['queries_per_request']))
+        if previous := (baseline or {}).get(endpoint):
+            line += '   p95 {:+.0%}, req/s {:+.0%}'.format(stats['p95_ms'] / previous['p95_ms'] - 1,
+                                                         stats['rps'] / previous['rps'] - 1)
+        print(line)
+
+
+async def main(args: argparse.Namespace):
+    from sqlalchemy import select
+
+    from config import settings
+    from datagen import generate
+    from db.connector import get_db, get_engine, dispose_engine
+    from db.migrate import upgrade
+    from db.models import User, Shift
+    from main import app
+
+    await upgrade()
+    sizes = await generate(get_engine(), args.scale, args.seed, settings.BCRYPT_ROUNDS, reset=not args.reuse_data)
+    async with get_db() as session:
+        users = (await session.execute(select(User.id, User.email, User.username, User.is_admin))).all()
+        shift_ids = list(await session.scalars(select(Shift.id).where(Shift.start_date > datetime.now(timezone.utc))))
+    campers = [SimpleNamespace(**user._asdict()) for user in users if not user.is_admin]
+    admin = next(SimpleNamespace(**user._asdict()) for user in users if user.is_admin)
+    await dispose_engine()
+
+    baseline = json.loads(Path(args.baseline).read_text())['scenarios'] if args.baseline else {}
+    results = {'meta': {'commit': git_commit(), 'started_at': datetime.now(timezone.utc).isoformat(),
+                        'database': get_engine().dialect.name, 'scale': args.scale, 'sizes': sizes,
+                        'concurrency': args.concurrency, 'requests': args.requests, 'seed': args.seed,
+                        'python': platform.python_version()},
+               'scenarios': {}}
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://camp') as client:
+            for name in args.scenarios:
+                recorder = Recorder(client)
+                scenarios = Scenarios(recorder, campers, admin, shift_ids, args.concurrency)
+                start = time.perf_counter()
+                await getattr(scenarios, name)(args.requests)
+                results['scenarios'][name] = recorder.report(time.perf_counter() - start)
+                print_report(name, results['scenarios'][name], baseline.get(name, {}).get('endpoints'))
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+        print('\nResults written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default='sqlite+aiosqlite:///{}'.format(
+        Path(tempfile.gettempdir()) / 'camp_load_test.db'))
+    parser.add_argument('--scale', choices=('small', 'camp'), default='camp')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reuse-data', action='store_true', help='keep the data of a previous run')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='results JSON of a previous run to compare with')
+    args = parser.parse_args()
+    # settings are read when the app is imported
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ['SERVER_TIMING_HEADER'] = 'true'
+    os.environ.setdefault('AUTH_SECRET_KEY', 'load-test')
+    os.environ.setdefault('POSTGRES_PASSWORD', 'load-test')
+    os.environ.setdefault('REQUEST_TIME_BUDGET_MS', '60000')
+    os.environ.setdefault('REQUEST_QUERY_BUDGET', '1000')
+    # every simulated client shares one address, login_storm measures hashing rather than the rate limiter
+    os.environ.setdefault('RATE_LIMIT_ENABLED', 'false')
+    asyncio.run(main(args))
@@ -0,0 +1,102 @@
+"""
+Memory and throughput of reading a large table as ORM instances, as Core Row records, as a yield_per stream
+and as a streamed CSV export.
+
+    python benchmarks/readonly_listing.py [--rows 100000] [--database-url sqlite+aiosqlite:///./bench.db]
+
+The users table of the given database is filled with generated rows, so never point it to a real database.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from sqlalchemy import insert, delete, func, select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+# the app settings require these, the benchmark never uses them
+os.environ.setdefault('AUTH_SECRET_KEY', 'benchmark')
+os.environ.setdefault('POSTGRES_PASSWORD', 'benchmark')
+
+from db.crud.readonly import record_select, stream_records  # noqa: E402
+from db.crud.users import export_users  # noqa: E402
+from db.models import Base, User  # noqa: E402
+from exports import ENCODERS  # noqa: E402
+from user.schemas import UserInfo  # noqa: E402
+
+
+async def fill_users(engine, rows: int):
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        if await connection.scalar(select(func.count()).select_from(User)) == rows:
+            return
+        await connection.execute(delete(User))
+        batch = 10000
+        for offset in range(0, rows, batch):
+            await connection.execute(insert(User), [
+                dict(email='camper{}@camp.ru'.format(i), first_name='First{}'.format(i), last_name='Last{}'.format(i),
+                     username='camper{}'.format(i), points=i % 1000, hashed_password='x' * 60, is_admin=False)
+                for i in range(offset, min(offset + batch, rows))])
+
+
+async def read_orm(session) -> int:
+    return len(list(await session.scalars(select(User).order_by(User.id))))
+
+
+async def read_records(session) -> int:
+    return len(list(await session.execute(record_select(select(User), UserInfo).order_by(User.id))))
+
+
+async def read_stream(session) -> int:
+    count = 0
+    async for _ in stream_records(session, select(User).order_by(User.id), UserInfo):
+        count += 1
+    return count
+
+
+async def read_csv_export(session) -> int:
+    # the body chunks are dropped as a client would consume them
+    count = 0
+    records = export_users(session, UserInfo, ordering='registered_at')
+    async for chunk in ENCODERS['csv'](records, list(UserInfo.__fields__)):
+        count += chunk.count(b'\n')
+    return count - 1
+
+
+async def measure(session_factory, read) -> tuple[int, float, float]:
+    async with session_factory() as session:
+        start = time.perf_counter()
+        count = await read(session)
+        elapsed = time.perf_counter() - start
+    async with session_factory() as session:
+        tracemalloc.start()
+        await read(session)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return count, elapsed, peak / 2 ** 20
+
+
+async def main(rows: int, database_url: str):
+    engine = create_async_engine(database_url)
+    await fill_users(engine, rows)
+    session_factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+    print('{:<22} {:>8} {:>10} {:>12} {:>14}'.format('path', 'rows', 'seconds', 'rows/s', 'peak MiB'))
+    for name, read in (('orm instances', read_orm), ('core records', read_records),
+                       ('streamed records', read_stream), ('streamed csv export', read_csv_export)):
+        count, elapsed, peak = await measure(session_factory, read)
+        print('{:<22} {:>8} {:>10.2f} {:>12,.0f} {:>14.1f}'.format(name, count, elapsed, count / elapsed, peak))
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--database-url', default='sqlite+aiosqlite:///{}'.format(
+        Path(tempfile.gettempdir()) / 'camp_readonly_bench.db'))
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.database_url))
@@ -0,0 +1,153 @@
+"""
+Check of the read replica routing of the session layer (db.connector).
+
+    python benchmarks/replica_routing.py [--primary-url URL] [--replica-url URL]
+
+Counts the statements each engine runs while campers read and write news: read-only crud functions go to the
+replica, writes and the reads of a session that wrote go to the primary, and so do the reads of a camper for
+DB_REPLICA_MAX_LAG_SECONDS after their write. A second, unreachable replica is configured as well and has to be
+taken out of rotation by the health check without a single failed read.
+By default the primary is a SQLite file and the replica a copy of it. With two local PostgreSQL instances pass
+both urls, the replica streaming from the primary. The primary is migrated and its news are replaced.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from sqlalchemy import make_url
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+CAMPER = 'camper@camp.ru'
+OTHER_CAMPER = 'other@camp.ru'
+
+
+def count_statements(statements: Counter) -> list:
+    """Count the statements of every engine under its name, returns the replicas"""
+    from sqlalchemy import event
+
+    from db.connector import get_engine, get_replicas
+
+    def counter(name: str):
+        def count(*args):
+            statements[name] += 1
+        return count
+
+    event.listen(get_engine().sync_engine, 'before_cursor_execute', counter('primary'))
+    for number, replica in enumerate(get_replicas()):
+        event.listen(replica.engine.sync_engine, 'before_cursor_execute', counter('replica {}'.format(number)))
+    return get_replicas()
+
+
+async def step(statements: Counter, title: str, work) -> Counter:
+    from db.connector import SessionLocal, get_engine
+
+    statements.clear()
+    async with SessionLocal(bind=get_engine()) as session:
+        await work(session)
+    print('{:<55} {}'.format(title, ', '.join('{} {}'.format(name, count)
+                                               for name, count in sorted(statements.items()))))
+    return Counter(statements)
+
+
+async def main(args: argparse.Namespace) -> list[str]:
+    from sqlalchemy import delete
+
+    from config import settings
+    from db.connector import get_engine, replica_monitor, set_session_user
+    from db.crud.news import add_news, get_news
+    from db.models import News
+
+    statements = Counter()
+    failures = []
+    async with get_engine().begin() as connection:
+        await connection.execute(delete(News.__table__))
+    if args.copy_primary:
+        await get_engine().dispose()
+        shutil.copyfile(make_url(args.primary_url).database, make_url(args.replica_url).database)
+    live, dead = count_statements(statements)
+    await replica_monitor.start()
+    print('replica health: live {}, unreachable {}'.format(live.healthy, dead.healthy))
+    if not live.healthy or dead.healthy:
+        failures.append('the health check should keep only the live replica in rotation')
+
+    async def read(session, email=CAMPER):
+        await set_session_user(session, email)
+        await get_news(session)
+
+    async def write_then_read(session):
+        await set_session_user(session, CAMPER)
+        await add_news(session, 'Replica check', 'written on the primary')
+        await get_news(session)
+
+    counts = await step(statements, 'camper reads news', read)
+    if counts['primary'] or not counts['replica 0']:
+        failures.append('reads should go to the replica')
+    counts = await step(statements, 'camper writes news and reads them back', write_then_read)
+    if not counts['primary'] or counts['replica 0']:
+        failures.append('a session which wrote should stay on the primary')
+    counts = await step(statements, 'camper reads right after the write', read)
+    if not counts['primary'] or counts['replica 0']:
+        failures.append('the reads of a recent writer should go to the primary')
+    counts = await step(statements, 'another camper reads', lambda session: read(session, OTHER_CAMPER))
+    if counts['primary'] or not counts['replica 0']:
+        failures.append('the reads of other campers should go to the replica')
+    await asyncio.sleep(settings.DB_REPLICA_MAX_LAG_SECONDS)
+    counts = await step(statements, 'camper reads once the replicas caught up', read)
+    if counts['primary'] or not counts['replica 0']:
+        failures.append('the reads of a former writer should go back to the replica')
+    if any(name == 'replica 1' for name in statements):
+        failures.append('the unreachable replica should not get any statement')
+
+    # the live replica goes away as well: reads fail over to the primary
+    live.set_healthy(False)
+    start = time.perf_counter()
+    counts = await step(statements, 'camper reads with every replica out of rotation', read)
+    if not counts['primary'] or counts['replica 0'] or counts['replica 1']:
+        failures.append('reads should fail over to the primary')
+    print('failover read took {:.1f} ms'.format((time.perf_counter() - start) * 1000))
+    await replica_monitor.stop()
+    return failures
+
+
+async def run(args: argparse.Namespace):
+    from db.connector import dispose_engine
+    from db.migrate import upgrade
+
+    await upgrade()
+    try:
+        failures = await main(args)
+    finally:
+        await dispose_engine()
+    for failure in failures:
+        print('FAILED:', failure)
+    if not failures:
+        print('OK: reads on the replica, writes and recent writers on the primary, failover to the primary')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    directory = Path(tempfile.gettempdir())
+    parser.add_argument('--primary-url', default='sqlite+aiosqlite:///{}'.format(directory / 'camp_primary.db'))
+    parser.add_argument('--replica-url')
+    parser.add_argument('--max-lag', type=float, default=1)
+    args = parser.parse_args()
+    # a sqlite replica is a copy of the primary taken after the migration
+    args.copy_primary = args.replica_url is None
+    if args.copy_primary:
+        args.replica_url = 'sqlite+aiosqlite:///{}'.format(directory / 'camp_replica.db')
+    unreachable = 'sqlite+aiosqlite:///{}'.format(directory / 'camp-missing-directory' / 'replica.db')
+    # settings are read when the app modules are imported
+    os.environ['DATABASE_URL'] = args.primary_url
+    os.environ['DB_REPLICA_URLS'] = ','.join([args.replica_url, unreachable])
+    os.environ['DB_REPLICA_MAX_LAG_SECONDS'] = str(args.max_lag)
+    os.environ.setdefault('AUTH_SECRET_KEY', 'replica-check')
+    os.environ.setdefault('POSTGRES_PASSWORD', 'replica-check')
+    asyncio.run(run(args))
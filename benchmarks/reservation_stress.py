@@ -0,0 +1,155 @@
+"""
+Concurrency stress test of the shift reservation engine (db.crud.shifts).
+
+    python benchmarks/reservation_stress.py [--database-url URL] [--campers 5000] [--capacity 300]
+                                            [--attempts 8000] [--concurrency 10] [--cancel-ratio 0.1]
+
+A crowd of campers reserves one shift at the same time (with repeated attempts by the same camper and some
+cancellations), then the final state is checked: the shift is never overbooked, its counters match the
+reservations, nobody holds two reservations and nobody waits while a place is free.
+The database is migrated and its users and shifts are replaced, so never point it to a real database.
+SQLite serializes writers, so raise --concurrency only against PostgreSQL.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+
+def camper_email(i: int) -> str:
+    return 'stress{}@camp.ru'.format(i)
+
+
+async def prepare(campers: int, capacity: int) -> int:
+    """Fresh campers and one empty shift, returns the shift id"""
+    from sqlalchemy import delete, insert
+
+    from db.connector import get_engine
+    from db.models import Shift, ShiftReservation, User
+
+    start = datetime.now(timezone.utc) + timedelta(days=7)
+    async with get_engine().begin() as connection:
+        for model in (ShiftReservation, Shift, User):
+            await connection.execute(delete(model.__table__))
+        await connection.execute(insert(User), [
+            dict(email=camper_email(i), first_name='Camper', last_name=str(i), username='stress{}'.format(i),
+                 hashed_password='x' * 60, points=0, is_admin=False) for i in range(campers)])
+        return await connection.scalar(insert(Shift).values(
+            name='Stress shift', number='1', description='Reservation stress test', capacity=capacity,
+            participants_number=0, start_date=start, end_date=start + timedelta(days=14)).returning(Shift.id))
+
+
+async def storm(shift_id: int, campers: int, attempts: int, concurrency: int, cancel_ratio: float,
+                seed: int) -> tuple[Counter, float]:
+    from db.connector import SessionLocal, get_engine
+    from db.crud.shifts import reserve_shift, cancel_shift_reservation
+    from exceptions import DatabaseElementConflictError, DatabaseElementNotFoundError
+
+    outcomes = Counter()
+    remaining = attempts
+
+    async def worker(number: int):
+        nonlocal remaining
+        rng = random.Random(seed * 1000 + number)
+        while remaining > 0:
+            remaining -= 1
+            email = camper_email(rng.randrange(campers))
+            async with SessionLocal(bind=get_engine()) as session:
+                try:
+                    if rng.random() < cancel_ratio:
+                        await cancel_shift_reservation(session, shift_id, email)
+                        outcomes['cancelled'] += 1
+                    elif await reserve_shift(session, shift_id, email):
+                        outcomes['waitlisted'] += 1
+                    else:
+                        outcomes['admitted'] += 1
+                except DatabaseElementConflictError:
+                    outcomes['duplicate'] += 1
+                except DatabaseElementNotFoundError:
+                    outcomes['nothing to cancel'] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(number) for number in range(concurrency)))
+    return outcomes, time.perf_counter() - start
+
+
+async def check(shift_id: int) -> list[str]:
+    """Invariants of the final state, returns the violations"""
+    from sqlalchemy import func, select
+
+    from db.connector import get_engine
+    from db.models import Shift, ShiftReservation
+
+    async with get_engine().connect() as connection:
+        shift = (await connection.execute(select(Shift.capacity, Shift.reserved_number, Shift.participants_number)
+                                          .filter(Shift.id == shift_id))).one()
+        admitted, waitlisted, approved = (await connection.execute(select(
+            func.count().filter(ShiftReservation.is_waitlisted == False),
+            func.count().filter(ShiftReservation.is_waitlisted == True),
+            func.count().filter(ShiftReservation.is_approved == True)).filter(
+            ShiftReservation.shift_id == shift_id))).one()
+        duplicates = await connection.scalar(select(func.count()).select_from(
+            select(ShiftReservation.user_email).filter(ShiftReservation.shift_id == shift_id).group_by(
+                ShiftReservation.user_email).having(func.count() > 1).subquery()))
+    print('capacity {}, reserved_number {}, admitted {}, waitlisted {}'.format(
+        shift.capacity, shift.reserved_number, admitted, waitlisted))
+    violations = []
+    if admitted > shift.capacity:
+        violations.append('overbooked: {} admitted for {} places'.format(admitted, shift.capacity))
+    if shift.reserved_number != admitted:
+        violations.append('reserved_number {} != {} admitted reservations'.format(shift.reserved_number, admitted))
+    if shift.participants_number != approved:
+        violations.append('participants_number {} != {} approved'.format(shift.participants_number, approved))
+    if waitlisted and admitted < shift.capacity:
+        violations.append('{} waitlisted while {} places are free'.format(waitlisted, shift.capacity - admitted))
+    if duplicates:
+        violations.append('{} campers hold more than one reservation'.format(duplicates))
+    return violations
+
+
+async def main(args: argparse.Namespace):
+    from db.connector import dispose_engine
+    from db.migrate import upgrade
+
+    try:
+        await upgrade()
+        shift_id = await prepare(args.campers, args.capacity)
+        outcomes, elapsed = await storm(shift_id, args.campers, args.attempts, args.concurrency,
+                                        args.cancel_ratio, args.seed)
+        print('{} attempts by {} concurrent clients in {:.2f} s: {:,.0f} operations/s'.format(
+            args.attempts, args.concurrency, elapsed, args.attempts / elapsed))
+        print(', '.join('{} {}'.format(name, count) for name, count in sorted(outcomes.items())))
+        violations = await check(shift_id)
+    finally:
+        await dispose_engine()
+    for violation in violations:
+        print('FAILED:', violation)
+    if not violations:
+        print('OK: no overbooking, counters consistent, no duplicates, no idle places while campers wait')
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default='sqlite+aiosqlite:///{}'.format(
+        Path(tempfile.gettempdir()) / 'camp_reservation_stress.db'))
+    parser.add_argument('--campers', type=int, default=5000)
+    parser.add_argument('--capacity', type=int, default=300)
+    parser.add_argument('--attempts', type=int, default=8000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--cancel-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    # settings are read when the app modules are imported
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('AUTH_SECRET_KEY', 'stress-test')
+    os.environ.setdefault('POSTGRES_PASSWORD', 'stress-test')
+    asyncio.run(main(args))
@@ -0,0 +1,69 @@
+"""
+Micro-benchmark of list endpoint serialization: the pydantic path (row -> dict -> model, then FastAPI response model
+validation and JSONResponse encoding) against the direct path (attrgetter row mapping and orjson encoding).
+
+    python benchmarks/serialization.py [--items 50 500] [--repeat 200]
+"""
+import argparse
+import asyncio
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from fastapi.responses import JSONResponse, ORJSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_response_field  # noqa: E402
+
+from db.crud.pagination import Page  # noqa: E402
+from db.models import Task  # noqa: E402
+from schemas import Page as PageAPI  # noqa: E402
+from tasks.schemas import TaskInfo  # noqa: E402
+from utils import convert_sqlalchemy_row_to_dict, serialize_page  # noqa: E402
+
+
+def make_page(size: int) -> Page:
+    now = datetime.now(timezone.utc)
+    tasks = [Task(id=i, title='task {}'.format(i), description='description ' * 10, points=i % 10,
+                  start_date=now - timedelta(days=1), end_date=now + timedelta(days=i), author_email='admin@camp.ru',
+                  is_active=True) for i in range(size)]
+    return Page(tasks, next_cursor='eyJvIjogInN0YXJ0X2RhdGUifQ==', total=None)
+
+
+async def pydantic_path(page: Page, field) -> bytes:
+    content = PageAPI[TaskInfo](items=[TaskInfo(**convert_sqlalchemy_row_to_dict(task)) for task in page.items],
+                                next_cursor=page.next_cursor, total=page.total)
+    return JSONResponse(await serialize_response(field=field, response_content=content)).body
+
+
+async def direct_path(page: Page, field) -> bytes:
+    return ORJSONResponse(serialize_page(page, TaskInfo)).body
+
+
+async def measure(path, page: Page, field, repeat: int) -> float:
+    await path(page, field)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await path(page, field)
+    return time.perf_counter() - start
+
+
+async def main(sizes: list[int], repeat: int):
+    field = create_response_field(name='response', type_=PageAPI[TaskInfo])
+    print('{:>6} {:>22} {:>22} {:>8}'.format('items', 'pydantic (items/s)', 'direct (items/s)', 'speedup'))
+    for size in sizes:
+        page = make_page(size)
+        before = await measure(pydantic_path, page, field, repeat)
+        after = await measure(direct_path, page, field, repeat)
+        print('{:>6} {:>22,.0f} {:>22,.0f} {:>7.1f}x'.format(size, size * repeat / before, size * repeat / after,
+                                                            before / after))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, nargs='+', default=[50, 500])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.items, args.repeat))
@@ -0,0 +1,44 @@
+import time
+
+from config import settings
+from shared_cache import TTLCache, create_cache
+from user.schemas import UserInfo
+
+
+# decoded token payloads keyed by raw token, they depend on the token only so every worker keeps its own
+token_cache = TTLCache(settings.AUTH_CACHE_MAX_SIZE, settings.AUTH_CACHE_TTL_SECONDS)
+# users keyed by email
+user_cache = create_cache('users', settings.AUTH_CACHE_MAX_SIZE, settings.AUTH_CACHE_TTL_SECONDS)
+
+# revoked token ids and per-user revocation timestamps (tokens issued before it are invalid),
+# both only matter until the tokens they concern expire, and must never be evicted before
+_revocations = create_cache('revoked', None, settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
+
+async def get_cached_user(email: str) -> UserInfo | None:
+    return await user_cache.get(email)
+
+
+async def cache_user(user: UserInfo):
+    await user_cache.set(user.email, user)
+
+
+async def invalidate_user(*emails: str):
+    await user_cache.delete(*emails)
+
+
+async def revoke_token(jti: str, expire: float):
+    await _revocations.set('token:' + jti, True, ttl=expire - time.time())
+
+
+async def revoke_user_tokens(email: str):
+    await invalidate_user(email)
+    await _revocations.set('user:' + email, time.time())
+
+
+async def is_token_revoked(payload: dict) -> bool:
+    revoked_token, revoked_at = await _revocations.get_many('token:{}'.format(payload.get('jti')),
+                                                            'user:{}'.format(payload.get('email')))
+    if payload.get('jti') and revoked_token:
+        return True
+    return revoked_at is not None and payload.get('iat', 0) <= revoked_at
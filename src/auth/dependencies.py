@@ -1,37 +1,64 @@
+import time
+
 import jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from auth.cache import token_cache, get_cached_user, cache_user, is_token_revoked
+from db.connector import get_session, set_session_user
 from db.crud.users import get_user_by_email
 from config import settings
+from exceptions import DatabaseElementNotFoundError
 from user.schemas import UserInfo
 from utils import convert_sqlalchemy_row_to_dict
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login", scheme_name="JWT")
 
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInfo:
+def decode_token(token: str) -> dict:
+    # signature and expiry are checked once, then the payload is served from cache until the token expires
+    if (payload := token_cache.get(token)) is not None:
+        return payload
     try:
         payload = jwt.decode(token, settings.AUTH_SECRET_KEY, algorithms=[settings.ALGORITHM])
-        email: str = payload.get("email")
-        if email is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Could not validate credentials",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
     except jwt.PyJWTError:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    user = get_user_by_email(email)
-    return UserInfo(**convert_sqlalchemy_row_to_dict(user))
+        raise credentials_exception
+    if payload.get("email") is None:
+        raise credentials_exception
+    token_cache.set(token, payload, ttl=payload["exp"] - time.time() if "exp" in payload else None)
+    return payload
+
+
+async def get_token_payload(token: str = Depends(oauth2_scheme)) -> dict:
+    payload = decode_token(token)
+    if await is_token_revoked(payload):
+        raise credentials_exception
+    return payload
+
+
+async def get_current_user(payload: dict = Depends(get_token_payload),
+                           session: AsyncSession = Depends(get_session)) -> UserInfo:
+    email: str = payload["email"]
+    await set_session_user(session, email)
+    if (user := await get_cached_user(email)) is not None:
+        return user
+    try:
+        user = UserInfo(**convert_sqlalchemy_row_to_dict(await get_user_by_email(session, email)))
+    except DatabaseElementNotFoundError:
+        raise credentials_exception
+    await cache_user(user)
+    return user
 
 
 async def check_user_status(user: UserInfo = Depends(get_current_user)):
     if not user.is_admin:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail="Current user has no permission to do this action")
-    return user
\ No newline at end of file
+    return user
@@ -0,0 +1,105 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from config import settings
+
+# passwords of a batch hashed per call, small so that logins and registrations get a slot in between
+HASH_MANY_CHUNK_SIZE = 4
+
+# hashes made with fewer rounds than configured are reported by needs_update and rehashed on login
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=settings.BCRYPT_ROUNDS)
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _hash_many(passwords: list[str]) -> list[str]:
+    return [pwd_context.hash(password) for password in passwords]
+
+
+def _verify_and_update(password: str, hashed_password: str) -> tuple[bool, str | None]:
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+class PasswordHashingOverloadedError(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail="Too many authentication requests, try again later", headers={"Retry-After": "1"})
+
+
+class PasswordHasher:
+    """Runs bcrypt in a dedicated process pool with bounded concurrency and queue depth"""
+
+    def __init__(self, workers: int, max_concurrency: int, max_queue: int):
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._executor: ProcessPoolExecutor | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        # slots batches may take, one is always left to interactive hashes
+        self._batch_semaphore: asyncio.Semaphore | None = None
+        self._queued = 0
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    async def _run(self, func, *args):
+        if self._queued >= self.max_queue:
+            raise PasswordHashingOverloadedError()
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        # requests waiting for a free hashing slot count towards the queue depth
+        self._queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._queued -= 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self._semaphore.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password)
+
+    async def hash_many(self, passwords: list[str]) -> list[str]:
+        """Hash a batch of passwords in small chunks, which queue for a hashing slot like single hashes do"""
+        if self._batch_semaphore is None:
+            self._batch_semaphore = asyncio.Semaphore(max(1, min(self.workers, self.max_concurrency) - 1))
+
+        async def hash_chunk(chunk: list[str]) -> list[str]:
+            # chunks waiting here do not count towards the queue depth
+            async with self._batch_semaphore:
+                return await self._run(_hash_many, chunk)
+
+        tasks = [asyncio.ensure_future(hash_chunk(passwords[i:i + HASH_MANY_CHUNK_SIZE]))
+                 for i in range(0, len(passwords), HASH_MANY_CHUNK_SIZE)]
+        try:
+            hashed = await asyncio.gather(*tasks)
+        except BaseException:
+            # the batch failed, the chunks still waiting are not hashed
+            for task in tasks:
+                task.cancel()
+            raise
+        return [password for chunk in hashed for password in chunk]
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> tuple[bool, str | None]:
+        return await self._run(_verify_and_update, password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(workers=settings.PASSWORD_HASH_WORKERS,
+                                 max_concurrency=settings.PASSWORD_HASH_MAX_CONCURRENCY,
+                                 max_queue=settings.PASSWORD_HASH_MAX_QUEUE)
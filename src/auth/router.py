@@ -1,83 +1,103 @@
 from datetime import datetime, timedelta
+from uuid import uuid4
 
 import jwt
 from fastapi import HTTPException, Depends, APIRouter, status
 from fastapi.security import OAuth2PasswordRequestForm
-from passlib.context import CryptContext
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from auth.cache import cache_user, revoke_token
+from auth.dependencies import get_token_payload
+from auth.hashing import password_hasher
 from auth.schemas import Token, UserRegister
 from config import settings
-from db.crud.users import get_user_by_email, add_new_user
+from db.connector import get_session
+from db.crud.users import get_user_by_email, add_new_user, update_user_by_email
 from db.models import User
 from exceptions import DatabaseElementNotFoundError
+from rate_limit import limit_auth_requests
 from user.schemas import UserInfo
 from utils import convert_sqlalchemy_row_to_dict
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+auth_router = APIRouter(tags=["Authentication"], prefix='/auth', dependencies=[Depends(limit_auth_requests)])
 
-auth_router = APIRouter(tags=["Authentication"], prefix='/auth')
 
+async def get_password_hash(password) -> str:
+    return await password_hasher.hash(password)
 
-def verify_password(plain_password, hashed_password) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
 
-
-def get_password_hash(password) -> str:
-    return pwd_context.hash(password)
-
-
-def authenticate_user(email: str, password: str) -> User | None:
-    user = get_user_by_email(email)
-    if not verify_password(password, user.hashed_password):
+async def authenticate_user(session: AsyncSession, email: str, password: str) -> User | None:
+    user = await get_user_by_email(session, email)
+    valid, new_hash = await password_hasher.verify_and_update(password, user.hashed_password)
+    if not valid:
         return None
+    # stored hash uses outdated parameters (e.g. fewer bcrypt rounds), replace it while we know the password
+    if new_hash:
+        await update_user_by_email(session, user.email, hashed_password=new_hash)
     return user
 
 
 def create_access_token(data: dict, expires_delta: timedelta) -> str:
     to_encode = data.copy()
-    expire = datetime.utcnow() + expires_delta
-    to_encode.update({"exp": expire})
+    now = datetime.utcnow()
+    to_encode.update({"exp": now + expires_delta, "iat": now, "jti": uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, settings.AUTH_SECRET_KEY, algorithm='HS256')
     return encoded_jwt
 
 
+def create_user_access_token(user: UserInfo, expires_delta: timedelta) -> str:
+    return create_access_token(
+        data={"id": user.id, "username": user.username, "email": user.email, "is_admin": user.is_admin},
+        expires_delta=expires_delta
+    )
+
+
 @auth_router.post("/register")
-def register_user(user: UserRegister) -> Token:
+async def register_user(user: UserRegister, session: AsyncSession = Depends(get_session)) -> Token:
     # check if user already in db
     try:
-        if get_user_by_email(email=user.email):
+        if await get_user_by_email(session, email=user.email):
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email is already registered")
     except DatabaseElementNotFoundError:
         pass
 
-    add_new_user(first_name=user.first_name, last_name=user.last_name,
-                 email=user.email, username=user.username,
-                 hashed_password=get_password_hash(user.password), admin=user.is_admin)
+    await add_new_user(session, first_name=user.first_name, last_name=user.last_name,
+                       email=user.email, username=user.username,
+                       hashed_password=await get_password_hash(user.password),
+                       admin=user.is_admin)
 
     # return new user form db (to get id)
-    user = UserInfo(**convert_sqlalchemy_row_to_dict(get_user_by_email(email=user.email)))
+    user = UserInfo(**convert_sqlalchemy_row_to_dict(await get_user_by_email(session, email=user.email)))
+    await cache_user(user)
 
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"username": user.username, "email": user.email, "exp": datetime.utcnow() + access_token_expires},
-        expires_delta=access_token_expires
-    )
+    access_token = create_user_access_token(user, access_token_expires)
     return Token(access_token=access_token, token_type='bearer',
                  expire=datetime.utcnow() + access_token_expires,
                  user_info=user)
 
 
 @auth_router.post("/login")
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()) -> Token:
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(),
+                                 session: AsyncSession = Depends(get_session)) -> Token:
     try:
-        user = authenticate_user(form_data.username, form_data.password)
+        user = await authenticate_user(session, form_data.username, form_data.password)
     except DatabaseElementNotFoundError:
+        user = None
+    if user is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect email or password")
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"username": user.username, "email": user.email, "exp": datetime.utcnow() + access_token_expires},
-        expires_delta=access_token_expires
-    )
+    user = UserInfo(**convert_sqlalchemy_row_to_dict(user))
+    await cache_user(user)
+    access_token = create_user_access_token(user, access_token_expires)
     return Token(access_token=access_token, token_type='bearer',
                  expire=datetime.utcnow() + access_token_expires,
-                 user_info=UserInfo(**convert_sqlalchemy_row_to_dict(user)))
+                 user_info=user)
+
+
+@auth_router.post("/logout")
+async def logout(payload: dict = Depends(get_token_payload)):
+    """Revoke current access token"""
+    if payload.get("jti"):
+        await revoke_token(payload["jti"], payload["exp"])
+    return {'status': 'success', 'message': 'Token revoked'}
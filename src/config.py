@@ -1,4 +1,6 @@
 import pathlib
+from typing import Literal
+
 from dotenv import load_dotenv
 from pydantic import BaseSettings, Field
 
@@ -13,14 +15,65 @@ class Settings(BaseSettings):
     POSTGRES_HOST: str = Field(default='db', env='POSTGRES_HOST')
     POSTGRES_PORT: int = Field(default=5432, env='POSTGRES_PORT')
     POSTGRES_DB: str = Field(default='postgres', env='POSTGRES_DB')
+    # full async db url, overrides postgres settings (e.g. sqlite+aiosqlite:///./camp.db for local runs)
+    DATABASE_URL: str = Field(default=None, env='DATABASE_URL')
+    # db connection pool
+    DB_POOL_SIZE: int = Field(default=5, env='DB_POOL_SIZE')
+    DB_MAX_OVERFLOW: int = Field(default=10, env='DB_MAX_OVERFLOW')
+    DB_POOL_TIMEOUT: int = Field(default=30, env='DB_POOL_TIMEOUT')
+    DB_POOL_RECYCLE: int = Field(default=1800, env='DB_POOL_RECYCLE')
+    DB_POOL_PRE_PING: bool = Field(default=True, env='DB_POOL_PRE_PING')
+    # read replicas: comma separated async db urls, read-only queries are spread over the healthy ones
+    DB_REPLICA_URLS: str = Field(default='', env='DB_REPLICA_URLS')
+    # a replica lagging more is out of rotation, and a user reads from the primary for as long after a write
+    DB_REPLICA_MAX_LAG_SECONDS: float = Field(default=5, env='DB_REPLICA_MAX_LAG_SECONDS')
+    DB_REPLICA_CHECK_INTERVAL_SECONDS: float = Field(default=5, env='DB_REPLICA_CHECK_INTERVAL_SECONDS')
     # for api
     API_HOST: str = Field(default='0.0.0.0', env='API_HOST')
     API_VERSION: str = Field(default='1.0.0', env='API_VERSION')
     API_DESCRIPTION: str = Field(default='API service for children`s camp 🏕', env='API_DESCRIPTION')
+    # production server (serve.py): worker processes (0 = one per cpu core), recycled after about
+    # API_MAX_REQUESTS requests (0 = never), given API_GRACEFUL_TIMEOUT seconds to finish requests on shutdown
+    API_WORKERS: int = Field(default=1, ge=0, env='API_WORKERS')
+    API_MAX_REQUESTS: int = Field(default=10000, ge=0, env='API_MAX_REQUESTS')
+    API_MAX_REQUESTS_JITTER: int = Field(default=1000, ge=0, env='API_MAX_REQUESTS_JITTER')
+    API_GRACEFUL_TIMEOUT: int = Field(default=30, env='API_GRACEFUL_TIMEOUT')
+    # caches of users, revoked tokens, responses and their versions, leaderboard and rate limits:
+    # memory (this process, single worker only) or redis (shared by all workers and instances)
+    CACHE_BACKEND: Literal['memory', 'redis'] = Field(default='memory', env='CACHE_BACKEND')
+    CACHE_REDIS_URL: str = Field(default='redis://localhost:6379/0', env='CACHE_REDIS_URL')
     # api auth settings
     AUTH_SECRET_KEY: str = Field(..., env="AUTH_SECRET_KEY")
     ALGORITHM: str = Field(default='HS256', env="ALGORITHM")
     ACCESS_TOKEN_EXPIRE_MINUTES: int = Field(default=30, env="ACCESS_TOKEN_EXPIRE_MINUTES")
+    # in-process cache of decoded tokens and authenticated users
+    AUTH_CACHE_TTL_SECONDS: int = Field(default=60, env="AUTH_CACHE_TTL_SECONDS")
+    AUTH_CACHE_MAX_SIZE: int = Field(default=10000, env="AUTH_CACHE_MAX_SIZE")
+    # password hashing
+    BCRYPT_ROUNDS: int = Field(default=12, env="BCRYPT_ROUNDS")
+    PASSWORD_HASH_WORKERS: int = Field(default=2, env="PASSWORD_HASH_WORKERS")
+    PASSWORD_HASH_MAX_CONCURRENCY: int = Field(default=2, env="PASSWORD_HASH_MAX_CONCURRENCY")
+    PASSWORD_HASH_MAX_QUEUE: int = Field(default=64, env="PASSWORD_HASH_MAX_QUEUE")
+    # serialized responses of conditional (ETag) read endpoints
+    HTTP_CACHE_TTL_SECONDS: int = Field(default=60, env="HTTP_CACHE_TTL_SECONDS")
+    HTTP_CACHE_MAX_SIZE: int = Field(default=1024, env="HTTP_CACHE_MAX_SIZE")
+    # requests above these budgets are logged as warnings
+    REQUEST_QUERY_BUDGET: int = Field(default=20, env="REQUEST_QUERY_BUDGET")
+    REQUEST_TIME_BUDGET_MS: int = Field(default=500, env="REQUEST_TIME_BUDGET_MS")
+    # report db time and query count of each request in a Server-Timing header (benchmarks, debugging)
+    SERVER_TIMING_HEADER: bool = Field(default=False, env="SERVER_TIMING_HEADER")
+    # max number of ids in one bulk approve/check request
+    BULK_MAX_ITEMS: int = Field(default=500, env="BULK_MAX_ITEMS")
+    # users validated, hashed and inserted together by the bulk import
+    USER_IMPORT_BATCH_SIZE: int = Field(default=500, env="USER_IMPORT_BATCH_SIZE")
+    # token bucket rate limits of the auth endpoints, checked before any password hashing
+    RATE_LIMIT_ENABLED: bool = Field(default=True, env="RATE_LIMIT_ENABLED")
+    # buckets kept by the memory backend
+    RATE_LIMIT_MAX_KEYS: int = Field(default=100000, env="RATE_LIMIT_MAX_KEYS")
+    RATE_LIMIT_AUTH_IP_BURST: int = Field(default=20, env="RATE_LIMIT_AUTH_IP_BURST")
+    RATE_LIMIT_AUTH_IP_PER_MINUTE: float = Field(default=10, gt=0, env="RATE_LIMIT_AUTH_IP_PER_MINUTE")
+    RATE_LIMIT_AUTH_EMAIL_BURST: int = Field(default=5, env="RATE_LIMIT_AUTH_EMAIL_BURST")
+    RATE_LIMIT_AUTH_EMAIL_PER_MINUTE: float = Field(default=2, gt=0, env="RATE_LIMIT_AUTH_EMAIL_PER_MINUTE")
 
     class Config:
         env_prefix = ""
@@ -28,6 +81,17 @@ class Settings(BaseSettings):
         env_file = '../.env'
         env_file_encoding = 'utf-8'
 
+    @property
+    def database_url(self) -> str:
+        if self.DATABASE_URL:
+            return self.DATABASE_URL
+        return (f"postgresql+asyncpg://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}"
+                f"@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}")
+
+    @property
+    def replica_urls(self) -> list[str]:
+        return [url.strip() for url in self.DB_REPLICA_URLS.split(',') if url.strip()]
+
 
 # load env from file
 load_dotenv()
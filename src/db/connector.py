@@ -1,22 +1,310 @@
-from contextlib import contextmanager
+import asyncio
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import AsyncIterator
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import make_url, event, text, select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncEngine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.sql.dml import UpdateBase
 
 from config import settings
-from db.models import Base
+from metrics import get_request_stats
+from shared_cache import create_cache
 
-engine = create_engine(
-    f"postgresql+psycopg2://{settings.POSTGRES_USER}:{settings.POSTGRES_PASSWORD}@{settings.POSTGRES_HOST}:{settings.POSTGRES_PORT}/{settings.POSTGRES_DB}")
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+logger = logging.getLogger(__name__)
 
-Base.metadata.create_all(bind=engine)
+
+class PoolWaitStatistics:
+    """Accumulated time spent by callers waiting for a pool checkout"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float):
+        self.checkouts += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self) -> dict:
+        return {'checkouts': self.checkouts,
+                'total_wait_seconds': self.total_wait,
+                'avg_wait_seconds': self.total_wait / self.checkouts if self.checkouts else 0.0,
+                'max_wait_seconds': self.max_wait}
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool which records how long each connection checkout waited"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_statistics = PoolWaitStatistics()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.perf_counter() - start
+            self.wait_statistics.record(wait)
+            if stats := get_request_stats():
+                stats.record_pool_wait(wait)
+
+
+def _pool_options(url: str) -> dict:
+    # in-memory sqlite lives in a single connection, keep the dialect default pool for it
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+    return dict(poolclass=InstrumentedQueuePool,
+                pool_size=settings.DB_POOL_SIZE,
+                max_overflow=settings.DB_MAX_OVERFLOW,
+                pool_timeout=settings.DB_POOL_TIMEOUT,
+                pool_recycle=settings.DB_POOL_RECYCLE,
+                pool_pre_ping=settings.DB_POOL_PRE_PING)
+
+
+_engine: AsyncEngine | None = None
+
+
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if stats := get_request_stats():
+        stats.record_query(elapsed)
+
+
+def _discard_query_timer(context):
+    # failed statements never reach after_cursor_execute
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+def _create_engine(url: str) -> AsyncEngine:
+    engine = create_async_engine(url, **_pool_options(url))
+    event.listen(engine.sync_engine, 'before_cursor_execute', _start_query_timer)
+    event.listen(engine.sync_engine, 'after_cursor_execute', _record_query)
+    event.listen(engine.sync_engine, 'handle_error', _discard_query_timer)
+    return engine
+
+
+def get_engine() -> AsyncEngine:
+    """Engine of the main database, created on first use so that importing the app never needs the database"""
+    global _engine
+    if _engine is None:
+        _engine = _create_engine(settings.database_url)
+    return _engine
+
+
+class Replica:
+    """Read-only copy of the main database, out of rotation while it is unreachable or lags behind too much"""
+
+    def __init__(self, url: str):
+        self.url = make_url(url)
+        self.engine = _create_engine(url)
+        self.healthy = True
+        self.lag: float | None = None
+        event.listen(self.engine.sync_engine, 'handle_error', self._on_error)
+
+    def _on_error(self, context):
+        # a lost replica is dropped at once instead of at the next health check
+        if context.is_disconnect:
+            self.set_healthy(False)
+
+    def set_healthy(self, healthy: bool):
+        if healthy != self.healthy:
+            logger.warning('Replica %s is %s', self.url.render_as_string(hide_password=True),
+                           'back in rotation' if healthy else 'out of rotation')
+        self.healthy = healthy
+
+    async def check(self):
+        try:
+            async with asyncio.timeout(settings.DB_REPLICA_CHECK_INTERVAL_SECONDS):
+                async with self.engine.connect() as connection:
+                    if self.url.get_backend_name() == 'postgresql':
+                        # replay delay, zero when the replica has replayed everything it received
+                        self.lag = await connection.scalar(text(
+                            'SELECT CASE WHEN NOT pg_is_in_recovery() '
+                            'OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                            'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'))
+                    else:
+                        await connection.scalar(select(1))
+                        self.lag = 0.0
+        except Exception:
+            logger.debug('Health check of replica %s failed', self.url.render_as_string(hide_password=True),
+                         exc_info=True)
+            self.lag = None
+            self.set_healthy(False)
+            return
+        self.set_healthy(self.lag is None or self.lag <= settings.DB_REPLICA_MAX_LAG_SECONDS)
+
+
+_replicas: list[Replica] | None = None
+_replica_turns = itertools.count()
+
+
+def get_replicas() -> list[Replica]:
+    global _replicas
+    if _replicas is None:
+        _replicas = [Replica(url) for url in settings.replica_urls]
+    return _replicas
+
+
+def _next_replica() -> Replica | None:
+    """Round-robin over the healthy replicas, None sends the reads to the primary"""
+    if healthy := [replica for replica in get_replicas() if replica.healthy]:
+        return healthy[next(_replica_turns) % len(healthy)]
+    return None
+
+
+class ReplicaMonitor:
+    """Checks every replica in the background and takes it out of (or back into) rotation"""
+
+    def __init__(self):
+        self._worker: asyncio.Task | None = None
+
+    async def start(self):
+        if get_replicas():
+            await asyncio.gather(*(replica.check() for replica in get_replicas()))
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.DB_REPLICA_CHECK_INTERVAL_SECONDS)
+            await asyncio.gather(*(replica.check() for replica in get_replicas()))
+
+
+replica_monitor = ReplicaMonitor()
+
+
+async def dispose_engine():
+    global _engine, _replicas
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = None
+    if _replicas is not None:
+        await asyncio.gather(*(replica.engine.dispose() for replica in _replicas))
+        _replicas = None
+
+
+# users whose reads go to the primary because they wrote a moment ago (in any worker), not bounded by size:
+# a writer evicted before the lag window is over would read from a replica that may miss the write
+_recent_writers = create_cache('recent_writers', None, settings.DB_REPLICA_MAX_LAG_SECONDS)
+_primary_reads: ContextVar[bool] = ContextVar('primary_reads', default=False)
+
+
+class RoutingSession(Session):
+    """
+    Sends the statements of read-only CRUD functions to a healthy replica (one per session) and everything else
+    to the primary. Once the session writes, it stays on the primary so that it reads its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        primary = super().get_bind(mapper=mapper, clause=clause, **kwargs)
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['primary'] = self.info['written'] = True
+            return primary
+        if not self.info.get('read_only') or self.info.get('primary') or _primary_reads.get():
+            return primary
+        replica = self.info.get('replica')
+        if replica is None or not replica.healthy:
+            if (replica := _next_replica()) is None:
+                return primary
+            self.info['replica'] = replica
+        return replica.engine.sync_engine
+
+
+class RoutingAsyncSession(AsyncSession):
+    async def commit(self):
+        await super().commit()
+        # the user's next requests read from the primary until the replicas have caught up
+        if self.info.pop('written', False) and (user := self.info.get('user')) and get_replicas():
+            await _recent_writers.set(user, True)
+
+
+async def set_session_user(session: AsyncSession, email: str):
+    """Remember whose request the session serves, the user's reads stay on the primary for a while after a write"""
+    session.info['user'] = email
+    if get_replicas() and await _recent_writers.get(email):
+        session.info['primary'] = True
+
+
+def read_only(func):
+    """Mark a CRUD function which only reads, so that its statements can be served by a replica"""
+
+    @wraps(func)
+    async def wrapper(session: AsyncSession, *args, **kwargs):
+        outer = session.info.get('read_only', False)
+        session.info['read_only'] = True
+        try:
+            return await func(session, *args, **kwargs)
+        finally:
+            session.info['read_only'] = outer
+
+    return wrapper
 
 
 @contextmanager
-def get_db():
-    db = SessionLocal()
+def primary_reads(enabled: bool = True):
+    """Read from the primary inside the block (e.g. what is cached right after a write)"""
+    token = _primary_reads.set(enabled or _primary_reads.get())
     try:
-        yield db
+        yield
     finally:
-        db.close_all()
+        _primary_reads.reset(token)
+
+
+SessionLocal = async_sessionmaker(class_=RoutingAsyncSession, sync_session_class=RoutingSession,
+                                  autoflush=False, expire_on_commit=False)
+
+
+@asynccontextmanager
+async def get_db(read_only: bool = False) -> AsyncSession:
+    """Standalone session for work done outside of a request, read_only ones may read from a replica"""
+    async with SessionLocal(bind=get_engine(), info={'read_only': read_only}) as session:
+        yield session
+
+
+async def get_session() -> AsyncIterator[AsyncSession]:
+    """Unit-of-work session shared by every CRUD call made while handling a request"""
+    async with SessionLocal(bind=get_engine()) as session:
+        yield session
+
+
+def _pool_statistics(engine: AsyncEngine) -> dict:
+    pool = engine.sync_engine.pool
+    statistics = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        statistics.update(size=pool.size(), checked_in=pool.checkedin(),
+                          checked_out=pool.checkedout(), overflow=max(pool.overflow(), 0))
+    if isinstance(pool, InstrumentedQueuePool):
+        statistics.update(pool.wait_statistics.as_dict())
+    return statistics
+
+
+def get_pool_statistics() -> dict:
+    statistics = _pool_statistics(get_engine())
+    if replicas := get_replicas():
+        statistics['replicas'] = [dict(_pool_statistics(replica.engine), host=replica.url.host,
+                                       database=replica.url.database, healthy=replica.healthy,
+                                       lag_seconds=replica.lag) for replica in replicas]
+    return statistics
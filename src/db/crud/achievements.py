@@ -0,0 +1,84 @@
+from collections import defaultdict
+from typing import Iterable
+
+from sqlalchemy import Row, select, insert, update, func, literal
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.connector import read_only
+from db.crud.bulk import add_amounts, insert_ignoring_conflicts
+from db.models import Achievement, UserAchievement, UserCounter
+
+
+async def _update_counters(session: AsyncSession, amounts: dict[tuple[str, str], int]) -> dict[tuple[str, str], int]:
+    by_counter = defaultdict(dict)
+    for (email, name), amount in amounts.items():
+        by_counter[name][email] = amount
+    totals = {}
+    for name, user_amounts in by_counter.items():
+        rows = await session.execute(update(UserCounter).filter(
+            (UserCounter.name == name) & UserCounter.user_email.in_(list(user_amounts))).values(
+            value=add_amounts(UserCounter.value, UserCounter.user_email, user_amounts)).returning(
+            UserCounter.user_email, UserCounter.value))
+        totals.update(((email, name), value) for email, value in rows)
+    return totals
+
+
+async def add_to_counters(session: AsyncSession, amounts: dict[tuple[str, str], int]) -> dict[tuple[str, str], int]:
+    """
+    Add amounts to the (user email, counter name) counters, returns their new values.
+    One UPDATE per counter name and one INSERT of the missing counters: unlike `ON CONFLICT` upserts, plain
+    statements are statement-cached, and this runs on every submit and check.
+    """
+    totals = await _update_counters(session, amounts)
+    if not (missing := {key: amount for key, amount in amounts.items() if key not in totals}):
+        return totals
+    try:
+        async with session.begin_nested():
+            await session.execute(insert(UserCounter), [dict(user_email=email, name=name, value=amount)
+                                                        for (email, name), amount in missing.items()])
+    except IntegrityError:
+        # a concurrent first event of the user created some of the counters, they are updated instead
+        totals |= await _update_counters(session, missing)
+        if missing.keys() - totals.keys():
+            raise
+        return totals
+    return totals | missing
+
+
+async def award_achievements(session: AsyncSession, awards: Iterable[tuple[str, int]]):
+    """Award (user email, achievement id) pairs with one statement, achievements a user already has are skipped"""
+    if rows := [dict(user_email=email, achievement_id=achievement_id) for email, achievement_id in awards]:
+        await session.execute(insert_ignoring_conflicts(session, UserAchievement).values(rows))
+        await session.commit()
+
+
+async def add_achievements(session: AsyncSession, achievements: Iterable[dict]):
+    """
+    Add the achievements whose code is not in the catalogue yet, and award each new one to the users whose
+    counter already reaches its threshold (an indexed range of counters, users and responses are not scanned)
+    """
+    if not (rows := list(achievements)):
+        return
+    added = (await session.execute(insert_ignoring_conflicts(session, Achievement).values(rows).returning(
+        Achievement.id, Achievement.counter, Achievement.threshold))).all()
+    for achievement_id, counter, threshold in added:
+        await session.execute(insert_ignoring_conflicts(session, UserAchievement).from_select(
+            ['user_email', 'achievement_id', 'awarded_at'],
+            select(UserCounter.user_email, literal(achievement_id), func.now()).filter(
+                (UserCounter.name == counter) & (UserCounter.value >= threshold))))
+    await session.commit()
+
+
+async def get_achievement_rules(session: AsyncSession) -> list[Row]:
+    """(id, counter, threshold) of every achievement awarded by a rule"""
+    return (await session.execute(select(Achievement.id, Achievement.counter, Achievement.threshold).filter(
+        Achievement.counter.is_not(None) & Achievement.threshold.is_not(None)))).all()
+
+
+@read_only
+async def get_user_achievements(session: AsyncSession, email: str) -> list[Row]:
+    return (await session.execute(select(
+        Achievement.id, Achievement.code, Achievement.name, Achievement.description, UserAchievement.awarded_at).join(
+        UserAchievement, UserAchievement.achievement_id == Achievement.id).filter(
+        UserAchievement.user_email == email).order_by(UserAchievement.awarded_at, UserAchievement.id))).all()
@@ -0,0 +1,32 @@
+from typing import Iterable
+
+from sqlalchemy import case, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+def unique_ids(ids: Iterable[int]) -> list[int]:
+    # keeps the request order
+    return list(dict.fromkeys(ids))
+
+
+def insert_ignoring_conflicts(session: AsyncSession, model):
+    """`INSERT ... ON CONFLICT DO NOTHING` for the session database (skipped rows are not returned)"""
+    insert = postgresql.insert if session.get_bind().dialect.name == 'postgresql' else sqlite.insert
+    return insert(model).on_conflict_do_nothing()
+
+
+def add_amounts(column, key_column, amounts: dict):
+    # `column + <amount of the row key>` so all rows are incremented by a single UPDATE
+    return column + case(amounts, value=key_column, else_=0)
+
+
+async def bulk_failures(session: AsyncSession, model, ids: list[int], processed: Iterable[int],
+                        name: str, state: str) -> dict[int, str]:
+    """Explain why ids were not processed: the row does not exist or was already processed"""
+    processed = set(processed)
+    if not (rest := [element_id for element_id in ids if element_id not in processed]):
+        return {}
+    existing = set(await session.scalars(select(model.id).filter(model.id.in_(rest))))
+    return {element_id: '{} with id={} is already {}'.format(name, element_id, state) if element_id in existing
+            else '{} with id={} not found'.format(name, element_id) for element_id in rest}
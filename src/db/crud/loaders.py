@@ -0,0 +1,30 @@
+from typing import Any, Iterable
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import InstrumentedAttribute
+
+from db.models import User, Shift
+
+# keeps IN (...) lists below the bound parameter limits of sqlite and postgres
+MAX_KEYS_PER_QUERY = 900
+
+
+async def load_by_key(session: AsyncSession, key_column: InstrumentedAttribute, keys: Iterable[Any]) -> dict[Any, Any]:
+    """Load all entities whose key_column is in keys with one query per chunk of keys, mapped by key"""
+    model = key_column.class_
+    unique_keys = list(dict.fromkeys(key for key in keys if key is not None))
+    loaded = {}
+    for offset in range(0, len(unique_keys), MAX_KEYS_PER_QUERY):
+        chunk = unique_keys[offset:offset + MAX_KEYS_PER_QUERY]
+        for entity in await session.scalars(select(model).where(key_column.in_(chunk))):
+            loaded[getattr(entity, key_column.key)] = entity
+    return loaded
+
+
+async def load_users_by_email(session: AsyncSession, emails: Iterable[str]) -> dict[str, User]:
+    return await load_by_key(session, User.email, emails)
+
+
+async def load_shifts_by_id(session: AsyncSession, shift_ids: Iterable[int]) -> dict[int, Shift]:
+    return await load_by_key(session, Shift.id, shift_ids)
@@ -1,33 +1,52 @@
-from db.connector import get_db
+from datetime import datetime
+
+from pydantic import BaseModel
+from sqlalchemy import select, delete, desc
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.connector import read_only
+from db.crud.pagination import Page, paginate
 from db.models import News
 from exceptions import DatabaseElementNotFoundError
+from http_cache import collection_versions
+
 
+async def add_news(session: AsyncSession, title: str, content: str):
+    news = News(title=title, content=content)
+    session.add(news)
+    await session.commit()
+    await session.refresh(news)
+    await collection_versions.bump('news')
 
-def add_news(title: str, content: str):
-    with get_db() as session:
-        news = News(title=title, content=content)
-        session.add(news)
-        session.commit()
-        session.refresh(news)
+
+@read_only
+async def get_news_by_id(session: AsyncSession, news_id: int) -> News | None:
+    if not (news := await session.scalar(select(News).filter_by(id=news_id))):
+        raise DatabaseElementNotFoundError('News with id={} not found'.format(news_id))
+    return news
 
 
-def get_news_by_id(news_id: int) -> News | None:
-    with get_db() as session:
-        if not (news := session.query(News).filter_by(id=news_id).first()):
-            raise DatabaseElementNotFoundError('News with id={} not found'.format(news_id))
-        return news
+NEWS_ORDERINGS = {
+    'created_at': (News.created_at, News.id),
+    '-created_at': (desc(News.created_at), desc(News.id)),
+}
 
 
-def get_news() -> list[News]:
-    with get_db() as session:
-        return session.query(News).all()
+@read_only
+async def get_news(session: AsyncSession, limit: int | None = None, cursor: str | None = None,
+                   with_total: bool = False, ordering: str = '-created_at',
+                   created_from: datetime | None = None, created_to: datetime | None = None,
+                   schema: type[BaseModel] | None = None) -> Page[News]:
+    query = select(News)
+    if created_from is not None:
+        query = query.where(News.created_at >= created_from)
+    if created_to is not None:
+        query = query.where(News.created_at < created_to)
+    return await paginate(session, query, NEWS_ORDERINGS[ordering], limit, cursor, with_total, schema)
 
 
-def remove_news(news_id: int):
-    # check if news with given id in db
-    if not get_news_by_id(news_id):
+async def remove_news(session: AsyncSession, news_id: int):
+    if not (await session.execute(delete(News).filter_by(id=news_id).returning(News.id))).first():
         raise DatabaseElementNotFoundError('News with id={} not found'.format(news_id))
-    # remove
-    with get_db() as session:
-        session.query(News).filter_by(id=news_id).delete()
-        session.commit()
+    await session.commit()
+    await collection_versions.bump('news')
@@ -0,0 +1,101 @@
+import base64
+import json
+from datetime import datetime
+from typing import Generic, TypeVar, Sequence
+
+from pydantic import BaseModel
+from sqlalchemy import Select, and_, or_, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression, ColumnElement
+
+from db.crud.readonly import record_select
+from exceptions import InvalidCursorError
+
+T = TypeVar('T')
+
+
+class Page(Generic[T]):
+    """One page of a keyset-paginated listing"""
+
+    def __init__(self, items: list[T], next_cursor: str | None = None, total: int | None = None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.total = total
+
+
+def _sort_keys(order_by: Sequence[ColumnElement]) -> list[tuple[ColumnElement, bool]]:
+    # split `desc(column)` / `column` ordering into (column, descending) pairs
+    keys = []
+    for expression in order_by:
+        if isinstance(expression, UnaryExpression) and expression.modifier in (operators.desc_op, operators.asc_op):
+            keys.append((expression.element, expression.modifier is operators.desc_op))
+        else:
+            keys.append((expression, False))
+    return keys
+
+
+def _ordering_signature(keys: list[tuple[ColumnElement, bool]]) -> str:
+    return ','.join(('-' if descending else '') + column.key for column, descending in keys)
+
+
+def encode_cursor(keys: list[tuple[ColumnElement, bool]], values: Sequence) -> str:
+    payload = {'o': _ordering_signature(keys),
+               'v': [value.isoformat() if isinstance(value, datetime) else value for value in values]}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(keys: list[tuple[ColumnElement, bool]], cursor: str) -> list:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if payload['o'] != _ordering_signature(keys) or len(payload['v']) != len(keys):
+            raise ValueError
+        values = []
+        for (column, _), value in zip(keys, payload['v']):
+            # custom column types (TypeDecorator) keep their python type on the wrapped implementation
+            if value is not None and getattr(column.type, 'impl', column.type).python_type is datetime:
+                value = datetime.fromisoformat(value)
+            values.append(value)
+        return values
+    except (ValueError, KeyError, TypeError):
+        raise InvalidCursorError('Invalid or outdated pagination cursor')
+
+
+def _after(keys: list[tuple[ColumnElement, bool]], values: list) -> ColumnElement:
+    # (k1, k2, ...) strictly after (v1, v2, ...) in the given mixed-direction ordering
+    clauses = []
+    for i, (column, descending) in enumerate(keys):
+        equal_prefix = [keys[j][0] == values[j] for j in range(i)]
+        clauses.append(and_(*equal_prefix, column < values[i] if descending else column > values[i]))
+    return or_(*clauses)
+
+
+async def paginate(session: AsyncSession, query: Select, order_by: Sequence[ColumnElement],
+                   limit: int | None = None, cursor: str | None = None, with_total: bool = False,
+                   schema: type[BaseModel] | None = None) -> Page:
+    """
+    Run `query` with keyset pagination.
+    `order_by` must end with a unique column (e.g. id) so that every row has a distinct position.
+    With `schema` only its columns are selected and the page holds read-only Row records instead of ORM instances.
+    """
+    keys = _sort_keys(order_by)
+    fetch = session.scalars
+    if schema is not None:
+        query, fetch = record_select(query, schema, order_by), session.execute
+    elif query.column_descriptions[0].get('entity') is None:
+        # plain column selects (e.g. over a subquery) are paged as Row records
+        fetch = session.execute
+    total = None
+    if with_total:
+        total = await session.scalar(select(func.count()).select_from(query.order_by(None).subquery()))
+    if cursor:
+        query = query.where(_after(keys, decode_cursor(keys, cursor)))
+    query = query.order_by(*order_by)
+    if limit is None:
+        return Page(list(await fetch(query)), total=total)
+    items = list(await fetch(query.limit(limit + 1)))
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(keys, [getattr(items[-1], column.key) for column, _ in keys])
+    return Page(items, next_cursor=next_cursor, total=total)
@@ -0,0 +1,35 @@
+from typing import AsyncIterator, Sequence
+
+from pydantic import BaseModel
+from sqlalchemy import Select, Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql.elements import ColumnElement, UnaryExpression
+
+# rows fetched per round trip when streaming
+DEFAULT_BATCH_SIZE = 1000
+
+
+def record_select(query: Select, schema: type[BaseModel], order_by: Sequence[ColumnElement] = ()) -> Select:
+    """
+    Narrow a select of one model to the plain table columns of the schema fields (plus the ordering columns).
+    The result rows are tuple-backed Row records: no ORM instances, identity map or attribute instrumentation.
+    """
+    table = query.column_descriptions[0]['entity'].__table__
+    ordering = (expression.element if isinstance(expression, UnaryExpression) else expression
+                for expression in order_by)
+    names = dict.fromkeys([*schema.__fields__, *(column.key for column in ordering)])
+    return query.with_only_columns(*(table.c[name] for name in names))
+
+
+async def stream_records(session: AsyncSession, query: Select, schema: type[BaseModel] | None = None,
+                         batch_size: int = DEFAULT_BATCH_SIZE) -> AsyncIterator[Row]:
+    """
+    Stream the records of a (possibly huge) select, keeping only one batch of rows in memory.
+    Without a schema the columns of the select are streamed as they are.
+    """
+    if schema is not None:
+        query = record_select(query, schema)
+    result = await session.stream(query.execution_options(yield_per=batch_size))
+    async for partition in result.partitions():
+        for record in partition:
+            yield record
@@ -0,0 +1,69 @@
+from dataclasses import dataclass
+
+from sqlalchemy import Float, Select, column, desc, func, literal, literal_column, select, union_all
+from sqlalchemy import table as table_clause
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.connector import read_only
+from db.crud.pagination import Page, paginate
+from db.models import News, Task
+
+# text search configuration of the postgres tsvector columns (no stemming, works for any language)
+SEARCH_CONFIG = 'simple'
+
+
+@dataclass(frozen=True)
+class SearchSource:
+    model: type
+    title: str
+    body: str
+
+    @property
+    def table(self) -> str:
+        return self.model.__tablename__
+
+    @property
+    def fts_table(self) -> str:
+        # sqlite FTS5 index of the table
+        return '{}_search'.format(self.table)
+
+
+SEARCH_SOURCES = {
+    'news': SearchSource(News, 'title', 'content'),
+    'tasks': SearchSource(Task, 'title', 'description'),
+}
+
+
+def _fts5_query(text: str) -> str:
+    # every word as a quoted phrase, so user input can never be an FTS5 syntax error
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+def _postgres_hits(kind: str, source: SearchSource, text: str) -> Select:
+    table = source.model.__table__
+    vector = literal_column('{}.search_vector'.format(source.table))
+    query = func.websearch_to_tsquery(SEARCH_CONFIG, text)
+    return select(literal(kind).label('kind'), table.c.id, table.c[source.title].label('title'),
+                  func.ts_rank_cd(vector, query, type_=Float).label('rank')).where(vector.op('@@')(query))
+
+
+def _sqlite_hits(kind: str, source: SearchSource, text: str) -> Select:
+    table = source.model.__table__
+    fts = table_clause(source.fts_table, column('rowid'))
+    fts_column = literal_column(source.fts_table)
+    # bm25 is lower for better matches, title matches weigh more than body matches
+    return select(literal(kind).label('kind'), table.c.id, table.c[source.title].label('title'),
+                  (-func.bm25(fts_column, 4.0, 1.0, type_=Float)).label('rank')).select_from(
+        table.join(fts, fts.c.rowid == table.c.id)).where(fts_column.op('MATCH')(_fts5_query(text)))
+
+
+@read_only
+async def search(session: AsyncSession, text: str, kinds: list[str] | None = None, limit: int | None = None,
+                 cursor: str | None = None, with_total: bool = False) -> Page:
+    """Ranked full-text search over the title and body of news and tasks"""
+    if not text.split():
+        return Page([], total=0 if with_total else None)
+    hits = _postgres_hits if session.get_bind().dialect.name == 'postgresql' else _sqlite_hits
+    hits = union_all(*(hits(kind, SEARCH_SOURCES[kind], text) for kind in kinds or SEARCH_SOURCES)).subquery('hits')
+    return await paginate(session, select(hits), (desc(hits.c.rank), hits.c.kind, hits.c.id), limit, cursor,
+                          with_total)
@@ -1,117 +1,229 @@
+from collections import Counter
 from datetime import datetime
+from typing import AsyncIterator
 
 import pytz
-
-from db.connector import get_db
-from db.crud.users import get_user_by_email
+from sqlalchemy import Boolean, Row, select, insert, update, delete, desc, exists, func, literal, true
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from db.connector import read_only
+from db.crud.bulk import unique_ids, add_amounts, bulk_failures
+from db.crud.loaders import load_users_by_email, load_shifts_by_id
+from db.crud.pagination import Page, paginate
+from db.crud.readonly import stream_records
+from db.crud.time_window import time_window_predicate
 from db.models import Shift, ShiftReservation, User
-from exceptions import DatabaseElementNotFoundError
+from exceptions import DatabaseElementNotFoundError, DatabaseElementConflictError
+from http_cache import collection_versions
 from shifts.schemas import ShiftReservation as ShiftReservationAPI, ShiftInfo as ShiftInfoAPI
+from user.achievements import achievement_engine, shift_reservations_approved
 from user.schemas import UserInfo as UserInfoAPI
 from utils import convert_sqlalchemy_row_to_dict
 
 
-def check_shift_exist_decorator(func):
-    def wrapper(shift_id: int, *args, **kwargs):
-        if not get_shift_by_id(shift_id):
-            raise DatabaseElementNotFoundError('shift with id={} not found'.format(shift_id))
-        return func(shift_id=shift_id, *args, **kwargs)
-
-    return wrapper
-
-
-def get_shift_by_id(shift_id: int) -> Shift | None:
-    with get_db() as session:
-        if not (shift := session.query(Shift).filter(Shift.id == shift_id).first()):
-            raise DatabaseElementNotFoundError('Shift with id={} not found'.format(shift_id))
-        return shift
+@read_only
+async def get_shift_by_id(session: AsyncSession, shift_id: int) -> Shift | None:
+    if not (shift := await session.scalar(select(Shift).filter(Shift.id == shift_id))):
+        raise DatabaseElementNotFoundError('Shift with id={} not found'.format(shift_id))
+    return shift
 
 
-def add_shift(name: str, start_date: datetime, end_date: datetime, **kwargs):
+async def add_shift(session: AsyncSession, name: str, start_date: datetime, end_date: datetime, **kwargs):
     # validate datetime
     if start_date > end_date:
         raise ValueError('Start date must be before end date')
     if datetime.now(pytz.utc) > end_date:
         raise ValueError('End date must be in the future')
-    with get_db() as session:
-        shift = Shift(name=name, start_date=start_date, end_date=end_date, **kwargs)
-        session.add(shift)
-        session.commit()
-        session.refresh(shift)
-
-
-def get_all_shifts() -> list[Shift]:
-    with get_db() as session:
-        return session.query(Shift).all()
-
-
-def get_user_shifts_by_email(email: str) -> list[Shift]:
-    with get_db() as session:
-        # get user id
-        user = get_user_by_email(email)
-        # extract all shift reservations ids
-        shift_reservations_ids = [_.shift_id for _ in session.query(ShiftReservation).filter(
-            (ShiftReservation.user_email == user.email) & (ShiftReservation.is_approved == True)).all()]
-        # extract info about each shift
-        shifts = session.query(Shift).filter(Shift.id.in_(shift_reservations_ids)).all()
-        return shifts
-
-
-@check_shift_exist_decorator
-def reserve_shift(shift_id: int, user_email: str):
-    with get_db() as session:
-        user = session.query(User).filter_by(email=user_email).first()
-        shift = session.query(Shift).filter_by(id=shift_id).first()
-        user.shifts.append(shift)
-        session.commit()
-
-
-def get_shift_reservation_by_id(shift_reservation_id: int) -> ShiftReservation | None:
-    with get_db() as session:
-        if not (shifts_reservations := session.query(ShiftReservation).filter(
-                ShiftReservation.id == shift_reservation_id).first()):
-            raise DatabaseElementNotFoundError('Shift reservation with id={} not found'.format(shift_reservation_id))
-        return shifts_reservations
-
-
-def check_shift_reservation_exist_decorator(func):
-    def wrapper(shift_reservation_id: int, *args, **kwargs):
-        if not get_shift_reservation_by_id(shift_reservation_id):
-            raise DatabaseElementNotFoundError('Shift reservation with id={} not found'.format(shift_reservation_id))
-        return func(shift_reservation_id=shift_reservation_id, *args, **kwargs)
-
-    return wrapper
-
-
-@check_shift_reservation_exist_decorator
-def approve_shift_reservation(shift_reservation_id: int):
-    with get_db() as session:
-        # update approve status
-        session.query(ShiftReservation).filter_by(id=shift_reservation_id).update({'is_approved': True})
-        # update shift participant count
-        shift_id = session.query(ShiftReservation).filter_by(id=shift_reservation_id).first().shift_id
-        session.query(Shift).filter_by(id=shift_id).update({'participants_number': Shift.participants_number + 1})
-        session.commit()
-
-
-def get_shifts_reservations() -> list[ShiftReservationAPI]:
-    with get_db() as session:
-        # update shift participant count
-        result = []
-        shifts_reservations = session.query(ShiftReservation).filter_by(is_approved=False).all()
-        for reservation in shifts_reservations:
-            user_info = get_user_by_email(reservation.user_email)
-            shift_info = get_shift_by_id(reservation.shift_id)
-            result.append(ShiftReservationAPI(id=reservation.id,
-                                              is_approved=reservation.is_approved,
-                                              user_info=UserInfoAPI(**convert_sqlalchemy_row_to_dict(user_info)),
-                                              shift_info=ShiftInfoAPI(**convert_sqlalchemy_row_to_dict(shift_info))))
-
-        return result
-
-
-@check_shift_exist_decorator
-def remove_shift(shift_id: int):
-    with get_db() as session:
-        session.query(Shift).filter_by(id=shift_id).delete()
-        session.commit()
+    shift = Shift(name=name, start_date=start_date, end_date=end_date, **kwargs)
+    session.add(shift)
+    await session.commit()
+    await session.refresh(shift)
+    await collection_versions.bump('shifts')
+
+
+SHIFT_ORDERINGS = {
+    'start_date': (Shift.start_date, Shift.id),
+    '-start_date': (desc(Shift.start_date), desc(Shift.id)),
+}
+
+
+@read_only
+async def get_shifts_in_window(session: AsyncSession, window: str, start: datetime | None = None,
+                               end: datetime | None = None, limit: int | None = None, cursor: str | None = None,
+                               with_total: bool = False, ordering: str = 'start_date') -> Page[Shift]:
+    query = select(Shift).where(time_window_predicate(Shift.start_date, Shift.end_date, window, start, end))
+    return await paginate(session, query, SHIFT_ORDERINGS[ordering], limit, cursor, with_total)
+
+
+@read_only
+async def get_upcoming_shifts(session: AsyncSession, **kwargs) -> Page[Shift]:
+    return await get_shifts_in_window(session, 'upcoming', **kwargs)
+
+
+@read_only
+async def get_user_shifts_by_email(session: AsyncSession, email: str) -> list[Shift]:
+    # shifts with an approved reservation of the user
+    return list(await session.scalars(
+        select(Shift).join(ShiftReservation, ShiftReservation.shift_id == Shift.id).filter(
+            (ShiftReservation.user_email == email) & (ShiftReservation.is_approved == True)).distinct().order_by(
+            Shift.start_date, Shift.id)))
+
+
+def _admit(shift_id: int):
+    # takes a place only while the shift has one left, the row lock of the UPDATE serializes concurrent admissions
+    return update(Shift).filter((Shift.id == shift_id) & (
+            Shift.capacity.is_(None) | (Shift.reserved_number < Shift.capacity))).values(
+        reserved_number=Shift.reserved_number + 1).returning(Shift.id)
+
+
+async def _promote_waitlist(session: AsyncSession, shift_id: int):
+    """Admit waitlisted reservations of the shift, oldest first, while it has free places"""
+    waiting = aliased(ShiftReservation)
+    head = select(waiting.id).filter((waiting.shift_id == shift_id) & (waiting.is_waitlisted == True)).order_by(
+        waiting.id).limit(1).scalar_subquery()
+    while (await session.execute(_admit(shift_id).filter(head.is_not(None)))).first():
+        await session.execute(update(ShiftReservation).filter(ShiftReservation.id == head).values(is_waitlisted=False))
+
+
+async def reserve_shift(session: AsyncSession, shift_id: int, user_email: str) -> int | None:
+    """Reserve a place on the shift, returns the waitlist position when the shift is full"""
+    admitted = (await session.execute(_admit(shift_id))).first() is not None
+    # inserts nothing when the shift (or user) does not exist or the camper has already reserved it
+    reserved = aliased(ShiftReservation)
+    try:
+        reservation_id = await session.scalar(insert(ShiftReservation).from_select(
+            ['user_email', 'shift_id', 'is_waitlisted'],
+            select(User.email, Shift.id, literal(not admitted, Boolean)).join_from(User, Shift, true()).filter(
+                (User.email == user_email) & (Shift.id == shift_id) &
+                ~exists().where((reserved.shift_id == Shift.id) & (reserved.user_email == User.email)))).returning(
+            ShiftReservation.id))
+    except IntegrityError:
+        # a concurrent request of the same camper got in first (unique index)
+        reservation_id = None
+    if reservation_id is None:
+        # gives the place back
+        await session.rollback()
+        if await session.scalar(select(ShiftReservation.id).filter_by(shift_id=shift_id, user_email=user_email)):
+            raise DatabaseElementConflictError('Shift with id={} is already reserved'.format(shift_id))
+        raise DatabaseElementNotFoundError('Shift with id={} not found'.format(shift_id))
+    position = None
+    if not admitted:
+        # a place freed by a cancellation that has not seen this reservation yet
+        await _promote_waitlist(session, shift_id)
+        # none ahead when this reservation has just been promoted (promotion goes in id order)
+        position = await session.scalar(select(func.count()).select_from(ShiftReservation).filter(
+            (ShiftReservation.shift_id == shift_id) & (ShiftReservation.is_waitlisted == True) &
+            (ShiftReservation.id <= reservation_id))) or None
+    await session.commit()
+    await collection_versions.bump('shifts')
+    return position
+
+
+async def cancel_shift_reservation(session: AsyncSession, shift_id: int, user_email: str):
+    if not (reservation := (await session.execute(delete(ShiftReservation).filter_by(
+            shift_id=shift_id, user_email=user_email).returning(
+            ShiftReservation.is_waitlisted, ShiftReservation.is_approved))).first()):
+        raise DatabaseElementNotFoundError('Reservation of shift with id={} not found'.format(shift_id))
+    if not reservation.is_waitlisted:
+        # the freed place goes to the head of the waitlist
+        await session.execute(update(Shift).filter_by(id=shift_id).values(
+            reserved_number=Shift.reserved_number - 1,
+            participants_number=Shift.participants_number - (1 if reservation.is_approved else 0)))
+        await _promote_waitlist(session, shift_id)
+    await session.commit()
+    await collection_versions.bump('shifts')
+
+
+@read_only
+async def get_shift_reservation_by_id(session: AsyncSession, shift_reservation_id: int) -> ShiftReservation | None:
+    if not (shifts_reservations := await session.scalar(select(ShiftReservation).filter(
+            ShiftReservation.id == shift_reservation_id))):
+        raise DatabaseElementNotFoundError('Shift reservation with id={} not found'.format(shift_reservation_id))
+    return shifts_reservations
+
+
+async def approve_shift_reservation(session: AsyncSession, shift_reservation_id: int):
+    # only admitted reservations waiting for approval, so participants are never counted twice
+    if not (reservation := (await session.execute(update(ShiftReservation).filter(
+            (ShiftReservation.id == shift_reservation_id) & (ShiftReservation.is_approved == False) &
+            (ShiftReservation.is_waitlisted == False)).values(is_approved=True).returning(
+            ShiftReservation.shift_id, ShiftReservation.user_email))).first()):
+        raise DatabaseElementNotFoundError(
+            'Shift reservation with id={} not found or not waiting for approval'.format(shift_reservation_id))
+    # update shift participant count
+    await session.execute(update(Shift).filter_by(id=reservation.shift_id).values(
+        participants_number=Shift.participants_number + 1))
+    await achievement_engine.record(session, shift_reservations_approved([reservation.user_email]))
+    await session.commit()
+    await collection_versions.bump('shifts')
+    await achievement_engine.award(session)
+
+
+async def approve_shift_reservations(session: AsyncSession, shift_reservation_ids: list[int]) -> dict[int, str]:
+    """Approve reservations in one transaction, returns the reason for every id that was not approved"""
+    ids = unique_ids(shift_reservation_ids)
+    # reservations approved before are skipped so participants are not counted twice
+    approved = (await session.execute(update(ShiftReservation).filter(
+        ShiftReservation.id.in_(ids) & (ShiftReservation.is_approved == False) &
+        (ShiftReservation.is_waitlisted == False)).values(
+        is_approved=True).returning(ShiftReservation.id, ShiftReservation.shift_id, ShiftReservation.user_email))).all()
+    # one aggregated increment per shift
+    if participants := Counter(shift_id for _, shift_id, _ in approved):
+        await session.execute(update(Shift).filter(Shift.id.in_(list(participants))).values(
+            participants_number=add_amounts(Shift.participants_number, Shift.id, participants)))
+        await achievement_engine.record(session, shift_reservations_approved(
+            user_email for _, _, user_email in approved))
+    failures = await bulk_failures(session, ShiftReservation, ids,
+                                   (reservation_id for reservation_id, _, _ in approved),
+                                   'Shift reservation', 'approved or on the waitlist')
+    await session.commit()
+    if approved:
+        await collection_versions.bump('shifts')
+        await achievement_engine.award(session)
+    return failures
+
+
+@read_only
+async def get_shifts_reservations(session: AsyncSession) -> list[ShiftReservationAPI]:
+    shifts_reservations = list(await session.scalars(
+        select(ShiftReservation).filter_by(is_approved=False, is_waitlisted=False).order_by(ShiftReservation.id)))
+    # resolve users and shifts of all reservations at once (many reservations share the same shift)
+    users = await load_users_by_email(session, (reservation.user_email for reservation in shifts_reservations))
+    shifts = await load_shifts_by_id(session, (reservation.shift_id for reservation in shifts_reservations))
+    # converted once per user/shift instead of once per reservation
+    users_info = {email: UserInfoAPI(**convert_sqlalchemy_row_to_dict(user)) for email, user in users.items()}
+    shifts_info = {shift_id: ShiftInfoAPI(**convert_sqlalchemy_row_to_dict(shift))
+                   for shift_id, shift in shifts.items()}
+    return [ShiftReservationAPI(id=reservation.id,
+                                is_approved=reservation.is_approved,
+                                is_waitlisted=reservation.is_waitlisted,
+                                user_info=users_info[reservation.user_email],
+                                shift_info=shifts_info[reservation.shift_id])
+            for reservation in shifts_reservations]
+
+
+async def remove_shift(session: AsyncSession, shift_id: int):
+    if not (await session.execute(delete(Shift).filter_by(id=shift_id).returning(Shift.id))).first():
+        raise DatabaseElementNotFoundError('Shift with id={} not found'.format(shift_id))
+    await session.commit()
+    await collection_versions.bump('shifts')
+
+
+def export_shifts_reservations(session: AsyncSession, is_approved: bool | None = None,
+                               is_waitlisted: bool | None = None, shift_id: int | None = None) -> AsyncIterator[Row]:
+    # flat rows: reservation with the columns of its user and shift
+    query = select(ShiftReservation.id, ShiftReservation.is_approved, ShiftReservation.is_waitlisted,
+                   ShiftReservation.created_at,
+                   ShiftReservation.user_email, User.username, User.first_name, User.last_name,
+                   ShiftReservation.shift_id, Shift.name.label('shift_name'),
+                   Shift.start_date.label('shift_start_date'), Shift.end_date.label('shift_end_date')).join(
+        User, User.email == ShiftReservation.user_email).join(Shift, Shift.id == ShiftReservation.shift_id)
+    if is_approved is not None:
+        query = query.filter(ShiftReservation.is_approved == is_approved)
+    if is_waitlisted is not None:
+        query = query.filter(ShiftReservation.is_waitlisted == is_waitlisted)
+    if shift_id is not None:
+        query = query.filter(ShiftReservation.shift_id == shift_id)
+    return stream_records(session, query.order_by(ShiftReservation.id))
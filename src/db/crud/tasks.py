@@ -1,159 +1,266 @@
+from collections import defaultdict
 from datetime import datetime
+from typing import AsyncIterator
 
 import pytz as pytz
-from sqlalchemy import and_
-from sqlalchemy.exc import NoResultFound
-
-from db.connector import get_db
-from db.crud.users import check_user_exist_decorator
+from pydantic import BaseModel
+from sqlalchemy import Row, select, insert, update, delete, desc, exists, literal, true
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from auth.cache import invalidate_user
+from db.connector import read_only
+from db.crud.bulk import unique_ids, add_amounts, bulk_failures
+from db.crud.pagination import Page, paginate
+from db.crud.readonly import stream_records
+from db.crud.time_window import time_window_predicate
 from db.models import Task, TaskResponse, User
-from exceptions import DatabaseElementNotFoundError
-
-
-def check_task_exist_decorator(func):
-    def wrapper(task_id: int, *args, **kwargs):
-        if not get_task_by_id(task_id):
-            raise DatabaseElementNotFoundError('Task with id={} not found'.format(task_id))
-        return func(task_id, *args, **kwargs)
-
-    return wrapper
-
-
-def check_task_response_exist_decorator(func):
-    def wrapper(task_response_id: int, *args, **kwargs):
-        if not get_task_response_by_id(task_response_id):
-            raise DatabaseElementNotFoundError('Task with id={} not found'.format(task_response_id))
-        return func(task_response_id, *args, **kwargs)
+from exceptions import DatabaseElementNotFoundError, DatabaseElementConflictError
+from http_cache import collection_versions
+from tasks.scheduler import task_scheduler
+from user.achievements import achievement_engine, task_submitted, tasks_checked
+from user.leaderboard import leaderboard
 
-    return wrapper
 
-
-def add_task(start_date: datetime, end_date: datetime, **kwargs):
+async def add_task(session: AsyncSession, start_date: datetime, end_date: datetime, **kwargs):
     # validate datetime and check if task already start
     if start_date > end_date:
         raise ValueError('Start date must be before end date')
     if datetime.now(pytz.utc) > end_date:
         raise ValueError('End date must be in the future')
     is_active = True if start_date < datetime.now(pytz.utc) < end_date else False
-    with get_db() as session:
-        task = Task(start_date=start_date, end_date=end_date, is_active=is_active, **kwargs)
-        session.add(task)
-        session.commit()
-        session.refresh(task)
-
-
-def get_task_by_id(task_id: int) -> Task | None:
-    with get_db() as session:
-        if not (task := session.query(Task).filter_by(id=task_id).first()):
-            raise DatabaseElementNotFoundError('Task with id={} not found'.format(task_id))
-        return task
-
-
-def get_all_tasks() -> list[Task]:
-    with get_db() as session:
-        return session.query(Task).all()
-
-
-def get_all_active_tasks() -> list[Task]:
-    # get all tasks and check if they are active
-    with get_db() as session:
-        for task in get_all_tasks():
-            if task.start_date < datetime.now(pytz.utc) < task.end_date:
-                session.query(Task).filter_by(id=task.id).update({'is_active': True})
-            else:
-                session.query(Task).filter_by(id=task.id).update({'is_active': False})
-        session.commit()
-        return session.query(Task).filter_by(is_active=True).all()
+    task = Task(start_date=start_date, end_date=end_date, is_active=is_active, **kwargs)
+    session.add(task)
+    await session.commit()
+    await session.refresh(task)
+    task_scheduler.schedule(task.id, task.start_date, task.end_date)
+    await collection_versions.bump('tasks')
+
+
+@read_only
+async def get_task_by_id(session: AsyncSession, task_id: int) -> Task | None:
+    if not (task := await session.scalar(select(Task).filter_by(id=task_id))):
+        raise DatabaseElementNotFoundError('Task with id={} not found'.format(task_id))
+    return task
+
+
+TASK_ORDERINGS = {
+    'start_date': (Task.start_date, Task.id),
+    '-start_date': (desc(Task.start_date), desc(Task.id)),
+    'end_date': (Task.end_date, Task.id),
+    '-end_date': (desc(Task.end_date), desc(Task.id)),
+}
+TASK_RESPONSE_ORDERINGS = {
+    'response_time': (TaskResponse.response_time, TaskResponse.id),
+    '-response_time': (desc(TaskResponse.response_time), desc(TaskResponse.id)),
+}
+
+
+@read_only
+async def get_all_tasks(session: AsyncSession, limit: int | None = None, cursor: str | None = None,
+                        with_total: bool = False, ordering: str = 'start_date',
+                        is_active: bool | None = None, author_email: str | None = None,
+                        schema: type[BaseModel] | None = None) -> Page[Task]:
+    query = select(Task)
+    if is_active is not None:
+        query = query.filter_by(is_active=is_active)
+    if author_email is not None:
+        query = query.filter_by(author_email=author_email)
+    return await paginate(session, query, TASK_ORDERINGS[ordering], limit, cursor, with_total, schema)
+
+
+@read_only
+async def get_tasks_in_window(session: AsyncSession, window: str, start: datetime | None = None,
+                              end: datetime | None = None, limit: int | None = None, cursor: str | None = None,
+                              with_total: bool = False, ordering: str = 'start_date') -> Page[Task]:
+    query = select(Task).where(time_window_predicate(Task.start_date, Task.end_date, window, start, end))
+    return await paginate(session, query, TASK_ORDERINGS[ordering], limit, cursor, with_total)
+
+
+@read_only
+async def get_all_active_tasks(session: AsyncSession, limit: int | None = None, cursor: str | None = None,
+                               with_total: bool = False, ordering: str = 'start_date') -> Page[Task]:
+    # is_active is kept up to date by the task scheduler
+    return await paginate(session, select(Task).filter_by(is_active=True), TASK_ORDERINGS[ordering],
+                          limit, cursor, with_total)
+
+
+@read_only
+async def get_user_tasks_by_email(session: AsyncSession, email: str) -> list[Task]:
+    # get user tasks which are currently running
+    return list(await session.scalars(
+        select(Task).join(TaskResponse, TaskResponse.task_id == Task.id)
+        .filter(TaskResponse.user_email == email,
+                time_window_predicate(Task.start_date, Task.end_date, 'ongoing'))
+        .distinct().order_by(Task.start_date, Task.id)))
+
+
+async def _insert_task_response(session: AsyncSession, task_id: int, user_filter, **values) -> int | None:
+    # inserts nothing when the task (or user) does not exist or the user has already responded to it
+    responded = aliased(TaskResponse)
+    try:
+        async with session.begin_nested():
+            return await session.scalar(insert(TaskResponse).from_select(
+                ['user_email', 'task_id', *values],
+                select(User.email, Task.id, *map(literal, values.values())).join_from(User, Task, true()).filter(
+                    user_filter & (Task.id == task_id) &
+                    ~exists().where((responded.task_id == Task.id) & (responded.user_email == User.email)))).returning(
+                TaskResponse.id))
+    except IntegrityError:
+        # a concurrent request of the same user got in first (unique index)
+        return None
+
+
+async def response_to_task(session: AsyncSession, task_id: int, user_id: int):
+    if await _insert_task_response(session, task_id, User.id == user_id) is None:
+        if await session.scalar(select(TaskResponse.id).join(User, User.email == TaskResponse.user_email).filter(
+                (User.id == user_id) & (TaskResponse.task_id == task_id))):
+            raise DatabaseElementConflictError('Task with id={} is already responded'.format(task_id))
+        raise DatabaseElementNotFoundError('Task with id={} not found'.format(task_id))
+    await session.commit()
+
+
+@read_only
+async def get_task_response_by_id(session: AsyncSession, task_response_id: int) -> TaskResponse | None:
+    if not (task_response := await session.scalar(select(TaskResponse).filter_by(id=task_response_id))):
+        raise DatabaseElementNotFoundError('Task response with id={} not found'.format(task_response_id))
+    return task_response
 
 
-@check_user_exist_decorator
-def get_user_tasks_by_email(email: str) -> list[Task]:
-    with get_db() as session:
-        # get user id
-        user = session.query(User).filter_by(email=email).first()
-        return [task for task in user.tasks if task.is_active == True]
+def _filter_tasks_responses(query, task_id: int | None = None, user_email: str | None = None):
+    if task_id is not None:
+        query = query.filter_by(task_id=task_id)
+    if user_email is not None:
+        query = query.filter_by(user_email=user_email)
+    return query
 
 
-@check_task_exist_decorator
-def response_to_task(task_id: int, user_id: int):
-    with get_db() as session:
-        user = session.query(User).filter_by(id=user_id).first()
-        task = session.query(Task).filter_by(id=task_id).first()
-        user.tasks.append(task)
-        session.commit()
+# responses waiting for an admin, by review stage
+TASK_RESPONSE_STAGES = {
+    'for_approval': TaskResponse.is_approved == False,
+    'for_check': (TaskResponse.is_completed == True) & (TaskResponse.is_checked == False),
+}
 
 
-def get_task_response_by_id(task_response_id: int) -> TaskResponse | None:
-    with get_db() as session:
-        if not (task_response := session.query(TaskResponse).filter_by(id=task_response_id).first()):
-            raise DatabaseElementNotFoundError('Task response with id={} not found'.format(task_response_id))
-        return task_response
+@read_only
+async def get_all_not_approved_tasks_responses(session: AsyncSession, limit: int | None = None,
+                                               cursor: str | None = None, with_total: bool = False,
+                                               ordering: str = 'response_time', task_id: int | None = None,
+                                               user_email: str | None = None,
+                                               schema: type[BaseModel] | None = None) -> Page[TaskResponse]:
+    query = _filter_tasks_responses(select(TaskResponse).filter(TASK_RESPONSE_STAGES['for_approval']),
+                                    task_id, user_email)
+    return await paginate(session, query, TASK_RESPONSE_ORDERINGS[ordering], limit, cursor, with_total, schema)
 
 
-def get_all_not_approved_tasks_responses() -> list[TaskResponse]:
-    with get_db() as session:
-        return session.query(TaskResponse).filter_by(is_approved=False).all()
+@read_only
+async def get_all_not_checked_tasks_responses(session: AsyncSession, limit: int | None = None,
+                                              cursor: str | None = None, with_total: bool = False,
+                                              ordering: str = 'response_time', task_id: int | None = None,
+                                              user_email: str | None = None,
+                                              schema: type[BaseModel] | None = None) -> Page[TaskResponse]:
+    query = _filter_tasks_responses(select(TaskResponse).filter(TASK_RESPONSE_STAGES['for_check']),
+                                    task_id, user_email)
+    return await paginate(session, query, TASK_RESPONSE_ORDERINGS[ordering], limit, cursor, with_total, schema)
 
 
-def get_all_not_checked_tasks_responses() -> list[TaskResponse]:
-    with get_db() as session:
-        return session.query(TaskResponse).filter((TaskResponse.is_completed == True) &
-            (TaskResponse.is_checked == False)).all()
+def export_tasks_responses(session: AsyncSession, schema: type[BaseModel], stage: str,
+                           ordering: str = 'response_time', task_id: int | None = None,
+                           user_email: str | None = None) -> AsyncIterator[Row]:
+    query = _filter_tasks_responses(select(TaskResponse).filter(TASK_RESPONSE_STAGES[stage]), task_id, user_email)
+    return stream_records(session, query.order_by(*TASK_RESPONSE_ORDERINGS[ordering]), schema)
 
 
-@check_task_response_exist_decorator
-def approve_task_response(task_response_id: int):
-    try:
-        with get_db() as session:
-            # update approve status
-            session.query(TaskResponse).filter_by(id=task_response_id).update({'is_approved': True})
-            session.commit()
-    except NoResultFound:
+async def approve_task_response(session: AsyncSession, task_response_id: int):
+    if not (await session.execute(update(TaskResponse).filter_by(id=task_response_id).values(
+            is_approved=True).returning(TaskResponse.id))).first():
         raise DatabaseElementNotFoundError('Task response with id={} not found'.format(task_response_id))
-
-
-def submit_task(user_email: str, task_id: int, task_answer: str):
-    try:
-        with get_db() as session:
-            user = session.query(User).filter_by(email=user_email).first()
-            task = session.query(Task).filter_by(id=task_id).first()
-            user.tasks.append(task)
-            session.commit()
-            session.refresh(task)
-            # update completed status
-            session.query(TaskResponse).filter(
-                and_(TaskResponse.task_id == task_id, TaskResponse.user_email == user_email)).update(
-                {'is_completed': True,
-                 'answer': task_answer})
-            session.commit()
-    except NoResultFound:
+    await session.commit()
+
+
+async def approve_task_responses(session: AsyncSession, task_response_ids: list[int]) -> dict[int, str]:
+    """Approve task responses in one transaction, returns the reason for every id that was not approved"""
+    ids = unique_ids(task_response_ids)
+    approved = list(await session.scalars(update(TaskResponse).filter(
+        TaskResponse.id.in_(ids) & (TaskResponse.is_approved == False)).values(
+        is_approved=True).returning(TaskResponse.id)))
+    failures = await bulk_failures(session, TaskResponse, ids, approved, 'Task response', 'approved')
+    await session.commit()
+    return failures
+
+
+async def submit_task(session: AsyncSession, user_email: str, task_id: int, task_answer: str):
+    response = (TaskResponse.task_id == task_id) & (TaskResponse.user_email == user_email)
+    # the first submission completes the response of the user, inserted when they have not responded before
+    submitted = await session.scalar(update(TaskResponse).filter(
+        response & (TaskResponse.is_completed == False)).values(
+        is_completed=True, answer=task_answer).returning(TaskResponse.id))
+    if submitted is None:
+        submitted = await _insert_task_response(session, task_id, User.email == user_email, is_completed=True,
+                                                answer=task_answer)
+    if submitted is not None:
+        await achievement_engine.record(session, task_submitted(user_email))
+    # submitted again: the answer is replaced, the task is not counted twice
+    elif not await session.scalar(update(TaskResponse).filter(response).values(
+            is_completed=True, answer=task_answer).returning(TaskResponse.id)):
         raise DatabaseElementNotFoundError(
             'Task response to task with id={0} and user with email={1} not found'.format(task_id, user_email))
+    await session.commit()
+    await achievement_engine.award(session)
 
 
-@check_task_response_exist_decorator
-def check_task(task_response_id: int):
-    try:
-        with get_db() as session:
-            # update checked status
-            task_response_query = session.query(TaskResponse).filter_by(id=task_response_id)
-            task_response_query.update({'is_checked': True})
-            # update user scores
-            task_response = task_response_query.first()
-            task = session.query(Task).filter_by(id=task_response.task_id).first()
-            # query for user
-            user_query = session.query(User).filter_by(email=task_response.user_email)
-            # get user
-            user_points = user_query.first().points + task.points
-            user_query.update({'points': user_points})
-            session.commit()
-    except NoResultFound:
+async def check_task(session: AsyncSession, task_response_id: int):
+    # only responses not checked yet, so points are never awarded twice
+    if not (task_response := (await session.execute(update(TaskResponse).filter(
+            (TaskResponse.id == task_response_id) & (TaskResponse.is_checked == False)).values(
+            is_checked=True).returning(TaskResponse.user_email, TaskResponse.task_id))).first()):
         raise DatabaseElementNotFoundError(
-            'Task response with id={} not found'.format(task_response_id))
-
-
-@check_task_exist_decorator
-def remove_task(task_id: int):
-    with get_db() as session:
-        session.query(Task).filter_by(id=task_id).delete()
-        session.commit()
+            'Task response with id={} not found or already checked'.format(task_response_id))
+    task_points = await session.scalar(select(Task.points).filter_by(id=task_response.task_id)) or 0
+    # add task points in the database so concurrent checks do not overwrite each other
+    user_points = await session.scalar(update(User).filter_by(email=task_response.user_email).values(
+        points=User.points + task_points).returning(User.points))
+    await achievement_engine.record(session, tasks_checked([(task_response.user_email, task_points)]))
+    await session.commit()
+    # cached user info holds points
+    await invalidate_user(task_response.user_email)
+    await leaderboard.set_points(task_response.user_email, user_points)
+    await achievement_engine.award(session)
+
+
+async def check_tasks(session: AsyncSession, task_response_ids: list[int]) -> dict[int, str]:
+    """Check task responses in one transaction, returns the reason for every id that was not checked"""
+    ids = unique_ids(task_response_ids)
+    # responses checked before are skipped so points are not awarded twice
+    checked = (await session.execute(update(TaskResponse).filter(
+        TaskResponse.id.in_(ids) & (TaskResponse.is_checked == False)).values(
+        is_checked=True).returning(TaskResponse.id, TaskResponse.user_email, TaskResponse.task_id))).all()
+    users_points = {}
+    if checked:
+        task_points = dict((await session.execute(select(Task.id, Task.points).filter(
+            Task.id.in_({task_id for _, _, task_id in checked})))).all())
+        # sum the awards of every user and add them with a single UPDATE
+        awards = defaultdict(int)
+        for _, user_email, task_id in checked:
+            awards[user_email] += task_points.get(task_id, 0)
+        users_points = dict((await session.execute(update(User).filter(User.email.in_(list(awards))).values(
+            points=add_amounts(User.points, User.email, awards)).returning(User.email, User.points))).all())
+        await achievement_engine.record(session, tasks_checked(
+            (user_email, task_points.get(task_id, 0)) for _, user_email, task_id in checked))
+    failures = await bulk_failures(session, TaskResponse, ids, (response_id for response_id, _, _ in checked),
+                                   'Task response', 'checked')
+    await session.commit()
+    # cached user info holds points
+    await invalidate_user(*users_points)
+    await leaderboard.set_points_many(users_points)
+    await achievement_engine.award(session)
+    return failures
+
+
+async def remove_task(session: AsyncSession, task_id: int):
+    if not (await session.execute(delete(Task).filter_by(id=task_id).returning(Task.id))).first():
+        raise DatabaseElementNotFoundError('Task with id={} not found'.format(task_id))
+    await session.commit()
+    task_scheduler.unschedule(task_id)
+    await collection_versions.bump('tasks')
@@ -0,0 +1,31 @@
+from datetime import datetime
+
+import pytz
+from sqlalchemy import and_, true
+from sqlalchemy.sql.elements import ColumnElement
+
+
+def time_window_predicate(start_column, end_column, window: str,
+                          start: datetime | None = None, end: datetime | None = None) -> ColumnElement:
+    """
+    SQL predicate selecting rows whose [start_column, end_column) period is
+    `upcoming` (not started yet), `ongoing`, `past` (already finished) or overlaps
+    the [start, end) period for `between` (a missing bound leaves that side open).
+    """
+    now = datetime.now(pytz.utc)
+    if window == 'upcoming':
+        return start_column > now
+    if window == 'ongoing':
+        return and_(start_column <= now, end_column > now)
+    if window == 'past':
+        return end_column <= now
+    if window == 'between':
+        if start is not None and end is not None and start > end:
+            raise ValueError('Start date must be before end date')
+        clauses = []
+        if end is not None:
+            clauses.append(start_column < end)
+        if start is not None:
+            clauses.append(end_column > start)
+        return and_(true(), *clauses)
+    raise ValueError('Unknown time window {}'.format(window))
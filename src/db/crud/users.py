@@ -1,51 +1,98 @@
-from db.connector import get_db
+from typing import AsyncIterator, Iterable
+
+from pydantic import BaseModel
+from sqlalchemy import Row, select, update, delete, desc
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from auth.cache import invalidate_user, revoke_user_tokens
+from db.connector import read_only
+from db.crud.bulk import insert_ignoring_conflicts
+from db.crud.pagination import Page, paginate
+from db.crud.readonly import stream_records
 from db.models import User
 from exceptions import DatabaseElementNotFoundError
+from user.leaderboard import leaderboard
+
+
+async def get_user_by_email(session: AsyncSession, email: str) -> User:
+    if not (user := await session.scalar(select(User).filter_by(email=email))):
+        raise DatabaseElementNotFoundError('User with email={} not found'.format(email))
+    return user
+
+
+USER_ORDERINGS = {
+    'registered_at': (User.registered_at, User.id),
+    '-registered_at': (desc(User.registered_at), desc(User.id)),
+    'points': (User.points, User.id),
+    '-points': (desc(User.points), User.id),
+}
+
+
+def _users_query(min_points: int | None = None):
+    query = select(User).filter_by(is_admin=False)
+    if min_points is not None:
+        query = query.where(User.points >= min_points)
+    return query
+
 
+@read_only
+async def get_all_users(session: AsyncSession, limit: int | None = None, cursor: str | None = None,
+                        with_total: bool = False, ordering: str = 'registered_at',
+                        min_points: int | None = None,
+                        schema: type[BaseModel] | None = None) -> Page[User]:
+    return await paginate(session, _users_query(min_points), USER_ORDERINGS[ordering], limit, cursor, with_total,
+                          schema)
 
-def check_user_exist_decorator(func):
-    def wrapper(email: str, *args, **kwargs):
-        if not get_user_by_email(email):
-            raise DatabaseElementNotFoundError('User with email={} not found'.format(email))
-        return func(email=email, *args, **kwargs)
 
-    return wrapper
+def export_users(session: AsyncSession, schema: type[BaseModel], ordering: str = 'registered_at',
+                 min_points: int | None = None) -> AsyncIterator[Row]:
+    return stream_records(session, _users_query(min_points).order_by(*USER_ORDERINGS[ordering]), schema)
 
 
-def get_user_by_email(email: str) -> User:
-    with get_db() as session:
-        if not (user := session.query(User).filter_by(email=email).first()):
-            raise DatabaseElementNotFoundError('User with email={} not found'.format(email))
-        return user
+async def add_new_user(session: AsyncSession, first_name: str, last_name,
+                       email: str, username: str,
+                       hashed_password: str, admin=False):
+    user = User(first_name=first_name, last_name=last_name,
+                username=username, email=email,
+                hashed_password=hashed_password, is_admin=admin)
+    user.is_admin = admin
+    session.add(user)
+    await session.commit()
+    await session.refresh(user)
+    if not user.is_admin:
+        await leaderboard.add(user.id, user.email, user.username, user.points)
 
 
-def get_all_users() -> list[User]:
-    with get_db() as session:
-        return session.query(User).filter_by(is_admin=False).all()
+async def get_registered_emails(session: AsyncSession, emails: Iterable[str]) -> set[str]:
+    return set(await session.scalars(select(User.email).filter(User.email.in_(list(emails)))))
 
 
-def add_new_user(first_name: str, last_name,
-                 email: str, username: str,
-                 hashed_password: str, admin=False):
-    with get_db() as session:
-        user = User(first_name=first_name, last_name=last_name,
-                    username=username, email=email,
-                    hashed_password=hashed_password, is_admin=admin)
-        user.is_admin = admin
-        session.add(user)
-        session.commit()
-        session.refresh(user)
+async def add_new_users(session: AsyncSession, users: list[dict]) -> list:
+    """Insert users with multi-row INSERTs, returns the inserted rows (emails registered meanwhile are skipped)"""
+    rows = (await session.execute(insert_ignoring_conflicts(session, User).returning(
+        User.id, User.email, User.username, User.points, User.is_admin), users)).all()
+    await session.commit()
+    await leaderboard.add_many((row.id, row.email, row.username, row.points) for row in rows if not row.is_admin)
+    return rows
 
 
-@check_user_exist_decorator
-def update_user_by_email(email: str, **kwargs):
-    with get_db() as session:
-        session.query(User).filter_by(email=email).update(kwargs)
-        session.commit()
+async def update_user_by_email(session: AsyncSession, email: str, **kwargs):
+    if kwargs:
+        query = update(User).filter_by(email=email).values(**kwargs).returning(User.id)
+    else:
+        # nothing to update, only check that the user exists
+        query = select(User.id).filter_by(email=email)
+    if not (await session.execute(query)).first():
+        raise DatabaseElementNotFoundError('User with email={} not found'.format(email))
+    await session.commit()
+    await invalidate_user(email)
+    if 'username' in kwargs:
+        await leaderboard.set_username(email, kwargs['username'])
 
 
-@check_user_exist_decorator
-def remove_user_by_email(email: str):
-    with get_db() as session:
-        session.query(User).filter_by(email=email).delete()
-        session.commit()
+async def remove_user_by_email(session: AsyncSession, email: str):
+    if not (await session.execute(delete(User).filter_by(email=email).returning(User.id))).first():
+        raise DatabaseElementNotFoundError('User with email={} not found'.format(email))
+    await session.commit()
+    await revoke_user_tokens(email)
+    await leaderboard.remove(email)
@@ -0,0 +1,345 @@
+"""
+Versioned schema migrations.
+
+    python -m db.migrate upgrade [--to VERSION]
+    python -m db.migrate current
+    python -m db.migrate history
+"""
+import argparse
+import asyncio
+import logging
+import re
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, MetaData, Table, Index, func, inspect, insert, \
+    select, text, delete, update, literal, distinct
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.orm import aliased
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+from db.connector import get_engine, dispose_engine
+from db.crud.search import SEARCH_CONFIG, SEARCH_SOURCES
+from db.models import TZTimestamp, TaskResponse, ShiftReservation, Shift, Task, Achievement, UserAchievement, \
+    UserCounter
+from user.achievements import TASKS_SUBMITTED, TASKS_CHECKED, POINTS_EARNED, SHIFTS_APPROVED
+
+logger = logging.getLogger(__name__)
+
+# arbitrary application-wide key of the postgres advisory lock serializing concurrent runs
+MIGRATION_LOCK_KEY = 0x63616D70
+
+migration_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', migration_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String, nullable=False),
+    Column('applied_at', TZTimestamp, server_default=func.now()),
+)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    upgrade: Callable[[AsyncConnection], Awaitable[None]]
+    # concurrent index builds cannot run inside a transaction, such migrations must be idempotent
+    transactional: bool = True
+
+
+def _is_postgres(connection: AsyncConnection) -> bool:
+    return connection.dialect.name == 'postgresql'
+
+
+async def add_column(connection: AsyncConnection, column: Column):
+    """Add a model column to its existing table (no-op if it is already there)"""
+    table = column.table.name
+    existing = await connection.run_sync(lambda sync: {c['name'] for c in inspect(sync).get_columns(table)})
+    if column.name not in existing:
+        await connection.execute(text('ALTER TABLE {} ADD COLUMN {}'.format(
+            table, CreateColumn(column).compile(dialect=connection.dialect))))
+
+
+async def create_index(connection: AsyncConnection, index: Index):
+    """Create a model index if it does not exist, without blocking writes on postgres"""
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=connection.dialect))
+    if _is_postgres(connection):
+        # a failed concurrent build leaves an invalid index behind, which IF NOT EXISTS would keep forever
+        if await connection.scalar(text('SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)'),
+                                   {'name': index.name}):
+            await connection.execute(text('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(index.name)))
+        ddl = re.sub(r'^CREATE (UNIQUE )?INDEX', r'CREATE \1INDEX CONCURRENTLY', ddl)
+    await connection.execute(text(ddl))
+
+
+def model_index(model, name: str) -> Index:
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+
+# tables as the app created them before versioned migrations, later changes of the models go in new migrations
+baseline_metadata = MetaData()
+Table('users', baseline_metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('email', String, nullable=False, unique=True),
+      Column('first_name', String, nullable=False),
+      Column('last_name', String, nullable=False),
+      Column('username', String, nullable=False),
+      Column('points', Integer),
+      Column('media_link', String, nullable=True),
+      Column('hashed_password', String, nullable=False),
+      Column('is_admin', Boolean),
+      Column('registered_at', TZTimestamp, server_default=func.now()))
+Table('shifts', baseline_metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('name', String, nullable=False),
+      Column('number', String, nullable=False),
+      Column('description', String, nullable=False),
+      Column('participants_number', Integer, nullable=False),
+      Column('start_date', TZTimestamp, nullable=False),
+      Column('end_date', TZTimestamp, nullable=False))
+Table('tasks', baseline_metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('title', String, nullable=False),
+      Column('description', String, nullable=False),
+      Column('author_email', String, ForeignKey('users.email')),
+      Column('points', Integer, nullable=False),
+      Column('start_date', TZTimestamp, server_default=func.now()),
+      Column('end_date', TZTimestamp, nullable=False),
+      Column('is_active', Boolean))
+Table('task_responses', baseline_metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('user_email', String, ForeignKey('users.email')),
+      Column('task_id', Integer, ForeignKey('tasks.id')),
+      Column('answer', String),
+      Column('response_time', TZTimestamp, server_default=func.now()),
+      Column('is_approved', Boolean),
+      Column('is_completed', Boolean),
+      Column('is_checked', Boolean))
+Table('shift_reservations', baseline_metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('shift_id', Integer, ForeignKey('shifts.id')),
+      Column('user_email', String, ForeignKey('users.email')),
+      Column('created_at', TZTimestamp, server_default=func.now()),
+      Column('is_approved', Boolean))
+Table('achievements', baseline_metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('name', String, nullable=False),
+      Column('description', String, nullable=False))
+Table('user_achievements', baseline_metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('user_email', String, ForeignKey('users.email')),
+      Column('achievement_id', Integer, ForeignKey('achievements.id')))
+Table('news', baseline_metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('title', String, nullable=False),
+      Column('content', String, nullable=False),
+      Column('created_at', TZTimestamp, server_default=func.now()))
+
+
+async def _create_tables(connection: AsyncConnection):
+    # tables already there (databases created by the app before migrations) are kept
+    await connection.run_sync(baseline_metadata.create_all)
+
+
+async def _index_lookup_columns(connection: AsyncConnection):
+    for model, name in ((TaskResponse, 'ix_task_responses_user_email'),
+                        (ShiftReservation, 'ix_shift_reservations_user_email'),
+                        (Shift, 'ix_shifts_start_date'), (Shift, 'ix_shifts_end_date'),
+                        (Task, 'ix_tasks_start_date'), (Task, 'ix_tasks_end_date'),
+                        (Task, 'ix_tasks_is_active_start_date')):
+        await create_index(connection, model_index(model, name))
+
+
+async def _create_search_index(connection: AsyncConnection):
+    # the database keeps the index in sync with every insert, update and delete of news and tasks
+    for source in SEARCH_SOURCES.values():
+        names = dict(table=source.table, title=source.title, body=source.body, fts=source.fts_table,
+                     config=SEARCH_CONFIG)
+        if _is_postgres(connection):
+            await connection.execute(text(
+                "ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+                "setweight(to_tsvector('{config}', coalesce({title}, '')), 'A') || "
+                "setweight(to_tsvector('{config}', coalesce({body}, '')), 'B')) STORED".format(**names)))
+            table = Table(source.table, MetaData(), Column('search_vector', TSVECTOR))
+            await create_index(connection, Index('ix_{}_search_vector'.format(source.table), table.c.search_vector,
+                                                 postgresql_using='gin'))
+            continue
+        # sqlite: external content FTS5 table over the rows of the source table
+        for statement in (
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({title}, {body}, content='{table}', "
+                "content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+                "CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN "
+                "INSERT INTO {fts}(rowid, {title}, {body}) VALUES (new.id, new.{title}, new.{body}); END",
+                "CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN "
+                "INSERT INTO {fts}({fts}, rowid, {title}, {body}) VALUES ('delete', old.id, old.{title}, old.{body}); "
+                "END",
+                "CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {title}, {body} ON {table} BEGIN "
+                "INSERT INTO {fts}({fts}, rowid, {title}, {body}) VALUES ('delete', old.id, old.{title}, old.{body}); "
+                "INSERT INTO {fts}(rowid, {title}, {body}) VALUES (new.id, new.{title}, new.{body}); END",
+                # index the rows written before the migration
+                "INSERT INTO {fts}({fts}) VALUES ('rebuild')"):
+            await connection.execute(text(statement.format(**names)))
+
+
+async def _add_shift_capacity(connection: AsyncConnection):
+    for column in (Shift.__table__.c.capacity, Shift.__table__.c.reserved_number,
+                   ShiftReservation.__table__.c.is_waitlisted):
+        await add_column(connection, column)
+    # keep one reservation per camper and shift (preferring an approved one) before the unique index is built
+    ranked = select(ShiftReservation.id, func.row_number().over(
+        partition_by=(ShiftReservation.shift_id, ShiftReservation.user_email),
+        order_by=(ShiftReservation.is_approved.desc(), ShiftReservation.id)).label('n')).subquery()
+    await connection.execute(delete(ShiftReservation.__table__).where(
+        ShiftReservation.id.in_(select(ranked.c.id).where(ranked.c.n > 1))))
+    # every existing reservation holds a place, participants are the approved ones
+    reservation = aliased(ShiftReservation)
+    reservations = select(func.count()).select_from(reservation).where(reservation.shift_id == Shift.id)
+    await connection.execute(update(Shift.__table__).values(
+        reserved_number=reservations.scalar_subquery(),
+        participants_number=reservations.where(reservation.is_approved == True).scalar_subquery()))
+
+
+async def _index_shift_reservations(connection: AsyncConnection):
+    for name in ('ux_shift_reservations_shift_id_user_email', 'ix_shift_reservations_shift_id_is_waitlisted_id'):
+        await create_index(connection, model_index(ShiftReservation, name))
+
+
+async def _add_achievement_counters(connection: AsyncConnection):
+    for column in (Achievement.__table__.c.code, Achievement.__table__.c.counter, Achievement.__table__.c.threshold,
+                   UserAchievement.__table__.c.awarded_at):
+        await add_column(connection, column)
+    await connection.run_sync(lambda sync: UserCounter.__table__.create(sync, checkfirst=True))
+    # keep one award per camper and achievement before the unique index is built
+    ranked = select(UserAchievement.id, func.row_number().over(
+        partition_by=(UserAchievement.user_email, UserAchievement.achievement_id),
+        order_by=UserAchievement.id).label('n')).subquery()
+    await connection.execute(delete(UserAchievement.__table__).where(
+        UserAchievement.id.in_(select(ranked.c.id).where(ranked.c.n > 1))))
+    # the one time counters are computed from the history, afterwards every event adds to them
+    counters = {
+        # a task counts once, however many responses a camper sent to it
+        TASKS_SUBMITTED: select(TaskResponse.user_email, func.count(distinct(TaskResponse.task_id))).filter(
+            TaskResponse.is_completed == True),
+        TASKS_CHECKED: select(TaskResponse.user_email, func.count()).filter(TaskResponse.is_checked == True),
+        POINTS_EARNED: select(TaskResponse.user_email, func.coalesce(func.sum(Task.points), 0)).join(
+            Task, Task.id == TaskResponse.task_id).filter(TaskResponse.is_checked == True),
+        SHIFTS_APPROVED: select(ShiftReservation.user_email, func.count()).filter(
+            ShiftReservation.is_approved == True),
+    }
+    for name, query in counters.items():
+        user_email, value = query.selected_columns
+        await connection.execute(insert(UserCounter.__table__).from_select(
+            ['user_email', 'name', 'value'], query.with_only_columns(user_email, literal(name), value).filter(
+                user_email.is_not(None)).group_by(user_email)))
+
+
+async def _index_achievements(connection: AsyncConnection):
+    for model, name in ((Achievement, 'ux_achievements_code'),
+                        (UserAchievement, 'ux_user_achievements_user_email_achievement_id'),
+                        (UserCounter, 'ix_user_counters_name_value')):
+        await create_index(connection, model_index(model, name))
+
+
+async def _deduplicate_task_responses(connection: AsyncConnection):
+    # keep one response per camper and task (preferring the furthest reviewed) before the unique index is built
+    ranked = select(TaskResponse.id, func.row_number().over(
+        partition_by=(TaskResponse.user_email, TaskResponse.task_id),
+        order_by=(TaskResponse.is_checked.desc(), TaskResponse.is_approved.desc(), TaskResponse.is_completed.desc(),
+                  TaskResponse.id)).label('n')).subquery()
+    await connection.execute(delete(TaskResponse.__table__).where(
+        TaskResponse.id.in_(select(ranked.c.id).where(ranked.c.n > 1))))
+
+
+async def _index_task_responses(connection: AsyncConnection):
+    await create_index(connection, model_index(TaskResponse, 'ux_task_responses_user_email_task_id'))
+
+
+MIGRATIONS = [
+    Migration(1, 'create tables', _create_tables),
+    Migration(2, 'index reservation, response and date lookup columns', _index_lookup_columns,
+              transactional=False),
+    Migration(3, 'full-text search index over news and tasks', _create_search_index, transactional=False),
+    Migration(4, 'shift capacity, reserved places and waitlist', _add_shift_capacity),
+    Migration(5, 'unique and waitlist indexes of shift reservations', _index_shift_reservations, transactional=False),
+    Migration(6, 'achievement rules and user counters', _add_achievement_counters),
+    Migration(7, 'achievement and user counter indexes', _index_achievements, transactional=False),
+    Migration(8, 'one response per camper and task', _deduplicate_task_responses),
+    Migration(9, 'unique index of task responses', _index_task_responses, transactional=False),
+]
+
+
+async def _applied_versions(connection: AsyncConnection) -> set[int]:
+    await connection.run_sync(migration_metadata.create_all)
+    return set(await connection.scalars(select(schema_migrations.c.version)))
+
+
+async def _apply(migration: Migration):
+    engine = get_engine()
+    if migration.transactional:
+        async with engine.begin() as connection:
+            await migration.upgrade(connection)
+            await connection.execute(insert(schema_migrations).values(
+                version=migration.version, description=migration.description))
+        return
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level='AUTOCOMMIT')
+        await migration.upgrade(connection)
+        await connection.execute(insert(schema_migrations).values(
+            version=migration.version, description=migration.description))
+
+
+async def upgrade(target: int | None = None) -> list[int]:
+    """Apply all pending migrations up to target (latest by default), returns applied versions"""
+    applied = []
+    async with get_engine().connect() as lock_connection:
+        # only one runner at a time (e.g. several containers starting together)
+        if _is_postgres(lock_connection):
+            await lock_connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+            await lock_connection.commit()
+        try:
+            async with get_engine().begin() as connection:
+                done = await _applied_versions(connection)
+            for migration in MIGRATIONS:
+                if migration.version in done or (target is not None and migration.version > target):
+                    continue
+                logger.info('Applying migration %d: %s', migration.version, migration.description)
+                await _apply(migration)
+                applied.append(migration.version)
+        finally:
+            if _is_postgres(lock_connection):
+                await lock_connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+                await lock_connection.commit()
+    return applied
+
+
+async def current_version() -> int:
+    async with get_engine().begin() as connection:
+        return max(await _applied_versions(connection), default=0)
+
+
+async def _main(args: argparse.Namespace):
+    try:
+        if args.command == 'upgrade':
+            applied = await upgrade(args.to)
+            print('Applied migrations: {}'.format(', '.join(map(str, applied)) or 'none'))
+            print('Schema version: {}'.format(await current_version()))
+        elif args.command == 'current':
+            print('Schema version: {} (latest {})'.format(await current_version(), MIGRATIONS[-1].version))
+        else:
+            for migration in MIGRATIONS:
+                print('{:>4}  {}'.format(migration.version, migration.description))
+    finally:
+        await dispose_engine()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    upgrade_parser = subparsers.add_parser('upgrade', help='apply pending migrations')
+    upgrade_parser.add_argument('--to', type=int, default=None, help='stop at this schema version')
+    subparsers.add_parser('current', help='show the applied schema version')
+    subparsers.add_parser('history', help='list all migrations')
+    logging.basicConfig(format='%(message)s')
+    logger.setLevel(logging.INFO)
+    asyncio.run(_main(parser.parse_args()))
@@ -1,32 +1,73 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, TIMESTAMP
+from datetime import timezone
+
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, TIMESTAMP, Index, false
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
+from sqlalchemy.types import TypeDecorator
 
 Base = declarative_base()
 
 
+class TZTimestamp(TypeDecorator):
+    """Timezone-aware timestamp, stored as naive UTC on backends without tz support (SQLite)"""
+    impl = TIMESTAMP(timezone=True)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'sqlite':
+            # same text format as CURRENT_TIMESTAMP server defaults, so stored values compare correctly
+            return dialect.type_descriptor(sqlite.DATETIME(
+                storage_format='%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d'))
+        return dialect.type_descriptor(self.impl)
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and value.tzinfo is not None and dialect.name == 'sqlite':
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
+
+
 class TaskResponse(Base):
     __tablename__ = 'task_responses'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_email = Column(String, ForeignKey('users.email'))
+    user_email = Column(String, ForeignKey('users.email'), index=True)
     task_id = Column(Integer, ForeignKey('tasks.id'))
     answer = Column(String, default=None)
-    response_time = Column(type_=TIMESTAMP(timezone=True), server_default=func.now())
+    response_time = Column(type_=TZTimestamp, server_default=func.now())
     is_approved = Column(Boolean, default=False)
     is_completed = Column(Boolean, default=False)
     is_checked = Column(Boolean, default=False)
 
+    __table_args__ = (
+        # one response per camper and task, submitting completes it
+        Index('ux_task_responses_user_email_task_id', 'user_email', 'task_id', unique=True),
+    )
+
 
 class ShiftReservation(Base):
     __tablename__ = 'shift_reservations'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     shift_id = Column(Integer, ForeignKey('shifts.id'))
-    user_email = Column(String, ForeignKey('users.email'))
-    created_at = Column(type_=TIMESTAMP(timezone=True), server_default=func.now())
+    user_email = Column(String, ForeignKey('users.email'), index=True)
+    created_at = Column(type_=TZTimestamp, server_default=func.now())
     is_approved = Column(Boolean, default=False)
+    # the shift was full when the reservation came in, waitlisted reservations are promoted in id order
+    is_waitlisted = Column(Boolean, nullable=False, default=False, server_default=false())
+
+    __table_args__ = (
+        # one reservation per camper and shift
+        Index('ux_shift_reservations_shift_id_user_email', 'shift_id', 'user_email', unique=True),
+        # head of the waitlist of a shift
+        Index('ix_shift_reservations_shift_id_is_waitlisted_id', 'shift_id', 'is_waitlisted', 'id'),
+    )
 
 
 class UserAchievement(Base):
@@ -35,6 +76,27 @@ class UserAchievement(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_email = Column(String, ForeignKey('users.email'))
     achievement_id = Column(Integer, ForeignKey('achievements.id'))
+    # set by the inserts (not a server default) so that the column can be added to the existing table on SQLite
+    awarded_at = Column(type_=TZTimestamp, default=func.now())
+
+    __table_args__ = (
+        # an achievement is awarded once, repeated awards are ignored
+        Index('ux_user_achievements_user_email_achievement_id', 'user_email', 'achievement_id', unique=True),
+    )
+
+
+class UserCounter(Base):
+    """Running total of something a user did (tasks submitted, points earned, ...), the input of achievements"""
+    __tablename__ = 'user_counters'
+
+    user_email = Column(String, ForeignKey('users.email'), primary_key=True)
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        # users who already reached a threshold, when a new achievement is awarded to them
+        Index('ix_user_counters_name_value', 'name', 'value'),
+    )
 
 
 class User(Base):
@@ -49,7 +111,7 @@ class User(Base):
     media_link = Column(String, nullable=True)
     hashed_password = Column(String, nullable=False)
     is_admin = Column(Boolean, default=False)
-    registered_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    registered_at = Column(TZTimestamp, server_default=func.now())
 
     shifts = relationship('Shift', secondary='shift_reservations', back_populates='users')
     tasks = relationship('Task', secondary='task_responses', back_populates='users')
@@ -64,8 +126,12 @@ class Shift(Base):
     number = Column(String, nullable=False)
     description = Column(String, nullable=False)
     participants_number = Column(Integer, nullable=False, default=0)
-    start_date = Column(type_=TIMESTAMP(timezone=True), nullable=False)
-    end_date = Column(type_=TIMESTAMP(timezone=True), nullable=False)
+    # max number of admitted (not waitlisted) reservations, unlimited when empty
+    capacity = Column(Integer, nullable=True)
+    # admitted reservations, maintained by the reservation engine
+    reserved_number = Column(Integer, nullable=False, default=0, server_default='0')
+    start_date = Column(type_=TZTimestamp, nullable=False, index=True)
+    end_date = Column(type_=TZTimestamp, nullable=False, index=True)
 
     users = relationship('User', secondary='shift_reservations', back_populates='shifts')
 
@@ -78,12 +144,17 @@ class Task(Base):
     description = Column(String, nullable=False)
     author_email = Column(String, ForeignKey("users.email"))
     points = Column(Integer, nullable=False)
-    start_date = Column(type_=TIMESTAMP(timezone=True), server_default=func.now())
-    end_date = Column(type_=TIMESTAMP(timezone=True), nullable=False)
+    start_date = Column(type_=TZTimestamp, server_default=func.now(), index=True)
+    end_date = Column(type_=TZTimestamp, nullable=False, index=True)
     is_active = Column(Boolean, default=True)
 
     users = relationship('User', secondary='task_responses', back_populates='tasks')
 
+    __table_args__ = (
+        # active tasks listing (is_active flag maintained by the task scheduler)
+        Index('ix_tasks_is_active_start_date', 'is_active', 'start_date', 'id'),
+    )
+
 
 class Achievement(Base):
     __tablename__ = 'achievements'
@@ -91,9 +162,17 @@ class Achievement(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
     description = Column(String, nullable=False)
+    # rule: awarded once the user counter reaches the threshold (catalogue in user/achievements.py)
+    code = Column(String, nullable=True)
+    counter = Column(String, nullable=True)
+    threshold = Column(Integer, nullable=True)
 
     users = relationship('User', secondary='user_achievements', back_populates='achievements')
 
+    __table_args__ = (
+        Index('ux_achievements_code', 'code', unique=True),
+    )
+
 
 class News(Base):
     __tablename__ = "news"
@@ -101,4 +180,4 @@ class News(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     title = Column(String, nullable=False)
     content = Column(String, nullable=False)
-    created_at = Column(type_=TIMESTAMP(timezone=True), server_default=func.now())
+    created_at = Column(type_=TZTimestamp, server_default=func.now())
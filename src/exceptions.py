@@ -10,4 +10,20 @@ class DatabaseElementNotFoundError(BaseAPIException):
         self.msg = msg
 
     def __str__(self):
-        return self.msg
\ No newline at end of file
+        return self.msg
+
+
+class InvalidCursorError(BaseAPIException):
+    def __init__(self, msg: str):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class DatabaseElementConflictError(BaseAPIException):
+    def __init__(self, msg: str):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
@@ -0,0 +1,81 @@
+import csv
+import io
+from datetime import datetime
+from typing import AsyncIterator, Callable, Sequence
+
+import orjson
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.connector import get_db
+
+# rows encoded into one chunk of the response body
+ROWS_PER_CHUNK = 1000
+
+MEDIA_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+async def _chunks(records: AsyncIterator[Row]) -> AsyncIterator[list[Row]]:
+    chunk = []
+    async for record in records:
+        chunk.append(record)
+        if len(chunk) >= ROWS_PER_CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def _encode_csv(records: AsyncIterator[Row], columns: Sequence[str]) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # the header goes out before the query runs
+    writer.writerow(columns)
+    yield buffer.getvalue().encode()
+    async for chunk in _chunks(records):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_csv_value(value) for value in record] for record in chunk)
+        yield buffer.getvalue().encode()
+
+
+async def _encode_ndjson(records: AsyncIterator[Row], columns: Sequence[str]) -> AsyncIterator[bytes]:
+    async for chunk in _chunks(records):
+        yield b''.join(orjson.dumps(dict(zip(columns, record))) + b'\n' for record in chunk)
+
+
+ENCODERS = {
+    'csv': _encode_csv,
+    'ndjson': _encode_ndjson,
+}
+
+
+def export_response(export: Callable[[AsyncSession], AsyncIterator[Row]], columns: Sequence[str],
+                    file_format: str, filename: str) -> StreamingResponse:
+    """
+    Stream the records of an export as a CSV or NDJSON download.
+    The export runs in its own session which lives exactly as long as the response body.
+    """
+
+    async def records() -> AsyncIterator[Row]:
+        async with get_db(read_only=True) as session:
+            async for record in export(session):
+                yield record
+
+    return StreamingResponse(ENCODERS[file_format](records(), columns), media_type=MEDIA_TYPES[file_format],
+                             headers={'Content-Disposition': 'attachment; filename="{}.{}"'.format(
+                                 filename, file_format)})
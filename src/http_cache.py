@@ -0,0 +1,95 @@
+import hashlib
+import time
+from collections import defaultdict
+from datetime import datetime
+from email.utils import formatdate
+from typing import Awaitable, Callable
+
+import pytz
+from fastapi.responses import ORJSONResponse
+from starlette.requests import Request
+from starlette.responses import Response
+
+from config import settings
+from db.connector import primary_reads
+from shared_cache import create_cache, get_redis
+
+
+class CollectionVersions:
+    """Version counters of collections, bumped by every write which changes what their read endpoints return"""
+
+    def __init__(self):
+        self._versions: defaultdict[str, int] = defaultdict(int)
+        self._modified: dict[str, float] = {}
+        self._started = time.time()
+
+    async def get(self, collection: str) -> tuple[int, float]:
+        """Current version and last modification time"""
+        return self._versions[collection], self._modified.get(collection, self._started)
+
+    async def bump(self, *collections: str):
+        for collection in collections:
+            self._versions[collection] += 1
+            self._modified[collection] = time.time()
+
+
+class RedisCollectionVersions:
+    """Version counters kept on the shared cache server, so a write handled by one worker is seen by all"""
+
+    def __init__(self, key: str = 'collections'):
+        self._key = key
+
+    async def get(self, collection: str) -> tuple[int, float]:
+        async with get_redis().pipeline(transaction=False) as pipeline:
+            # a collection never written to since the server started is modified as of now
+            pipeline.hsetnx(self._key, collection + ':modified', time.time())
+            pipeline.hmget(self._key, collection + ':version', collection + ':modified')
+            _, (version, modified) = await pipeline.execute()
+        return int(version or 0), float(modified)
+
+    async def bump(self, *collections: str):
+        async with get_redis().pipeline(transaction=True) as pipeline:
+            for collection in collections:
+                pipeline.hincrby(self._key, collection + ':version', 1)
+                pipeline.hset(self._key, collection + ':modified', time.time())
+            await pipeline.execute()
+
+
+collection_versions = RedisCollectionVersions() if settings.CACHE_BACKEND == 'redis' else CollectionVersions()
+# serialized bodies keyed by collection version and request url
+response_cache = create_cache('responses', settings.HTTP_CACHE_MAX_SIZE, settings.HTTP_CACHE_TTL_SECONDS)
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if not (if_none_match := request.headers.get('if-none-match')):
+        return False
+    # If-None-Match uses weak comparison
+    candidates = {candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')}
+    return '*' in candidates or etag in candidates
+
+
+async def conditional_response(request: Request, collection: str, render: Callable[[], Awaitable[dict]],
+                               expires_at: Callable[[dict], datetime | None] | None = None) -> Response:
+    """
+    Serve a read endpoint from the serialized body cached for the current collection version.
+    render returns the (json serializable) content of the response.
+    A matching If-None-Match is answered with 304 without rendering (and so without touching the database).
+    expires_at gives the moment a rendered content goes stale on its own (e.g. an upcoming shift starts).
+    """
+    version, last_modified = await collection_versions.get(collection)
+    key = '{}:{}:{}?{}'.format(collection, version, request.url.path, request.url.query)
+    if (entry := await response_cache.get(key)) is None:
+        # a version bumped a moment ago may not have reached the replicas, its body is rendered from the primary
+        with primary_reads(time.time() - last_modified < settings.DB_REPLICA_MAX_LAG_SECONDS):
+            content = await render()
+        body = ORJSONResponse(content).body
+        entry = ('"{}"'.format(hashlib.blake2b(body, digest_size=16).hexdigest()), body, last_modified)
+        ttl = None
+        if expires_at and (stale_at := expires_at(content)):
+            ttl = (stale_at - datetime.now(pytz.utc)).total_seconds()
+        await response_cache.set(key, entry, ttl)
+    etag, body, last_modified = entry
+    headers = {'ETag': etag, 'Last-Modified': formatdate(last_modified, usegmt=True), 'Cache-Control': 'no-cache'}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type='application/json', headers=headers)
@@ -1,20 +1,55 @@
+from contextlib import asynccontextmanager
+
 import uvicorn as uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 
+from auth.dependencies import check_user_status
+from auth.hashing import password_hasher
 from auth.router import auth_router
 from news.router import news_router
+from search.router import search_router
+from shared_cache import close_redis
 from shifts.router import shifts_router
 from config import settings
+from db.connector import dispose_engine, get_pool_statistics, replica_monitor
+from metrics import MetricsMiddleware, metrics_response
 from tasks.router import tasks_router
+from tasks.scheduler import task_scheduler
+from user.achievements import achievement_engine
+from user.leaderboard import leaderboard
 from user.router import user_router
 
-app = FastAPI(title='Children`s Camp API', version=settings.API_VERSION, description=settings.API_DESCRIPTION)
+# port inside the container, published as API_PORT by docker compose
+API_PORT = 8180
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the schema is managed separately by `python -m db.migrate upgrade`
+    await replica_monitor.start()
+    await task_scheduler.start()
+    await leaderboard.load()
+    await achievement_engine.load()
+    try:
+        yield
+    finally:
+        await task_scheduler.stop()
+        await replica_monitor.stop()
+        password_hasher.shutdown()
+        await close_redis()
+        await dispose_engine()
+
+
+app = FastAPI(title='Children`s Camp API', version=settings.API_VERSION, description=settings.API_DESCRIPTION,
+              lifespan=lifespan, default_response_class=ORJSONResponse)
 app.include_router(auth_router)
 app.include_router(user_router)
 app.include_router(news_router)
 app.include_router(shifts_router)
 app.include_router(tasks_router)
+app.include_router(search_router)
 
 # разрешим CORS
 app.add_middleware(
@@ -23,6 +58,20 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+
+
+@app.get("/status/pool", tags=["Status"], dependencies=[Depends(check_user_status)])
+async def get_db_pool_status() -> dict:
+    """Get live database connection pool statistics (required admin rights)"""
+    return get_pool_statistics()
+
+
+@app.get("/metrics", tags=["Status"], include_in_schema=False)
+async def get_metrics():
+    """Prometheus metrics"""
+    return metrics_response()
+
 
 if __name__ == "__main__":
-    uvicorn.run(app, host=settings.API_HOST, port=8180)
\ No newline at end of file
+    uvicorn.run(app, host=settings.API_HOST, port=API_PORT)
\ No newline at end of file
@@ -0,0 +1,108 @@
+import logging
+import os
+import time
+from contextvars import ContextVar
+
+from prometheus_client import Histogram, CollectorRegistry, CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+from starlette.datastructures import MutableHeaders
+from starlette.responses import Response
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Request latency',
+                            ['method', 'route', 'status'])
+REQUEST_QUERIES = Histogram('http_request_db_queries', 'SQL statements executed per request',
+                            ['method', 'route'], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500))
+REQUEST_DB_TIME = Histogram('http_request_db_duration_seconds', 'Time spent executing SQL per request',
+                            ['method', 'route'])
+REQUEST_POOL_WAIT = Histogram('http_request_db_pool_wait_seconds', 'Time spent waiting for a pool connection '
+                                                                   'per request', ['method', 'route'])
+
+
+class RequestStats:
+    """Database work done while handling the current request"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.pool_wait = 0.0
+
+    def record_query(self, duration: float):
+        self.queries += 1
+        self.db_time += duration
+
+    def record_pool_wait(self, duration: float):
+        self.pool_wait += duration
+
+    def server_timing(self) -> str:
+        return 'db;dur={:.2f};desc="{} queries", pool;dur={:.2f}'.format(self.db_time * 1000, self.queries,
+                                                                          self.pool_wait * 1000)
+
+
+request_stats: ContextVar[RequestStats | None] = ContextVar('request_stats', default=None)
+
+
+def get_request_stats() -> RequestStats | None:
+    return request_stats.get()
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording latency and database usage of every request per route"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._route_paths: dict | None = None
+
+    def _route_label(self, scope: Scope) -> str:
+        # the router stores the matched endpoint in the (shared) scope, map it back to the path template
+        if self._route_paths is None:
+            self._route_paths = {getattr(route, 'endpoint', None): route.path for route in scope['app'].routes}
+        return self._route_paths.get(scope.get('endpoint'), 'unmatched')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if settings.SERVER_TIMING_HEADER:
+                    MutableHeaders(scope=message).append('Server-Timing', stats.server_timing())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_stats.reset(token)
+            self._observe(scope, status, elapsed, stats)
+
+    def _observe(self, scope: Scope, status: int, elapsed: float, stats: RequestStats):
+        method, route = scope['method'], self._route_label(scope)
+        REQUEST_LATENCY.labels(method, route, status).observe(elapsed)
+        REQUEST_QUERIES.labels(method, route).observe(stats.queries)
+        REQUEST_DB_TIME.labels(method, route).observe(stats.db_time)
+        REQUEST_POOL_WAIT.labels(method, route).observe(stats.pool_wait)
+        if stats.queries > settings.REQUEST_QUERY_BUDGET or elapsed * 1000 > settings.REQUEST_TIME_BUDGET_MS:
+            logger.warning('%s %s exceeded request budget: %.1f ms, %d queries (%.1f ms in db, %.1f ms pool wait)',
+                           method, route, elapsed * 1000, stats.queries, stats.db_time * 1000,
+                           stats.pool_wait * 1000)
+
+
+def metrics_response() -> Response:
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        # served by several workers (serve.py): merge the metric files written by all of them
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+    # CONTENT_TYPE_LATEST already carries the charset
+    return Response(generate_latest(registry), headers={'Content-Type': CONTENT_TYPE_LATEST})
@@ -1,28 +1,49 @@
-from fastapi import APIRouter, Depends
+from datetime import datetime
+
+from fastapi import APIRouter, Depends, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from auth.dependencies import get_current_user, check_user_status
+from db.connector import get_session
 from db.crud.news import get_news as get_news_db, add_news as add_news_db, get_news_by_id
-from news.schemas import NewsInfo, NewsBase
-from utils import convert_sqlalchemy_row_to_dict, common_error_handler_decorator
+from http_cache import conditional_response
+from news.schemas import NewsInfo, NewsBase, NewsOrdering
+from schemas import Page
+from utils import common_error_handler_decorator, PaginationParams, serialize_page, serialize_row
 
 news_router = APIRouter(tags=["News"], prefix='/news')
 
 
 @news_router.get("/all", dependencies=[Depends(get_current_user)])
-def get_all_news() -> list[NewsInfo]:
+@common_error_handler_decorator
+async def get_all_news(request: Request, page: PaginationParams = Depends(),
+                       ordering: NewsOrdering = NewsOrdering.created_at_desc,
+                       created_from: datetime | None = None, created_to: datetime | None = None,
+                       session: AsyncSession = Depends(get_session)) -> Page[NewsInfo]:
     """Get all news"""
-    return [NewsInfo(id=i.id, title=i.title, content=i.content, created_at=i.created_at) for i in get_news_db()]
+
+    async def render():
+        news = await get_news_db(session, **page.dict(), ordering=ordering.value,
+                                 created_from=created_from, created_to=created_to, schema=NewsInfo)
+        return serialize_page(news, NewsInfo)
+
+    return await conditional_response(request, 'news', render)
 
 
 @news_router.get("/info/{news_id}", dependencies=[Depends(get_current_user)])
 @common_error_handler_decorator
-def get_news_info_by_id(news_id: int) -> NewsInfo:
+async def get_news_info_by_id(request: Request, news_id: int,
+                              session: AsyncSession = Depends(get_session)) -> NewsInfo:
     """Get news info"""
-    return NewsInfo(**convert_sqlalchemy_row_to_dict(get_news_by_id(news_id)))
+
+    async def render():
+        return serialize_row(await get_news_by_id(session, news_id), NewsInfo)
+
+    return await conditional_response(request, 'news', render)
 
 
 @news_router.post("/add", dependencies=[Depends(check_user_status)])
-def add_news(news: NewsBase):
+async def add_news(news: NewsBase, session: AsyncSession = Depends(get_session)):
     """Add new news (required admin rights)"""
-    add_news_db(news.title, news.content)
+    await add_news_db(session, news.title, news.content)
     return {'status': 'success', 'message': 'News added'}
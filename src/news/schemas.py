@@ -1,4 +1,5 @@
 from datetime import datetime
+from enum import Enum
 
 from pydantic import BaseModel
 
@@ -11,3 +12,8 @@ class NewsBase(BaseModel):
 class NewsInfo(NewsBase):
     id: int
     created_at: datetime
+
+
+class NewsOrdering(str, Enum):
+    created_at = 'created_at'
+    created_at_desc = '-created_at'
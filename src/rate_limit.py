@@ -0,0 +1,131 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from fastapi import HTTPException, Request, status
+from redis.exceptions import RedisError
+
+from config import settings
+from shared_cache import RedisScript
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class BucketLimit:
+    """Token bucket of `burst` tokens refilled at `per_minute` tokens a minute, each request takes one token"""
+    burst: int
+    per_minute: float
+
+    @property
+    def rate(self) -> float:
+        return self.per_minute / 60
+
+
+class RateLimitBackend:
+    """Storage of the token buckets"""
+
+    async def take(self, key: str, limit: BucketLimit) -> float:
+        """Take a token, returns 0 when it is granted or the seconds until the bucket has one again"""
+        raise NotImplementedError
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """Buckets of this process (the limits apply per worker), the least recently used are dropped beyond max_keys"""
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        # key -> (tokens, monotonic time of the last update)
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    async def take(self, key: str, limit: BucketLimit) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (limit.burst, now))
+        tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / limit.rate
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+# refill and take atomically on the server clock, a bucket expires once it would be full again
+_take_token = RedisScript("""
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return tostring(wait)
+""")
+
+
+class RedisRateLimitBackend(RateLimitBackend):
+    """Buckets shared by all workers and instances on the shared cache server"""
+
+    def __init__(self, prefix: str = 'rate_limit:'):
+        self._prefix = prefix
+
+    async def take(self, key: str, limit: BucketLimit) -> float:
+        try:
+            return float(await _take_token(keys=[self._prefix + key], args=[limit.burst, limit.rate]))
+        except RedisError:
+            # an unavailable limiter must not lock everybody out of the api
+            logger.warning('Rate limit backend is unavailable, %s is not limited', key, exc_info=True)
+            return 0.0
+
+
+def create_rate_limit_backend() -> RateLimitBackend:
+    if settings.CACHE_BACKEND == 'redis':
+        return RedisRateLimitBackend()
+    return MemoryRateLimitBackend(settings.RATE_LIMIT_MAX_KEYS)
+
+
+rate_limiter = create_rate_limit_backend()
+auth_ip_limit = BucketLimit(settings.RATE_LIMIT_AUTH_IP_BURST, settings.RATE_LIMIT_AUTH_IP_PER_MINUTE)
+auth_email_limit = BucketLimit(settings.RATE_LIMIT_AUTH_EMAIL_BURST, settings.RATE_LIMIT_AUTH_EMAIL_PER_MINUTE)
+
+
+async def _request_email(request: Request) -> str | None:
+    # login sends the email as the OAuth2 form username, register as a json field
+    content_type = request.headers.get('content-type', '')
+    try:
+        if content_type.startswith('application/json'):
+            data = await request.json()
+            email = data.get('email') if isinstance(data, dict) else None
+        elif content_type.startswith(('application/x-www-form-urlencoded', 'multipart/form-data')):
+            email = (await request.form()).get('username')
+        else:
+            return None
+    except ValueError:
+        return None
+    return email.strip().lower() if isinstance(email, str) and email.strip() else None
+
+
+async def limit_auth_requests(request: Request):
+    """Reject auth requests over the per IP or per email limit before any password hashing or db work"""
+    if not settings.RATE_LIMIT_ENABLED:
+        return
+    wait = await rate_limiter.take('auth:ip:{}'.format(request.client.host if request.client else ''), auth_ip_limit)
+    if not wait and (email := await _request_email(request)):
+        wait = await rate_limiter.take('auth:email:{}'.format(email), auth_email_limit)
+    if wait:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail='Too many requests, try again later',
+                            headers={'Retry-After': str(math.ceil(wait))})
@@ -0,0 +1,43 @@
+from enum import Enum
+from typing import Generic, TypeVar
+
+from pydantic import BaseModel, Field
+from pydantic.generics import GenericModel
+
+from config import settings
+
+T = TypeVar('T')
+
+
+class Page(GenericModel, Generic[T]):
+    items: list[T]
+    next_cursor: str | None = Field(default=None, description='Pass as `cursor` to get the next page')
+    total: int | None = Field(default=None, description='Total number of matching items (if requested)')
+
+
+class TimeWindow(str, Enum):
+    upcoming = 'upcoming'
+    ongoing = 'ongoing'
+    past = 'past'
+    between = 'between'
+
+
+class FileFormat(str, Enum):
+    csv = 'csv'
+    ndjson = 'ndjson'
+
+
+class BulkIds(BaseModel):
+    ids: list[int] = Field(min_items=1, max_items=settings.BULK_MAX_ITEMS)
+
+
+class BulkItemResult(BaseModel):
+    id: int
+    status: str
+    message: str | None = None
+
+
+class BulkResult(BaseModel):
+    succeeded: int
+    failed: int
+    results: list[BulkItemResult]
@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from auth.dependencies import get_current_user
+from db.connector import get_session
+from db.crud.search import search as search_db
+from schemas import Page
+from search.schemas import SearchHit, SearchKind
+from utils import common_error_handler_decorator, PaginationParams, serialize_page
+
+search_router = APIRouter(tags=["Search"], prefix='/search')
+
+
+@search_router.get("", dependencies=[Depends(get_current_user)])
+@common_error_handler_decorator
+async def search(q: str = Query(min_length=1, max_length=200, description='Words to look for'),
+                 kind: list[SearchKind] | None = Query(default=None, description='Only search these collections'),
+                 page: PaginationParams = Depends(),
+                 session: AsyncSession = Depends(get_session)) -> Page[SearchHit]:
+    """Search news and tasks by title and text, best matches first"""
+    hits = await search_db(session, q, [item.value for item in kind] if kind else None, **page.dict())
+    return ORJSONResponse(serialize_page(hits, SearchHit))
@@ -0,0 +1,15 @@
+from enum import Enum
+
+from pydantic import BaseModel
+
+
+class SearchKind(str, Enum):
+    news = 'news'
+    tasks = 'tasks'
+
+
+class SearchHit(BaseModel):
+    kind: SearchKind
+    id: int
+    title: str
+    rank: float
@@ -0,0 +1,75 @@
+"""
+Production server: a gunicorn master preloads the app and supervises API_WORKERS uvicorn workers.
+
+    python serve.py
+
+Workers are recycled after API_MAX_REQUESTS (plus a random jitter) requests, and on SIGTERM or recycling
+they stop accepting connections and get API_GRACEFUL_TIMEOUT seconds to finish the requests in flight.
+Several workers need CACHE_BACKEND=redis, so that caches, leaderboard and rate limits are shared.
+Metrics of all workers (recycled ones included) are merged from the files of PROMETHEUS_MULTIPROC_DIR.
+"""
+import glob
+import multiprocessing
+import os
+import sys
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+from config import settings
+
+
+class Server(BaseApplication):
+    def __init__(self, app, options: dict):
+        self.app = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        return self.app
+
+
+def prepare_metrics_directory():
+    # prometheus_client picks its multiprocess mode when it is imported, so this runs before the app is imported
+    directory = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                      os.path.join(tempfile.gettempdir(), 'camp-prometheus'))
+    os.makedirs(directory, exist_ok=True)
+    # metrics of a previous run
+    for path in glob.glob(os.path.join(directory, '*.db')):
+        os.remove(path)
+
+
+def worker_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def main():
+    workers = settings.API_WORKERS or multiprocessing.cpu_count()
+    if workers > 1 and settings.CACHE_BACKEND == 'memory':
+        # every worker would keep its own users, revoked tokens and leaderboard and miss the writes of the others
+        sys.exit('API_WORKERS={} requires CACHE_BACKEND=redis'.format(workers))
+    prepare_metrics_directory()
+    from main import API_PORT, app
+
+    Server(app, {
+        'bind': '{}:{}'.format(settings.API_HOST, API_PORT),
+        'workers': workers,
+        'worker_class': 'uvicorn.workers.UvicornWorker',
+        # import the app once in the master, workers are forked from it (connections are opened in the workers)
+        'preload_app': True,
+        'graceful_timeout': settings.API_GRACEFUL_TIMEOUT,
+        'max_requests': settings.API_MAX_REQUESTS,
+        'max_requests_jitter': settings.API_MAX_REQUESTS_JITTER,
+        'accesslog': '-',
+        'child_exit': worker_exit,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+import heapq
+import itertools
+import pickle
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from redis.asyncio import Redis
+
+from config import settings
+
+
+class TTLCache:
+    """
+    In-process LRU cache whose entries expire after a time-to-live.
+    Without max_size entries are never evicted before they expire (expired ones are dropped as new ones come in).
+    """
+
+    def __init__(self, max_size: int | None, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        # (expiry, insertion number, key) of the unbounded cache
+        self._expiries: list[tuple[float, int, Hashable]] = []
+        self._inserted = itertools.count()
+
+    def get(self, key: Hashable) -> Any | None:
+        if (item := self._data.get(key)) is None:
+            return None
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        expires_at = time.monotonic() + ttl
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        if self.max_size is None:
+            heapq.heappush(self._expiries, (expires_at, next(self._inserted), key))
+            self._drop_expired()
+            return
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def _drop_expired(self):
+        now = time.monotonic()
+        while self._expiries and self._expiries[0][0] <= now:
+            _, _, key = heapq.heappop(self._expiries)
+            # the key may have been set again since
+            if (item := self._data.get(key)) is not None and item[0] <= now:
+                del self._data[key]
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+        self._expiries.clear()
+
+
+_redis: Redis | None = None
+
+
+def get_redis() -> Redis:
+    """Client of the shared cache server, created on first use so that every (forked) worker has its own"""
+    global _redis
+    if _redis is None:
+        _redis = Redis.from_url(settings.CACHE_REDIS_URL)
+    return _redis
+
+
+async def close_redis():
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+
+
+class RedisScript:
+    """Lua script run on the shared cache server, registered again whenever the client is recreated"""
+
+    def __init__(self, source: str):
+        self.source = source
+        self._client: Redis | None = None
+        self._script = None
+
+    async def __call__(self, keys: list, args: list, client=None):
+        """client may be a pipeline of the shared client, the call is then queued"""
+        if self._client is not (redis := get_redis()):
+            self._client, self._script = redis, redis.register_script(self.source)
+        return await self._script(keys=keys, args=args, client=client)
+
+
+class Cache:
+    """Expiring values of one kind (users, responses, ...) keyed by strings"""
+
+    async def get(self, key: str) -> Any | None:
+        raise NotImplementedError
+
+    async def get_many(self, *keys: str) -> list[Any | None]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, ttl: float | None = None):
+        """ttl can only shorten the default time-to-live of the cache"""
+        raise NotImplementedError
+
+    async def delete(self, *keys: str):
+        raise NotImplementedError
+
+
+class MemoryCache(Cache):
+    """Values of this process, only coherent when the api runs a single worker"""
+
+    def __init__(self, max_size: int | None, ttl: float):
+        self._values = TTLCache(max_size, ttl)
+
+    async def get(self, key: str) -> Any | None:
+        return self._values.get(key)
+
+    async def get_many(self, *keys: str) -> list[Any | None]:
+        return [self._values.get(key) for key in keys]
+
+    async def set(self, key: str, value: Any, ttl: float | None = None):
+        self._values.set(key, value, ttl)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._values.pop(key)
+
+
+class RedisCache(Cache):
+    """Values shared by all workers, pickled under the `namespace:` keys of the shared cache server"""
+
+    def __init__(self, namespace: str, ttl: float):
+        self.ttl = ttl
+        self._prefix = namespace + ':'
+
+    async def get(self, key: str) -> Any | None:
+        return _unpickle(await get_redis().get(self._prefix + key))
+
+    async def get_many(self, *keys: str) -> list[Any | None]:
+        return [_unpickle(value) for value in await get_redis().mget([self._prefix + key for key in keys])]
+
+    async def set(self, key: str, value: Any, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        await get_redis().set(self._prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                              px=max(1, int(ttl * 1000)))
+
+    async def delete(self, *keys: str):
+        if keys:
+            await get_redis().delete(*(self._prefix + key for key in keys))
+
+
+def _unpickle(value: bytes | None) -> Any | None:
+    # the server is private to the api, so its values are trusted
+    return None if value is None else pickle.loads(value)
+
+
+def create_cache(namespace: str, max_size: int | None, ttl: float) -> Cache:
+    """max_size bounds the memory backend (least recently used values go first), None keeps values until they expire"""
+    if settings.CACHE_BACKEND == 'redis':
+        return RedisCache(namespace, ttl)
+    return MemoryCache(max_size, ttl)
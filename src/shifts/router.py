@@ -1,66 +1,126 @@
 from datetime import datetime
+from functools import partial
 
-import pytz
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from auth.dependencies import get_current_user, check_user_status
-from db.crud.shifts import get_all_shifts, get_shift_by_id, \
+from db.connector import get_session
+from db.crud.shifts import get_upcoming_shifts as get_upcoming_shifts_db, get_shifts_in_window, get_shift_by_id, \
     add_shift as add_shift_db, get_user_shifts_by_email, \
     approve_shift_reservation as approve_shift_reservation_db, reserve_shift as reserve_shift_db, \
-    get_shifts_reservations
-from shifts.schemas import ShiftInfo, ShiftReservation, BaseShift
+    get_shifts_reservations, approve_shift_reservations as approve_shift_reservations_db, export_shifts_reservations, \
+    cancel_shift_reservation as cancel_shift_reservation_db
+from exports import export_response
+from http_cache import conditional_response
+from schemas import Page, TimeWindow, BulkIds, BulkResult, FileFormat
+from shifts.schemas import ShiftInfo, ShiftReservation, BaseShift, ShiftOrdering, ShiftReservationExport
 from user.schemas import UserInfo
-from utils import convert_sqlalchemy_row_to_dict, common_error_handler_decorator
+from utils import common_error_handler_decorator, PaginationParams, serialize_page, serialize_row, serialize_rows, \
+    bulk_result
 
 shifts_router = APIRouter(tags=["Shifts"], prefix='/shifts')
 
 
 @shifts_router.get("/upcoming", dependencies=[Depends(get_current_user)])
-def get_upcoming_shifts() -> list[ShiftInfo]:
+@common_error_handler_decorator
+async def get_upcoming_shifts(request: Request, page: PaginationParams = Depends(),
+                              ordering: ShiftOrdering = ShiftOrdering.start_date,
+                              session: AsyncSession = Depends(get_session)) -> Page[ShiftInfo]:
     """Get all upcoming shifts"""
-    return [ShiftInfo(**convert_sqlalchemy_row_to_dict(shift)) for shift in get_all_shifts()
-            if shift.start_date > datetime.now(pytz.utc)]
+
+    async def render():
+        shifts = await get_upcoming_shifts_db(session, **page.dict(), ordering=ordering.value)
+        return serialize_page(shifts, ShiftInfo)
+
+    def first_start(content: dict):
+        # the page goes stale once its first shift starts
+        return min((shift['start_date'] for shift in content['items']), default=None)
+
+    return await conditional_response(request, 'shifts', render, expires_at=first_start)
+
+
+@shifts_router.get("/list", dependencies=[Depends(get_current_user)])
+@common_error_handler_decorator
+async def get_shifts_by_time_window(window: TimeWindow = TimeWindow.ongoing,
+                                    start: datetime | None = None, end: datetime | None = None,
+                                    page: PaginationParams = Depends(),
+                                    ordering: ShiftOrdering = ShiftOrdering.start_date,
+                                    session: AsyncSession = Depends(get_session)) -> Page[ShiftInfo]:
+    """Get upcoming, ongoing, past shifts or shifts overlapping the [start, end) period"""
+    shifts = await get_shifts_in_window(session, window.value, start, end, **page.dict(), ordering=ordering.value)
+    return ORJSONResponse(serialize_page(shifts, ShiftInfo))
 
 
 @shifts_router.get("/info/{shift_id}", dependencies=[Depends(get_current_user)])
 @common_error_handler_decorator
-def get_shift_info(shift_id: int) -> ShiftInfo:
+async def get_shift_info(shift_id: int, session: AsyncSession = Depends(get_session)) -> ShiftInfo:
     """Get shift info by id"""
-    return ShiftInfo(**convert_sqlalchemy_row_to_dict(get_shift_by_id(shift_id)))
+    return ORJSONResponse(serialize_row(await get_shift_by_id(session, shift_id), ShiftInfo))
 
 
 @shifts_router.get("/my")
-def get_my_shifts(current_user: UserInfo = Depends(get_current_user)) -> list[ShiftInfo]:
+async def get_my_shifts(current_user: UserInfo = Depends(get_current_user),
+                        session: AsyncSession = Depends(get_session)) -> list[ShiftInfo]:
     """Get shifts for current user"""
-    return [ShiftInfo(**convert_sqlalchemy_row_to_dict(shift)) for shift in
-            get_user_shifts_by_email(current_user.email)]
+    return ORJSONResponse(serialize_rows(await get_user_shifts_by_email(session, current_user.email), ShiftInfo))
 
 
-@shifts_router.get("/reservations")
-def show_shift_reservations() -> list[ShiftReservation]:
+@shifts_router.get("/reservations", dependencies=[Depends(check_user_status)])
+async def show_shift_reservations(session: AsyncSession = Depends(get_session)) -> list[ShiftReservation]:
     """Show all (not approved) shifts reservations (required admin rights)"""
-    return get_shifts_reservations()
+    return await get_shifts_reservations(session)
+
+
+@shifts_router.get("/reservations/export", dependencies=[Depends(check_user_status)])
+async def export_shift_reservations(file_format: FileFormat = Query(default=FileFormat.csv, alias='format'),
+                                    is_approved: bool | None = None, is_waitlisted: bool | None = None,
+                                    shift_id: int | None = None):
+    """Download shift reservations with their users and shifts as CSV or NDJSON (required admin rights)"""
+    return export_response(partial(export_shifts_reservations, is_approved=is_approved, is_waitlisted=is_waitlisted,
+                                   shift_id=shift_id),
+                           list(ShiftReservationExport.__fields__), file_format.value, 'shift_reservations')
 
 
 @shifts_router.post("/add", dependencies=[Depends(check_user_status)])
 @common_error_handler_decorator
-def add_shift(shift: BaseShift):
+async def add_shift(shift: BaseShift, session: AsyncSession = Depends(get_session)):
     """Add new shift (required admin rights)"""
-    add_shift_db(**shift.dict())
+    await add_shift_db(session, **shift.dict())
     return {'status': 'success', 'message': 'Shift added'}
 
 
 @shifts_router.post("/reserve/{shift_id}")
 @common_error_handler_decorator
-def reserve_shift(shift_id: int, current_user: UserInfo = Depends(get_current_user)):
-    """Reserve shift """
-    reserve_shift_db(shift_id=shift_id, user_email=current_user.email)
+async def reserve_shift(shift_id: int, current_user: UserInfo = Depends(get_current_user),
+                        session: AsyncSession = Depends(get_session)):
+    """Reserve shift (joins the waitlist when the shift is full)"""
+    if position := await reserve_shift_db(session, shift_id=shift_id, user_email=current_user.email):
+        return {'status': 'success', 'message': 'Shift is full, reservation is number {} on the waitlist'.format(
+            position), 'waitlist_position': position}
     return {'status': 'success', 'message': 'Shift reservation sent for approval'}
 
 
+@shifts_router.delete("/reserve/{shift_id}")
+@common_error_handler_decorator
+async def cancel_shift_reservation(shift_id: int, current_user: UserInfo = Depends(get_current_user),
+                                   session: AsyncSession = Depends(get_session)):
+    """Cancel own shift reservation (the place goes to the first camper on the waitlist)"""
+    await cancel_shift_reservation_db(session, shift_id=shift_id, user_email=current_user.email)
+    return {'status': 'success', 'message': 'Shift reservation cancelled'}
+
+
 @shifts_router.put("/approve/{shift_reservation_id}", dependencies=[Depends(check_user_status)])
 @common_error_handler_decorator
-def approve_shift_reservation(shift_reservation_id: int, ):
+async def approve_shift_reservation(shift_reservation_id: int, session: AsyncSession = Depends(get_session)):
     """Approve shift reservation (required admin rights)"""
-    approve_shift_reservation_db(shift_reservation_id=shift_reservation_id)
+    await approve_shift_reservation_db(session, shift_reservation_id=shift_reservation_id)
     return {'status': 'success', 'message': 'Shift reservation approved'}
+
+
+@shifts_router.put("/bulk/approve", dependencies=[Depends(check_user_status)])
+@common_error_handler_decorator
+async def approve_shift_reservations(bulk: BulkIds, session: AsyncSession = Depends(get_session)) -> BulkResult:
+    """Approve many shift reservations at once (required admin rights)"""
+    return bulk_result(bulk.ids, await approve_shift_reservations_db(session, bulk.ids))
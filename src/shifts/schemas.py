@@ -1,6 +1,7 @@
 from datetime import datetime
+from enum import Enum
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from user.schemas import UserInfo
 
@@ -11,11 +12,13 @@ class BaseShift(BaseModel):
     description: str
     start_date: datetime
     end_date: datetime
+    capacity: int | None = Field(default=None, ge=1, description='Max number of campers, unlimited when empty')
 
 
 class ShiftInfo(BaseShift):
     id: int
     participants_number: int
+    reserved_number: int = Field(default=0, description='Reservations holding a place (the rest are waitlisted)')
 
 
 class ShiftReservation(BaseModel):
@@ -23,3 +26,24 @@ class ShiftReservation(BaseModel):
     user_info: UserInfo
     shift_info: ShiftInfo
     is_approved: bool
+    is_waitlisted: bool = False
+
+
+class ShiftReservationExport(BaseModel):
+    id: int
+    is_approved: bool
+    is_waitlisted: bool
+    created_at: datetime
+    user_email: str
+    username: str
+    first_name: str
+    last_name: str
+    shift_id: int
+    shift_name: str
+    shift_start_date: datetime
+    shift_end_date: datetime
+
+
+class ShiftOrdering(str, Enum):
+    start_date = 'start_date'
+    start_date_desc = '-start_date'
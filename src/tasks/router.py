@@ -1,93 +1,171 @@
-from fastapi import APIRouter, Depends
+from datetime import datetime
+from functools import partial
+
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from auth.dependencies import get_current_user, check_user_status
+from db.connector import get_session
 from db.crud.tasks import get_user_tasks_by_email, get_task_by_id, \
     get_all_active_tasks as get_all_active_tasks_db, \
     response_to_task as response_to_task_db, approve_task_response as approve_task_response_db, \
     get_all_not_approved_tasks_responses, submit_task as submit_task_db, \
     check_task as check_task_db, add_task as add_task_db, get_all_tasks as get_all_tasks_db, \
-    get_all_not_checked_tasks_responses
-from tasks.schemas import TaskInfo, TaskResponse, BaseTask, TaskAnswer
+    get_all_not_checked_tasks_responses, get_tasks_in_window, approve_task_responses as approve_task_responses_db, \
+    check_tasks as check_tasks_db, export_tasks_responses
+from exports import export_response
+from http_cache import conditional_response
+from schemas import Page, TimeWindow, BulkIds, BulkResult, FileFormat
+from tasks.schemas import TaskInfo, TaskResponse, BaseTask, TaskAnswer, TaskOrdering, TaskResponseOrdering, \
+    TaskResponseStage
 from user.schemas import UserInfo
-from utils import convert_sqlalchemy_row_to_dict, common_error_handler_decorator
+from utils import common_error_handler_decorator, PaginationParams, serialize_page, serialize_row, serialize_rows, \
+    bulk_result
 
 tasks_router = APIRouter(tags=["Tasks"], prefix='/tasks')
 
 
 @tasks_router.get("/my")
-def get_my_tasks(current_user: UserInfo = Depends(get_current_user)) -> list[TaskInfo]:
+async def get_my_tasks(current_user: UserInfo = Depends(get_current_user),
+                       session: AsyncSession = Depends(get_session)) -> list[TaskInfo]:
     """Get tasks for current user"""
-    return [TaskInfo(**convert_sqlalchemy_row_to_dict(task)) for task in get_user_tasks_by_email(current_user.email)]
+    return ORJSONResponse(serialize_rows(await get_user_tasks_by_email(session, current_user.email), TaskInfo))
 
 
 @tasks_router.get('/all', dependencies=[Depends(check_user_status)])
-def get_all_tasks() -> list[TaskInfo]:
+@common_error_handler_decorator
+async def get_all_tasks(page: PaginationParams = Depends(), ordering: TaskOrdering = TaskOrdering.start_date,
+                        is_active: bool | None = None, author_email: str | None = None,
+                        session: AsyncSession = Depends(get_session)) -> Page[TaskInfo]:
     """Get all tasks (by admin)"""
-    return [TaskInfo(**convert_sqlalchemy_row_to_dict(task)) for task in get_all_tasks_db()]
+    tasks = await get_all_tasks_db(session, **page.dict(), ordering=ordering.value,
+                                   is_active=is_active, author_email=author_email, schema=TaskInfo)
+    return ORJSONResponse(serialize_page(tasks, TaskInfo))
 
 
 @tasks_router.get('/active', dependencies=[Depends(get_current_user)])
-def get_all_active_tasks() -> list[TaskInfo]:
+@common_error_handler_decorator
+async def get_all_active_tasks(request: Request, page: PaginationParams = Depends(),
+                               ordering: TaskOrdering = TaskOrdering.start_date,
+                               session: AsyncSession = Depends(get_session)) -> Page[TaskInfo]:
     """Get all active tasks"""
-    return [TaskInfo(**convert_sqlalchemy_row_to_dict(task)) for task in get_all_active_tasks_db()]
+
+    async def render():
+        tasks = await get_all_active_tasks_db(session, **page.dict(), ordering=ordering.value)
+        return serialize_page(tasks, TaskInfo)
+
+    # the task scheduler bumps the tasks version whenever a task starts or ends
+    return await conditional_response(request, 'tasks', render)
+
+
+@tasks_router.get('/list', dependencies=[Depends(get_current_user)])
+@common_error_handler_decorator
+async def get_tasks_by_time_window(window: TimeWindow = TimeWindow.ongoing,
+                                   start: datetime | None = None, end: datetime | None = None,
+                                   page: PaginationParams = Depends(), ordering: TaskOrdering = TaskOrdering.start_date,
+                                   session: AsyncSession = Depends(get_session)) -> Page[TaskInfo]:
+    """Get upcoming, ongoing, past tasks or tasks overlapping the [start, end) period"""
+    tasks = await get_tasks_in_window(session, window.value, start, end, **page.dict(), ordering=ordering.value)
+    return ORJSONResponse(serialize_page(tasks, TaskInfo))
 
 
 @tasks_router.get("/response/list/for_approval", dependencies=[Depends(check_user_status)])
-def get_not_approved_responses() -> list[TaskResponse]:
+@common_error_handler_decorator
+async def get_not_approved_responses(page: PaginationParams = Depends(),
+                                     ordering: TaskResponseOrdering = TaskResponseOrdering.response_time,
+                                     task_id: int | None = None, user_email: str | None = None,
+                                     session: AsyncSession = Depends(get_session)) -> Page[TaskResponse]:
     """Get all not approved responses (by admin)"""
-    return [TaskResponse(**convert_sqlalchemy_row_to_dict(response)) for response in
-            get_all_not_approved_tasks_responses()]
+    responses = await get_all_not_approved_tasks_responses(session, **page.dict(), ordering=ordering.value,
+                                                           task_id=task_id, user_email=user_email,
+                                                           schema=TaskResponse)
+    return ORJSONResponse(serialize_page(responses, TaskResponse))
+
+
+@tasks_router.get("/response/export/{stage}", dependencies=[Depends(check_user_status)])
+async def export_responses(stage: TaskResponseStage,
+                           file_format: FileFormat = Query(default=FileFormat.csv, alias='format'),
+                           ordering: TaskResponseOrdering = TaskResponseOrdering.response_time,
+                           task_id: int | None = None, user_email: str | None = None):
+    """Download responses waiting for approval or check as CSV or NDJSON (by admin)"""
+    return export_response(partial(export_tasks_responses, schema=TaskResponse, stage=stage.value,
+                                   ordering=ordering.value, task_id=task_id, user_email=user_email),
+                           list(TaskResponse.__fields__), file_format.value, 'responses_{}'.format(stage.value))
 
 
 @tasks_router.get('/{task_id}', dependencies=[Depends(get_current_user)])
 @common_error_handler_decorator
-def get_task(task_id: int) -> TaskInfo:
+async def get_task(task_id: int, session: AsyncSession = Depends(get_session)) -> TaskInfo:
     """Get task by id"""
-    return TaskInfo(**convert_sqlalchemy_row_to_dict(get_task_by_id(task_id)))
+    return ORJSONResponse(serialize_row(await get_task_by_id(session, task_id), TaskInfo))
 
 
 @tasks_router.get("/response/list/for_check", dependencies=[Depends(check_user_status)])
-def get_not_checked_responses() -> list[TaskResponse]:
+@common_error_handler_decorator
+async def get_not_checked_responses(page: PaginationParams = Depends(),
+                                    ordering: TaskResponseOrdering = TaskResponseOrdering.response_time,
+                                    task_id: int | None = None, user_email: str | None = None,
+                                    session: AsyncSession = Depends(get_session)) -> Page[TaskResponse]:
     """Get all not approved responses (by admin)"""
-    return [TaskResponse(**convert_sqlalchemy_row_to_dict(response)) for response in
-            get_all_not_checked_tasks_responses()]
+    responses = await get_all_not_checked_tasks_responses(session, **page.dict(), ordering=ordering.value,
+                                                          task_id=task_id, user_email=user_email,
+                                                          schema=TaskResponse)
+    return ORJSONResponse(serialize_page(responses, TaskResponse))
 
 
 @tasks_router.post('/add')
 @common_error_handler_decorator
-def add_task(task: BaseTask, current_user: UserInfo = Depends(check_user_status)):
+async def add_task(task: BaseTask, current_user: UserInfo = Depends(check_user_status),
+                   session: AsyncSession = Depends(get_session)):
     """Add new task (by admin)"""
-    add_task_db(**task.dict(), author_email=current_user.email)
+    await add_task_db(session, **task.dict(), author_email=current_user.email)
     return {'status': 'success', 'message': 'Task added'}
 
 
 @tasks_router.post('/response/{task_id}')
 @common_error_handler_decorator
-def response_to_task(task_id: int, current_user: UserInfo = Depends(get_current_user)):
+async def response_to_task(task_id: int, current_user: UserInfo = Depends(get_current_user),
+                           session: AsyncSession = Depends(get_session)):
     """Respond to task (by user)"""
-    response_to_task_db(task_id, current_user.id)
+    await response_to_task_db(session, task_id, current_user.id)
     return {'status': 'success', 'message': 'Task response sent'}
 
 
 @tasks_router.put('/response/approve/{task_response_id}', dependencies=[Depends(check_user_status)])
 @common_error_handler_decorator
-def approve_response(task_response_id: int):
+async def approve_response(task_response_id: int, session: AsyncSession = Depends(get_session)):
     """Approve user task response (by admin)"""
-    approve_task_response_db(task_response_id)
+    await approve_task_response_db(session, task_response_id)
     return {'status': 'success', 'message': 'Task response approved'}
 
 
+@tasks_router.put('/response/bulk/approve', dependencies=[Depends(check_user_status)])
+@common_error_handler_decorator
+async def approve_responses(bulk: BulkIds, session: AsyncSession = Depends(get_session)) -> BulkResult:
+    """Approve many user task responses at once (by admin)"""
+    return bulk_result(bulk.ids, await approve_task_responses_db(session, bulk.ids))
+
+
 @tasks_router.put('/submit/{task_id}')
 @common_error_handler_decorator
-def submit_task(task_id: int, task_answer: TaskAnswer, current_user: UserInfo = Depends(get_current_user)):
+async def submit_task(task_id: int, task_answer: TaskAnswer, current_user: UserInfo = Depends(get_current_user),
+                      session: AsyncSession = Depends(get_session)):
     """Submit task (by user)"""
-    submit_task_db(current_user.email, task_id, task_answer.answer)
+    await submit_task_db(session, current_user.email, task_id, task_answer.answer)
     return {'status': 'success', 'message': 'Task submitted'}
 
 
-@tasks_router.put('/check/{task_response_id}', dependencies=[Depends(get_current_user)])
+@tasks_router.put('/check/{task_response_id}', dependencies=[Depends(check_user_status)])
 @common_error_handler_decorator
-def check_task(task_response_id: int):
+async def check_task(task_response_id: int, session: AsyncSession = Depends(get_session)):
     """Check task (by admin)"""
-    check_task_db(task_response_id)
+    await check_task_db(session, task_response_id)
     return {'status': 'success', 'message': 'Task checked'}
+
+
+@tasks_router.put('/bulk/check', dependencies=[Depends(check_user_status)])
+@common_error_handler_decorator
+async def check_tasks(bulk: BulkIds, session: AsyncSession = Depends(get_session)) -> BulkResult:
+    """Check many tasks at once (by admin)"""
+    return bulk_result(bulk.ids, await check_tasks_db(session, bulk.ids))
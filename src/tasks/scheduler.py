@@ -0,0 +1,108 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime
+
+import pytz
+from sqlalchemy import select, update, and_, or_
+
+from db.connector import get_db
+from db.models import Task
+from http_cache import collection_versions
+
+logger = logging.getLogger(__name__)
+
+# upper bound of a single sleep, so clock jumps and missed wakeups heal by themselves
+MAX_SLEEP_SECONDS = 60
+RETRY_DELAY_SECONDS = 5
+
+
+def _is_active_expression(now: datetime):
+    return and_(Task.start_date <= now, Task.end_date > now)
+
+
+class TaskLifecycleScheduler:
+    """
+    Keeps Task.is_active in sync with task start/end dates.
+    Upcoming start/end boundaries are kept in a heap; when a boundary passes, the affected tasks
+    are flipped with a single UPDATE, so reads of active tasks never have to recompute the flag.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[datetime, int]] = []
+        self._wakeup = asyncio.Event()
+        self._worker: asyncio.Task | None = None
+
+    def schedule(self, task_id: int, start_date: datetime, end_date: datetime):
+        now = datetime.now(pytz.utc)
+        for boundary in (start_date, end_date):
+            if boundary > now:
+                heapq.heappush(self._heap, (boundary, task_id))
+        self._wakeup.set()
+
+    def unschedule(self, task_id: int):
+        self._heap = [item for item in self._heap if item[1] != task_id]
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+
+    async def start(self):
+        now = datetime.now(pytz.utc)
+        async with get_db() as session:
+            # bring every flag up to date once, then only touch tasks whose boundary passes
+            await session.execute(update(Task).where(
+                Task.is_active != _is_active_expression(now)).values(
+                is_active=_is_active_expression(now)).execution_options(synchronize_session=False))
+            await session.commit()
+            await collection_versions.bump('tasks')
+            boundaries = await session.execute(select(Task.id, Task.start_date, Task.end_date).where(
+                or_(Task.start_date > now, Task.end_date > now)))
+        self._heap = []
+        for task_id, start_date, end_date in boundaries:
+            self.schedule(task_id, start_date, end_date)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    def _pop_due(self, now: datetime) -> set[int]:
+        due = set()
+        while self._heap and self._heap[0][0] <= now:
+            due.add(heapq.heappop(self._heap)[1])
+        return due
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = MAX_SLEEP_SECONDS
+            if self._heap:
+                timeout = min(timeout, max((self._heap[0][0] - datetime.now(pytz.utc)).total_seconds(), 0))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            now = datetime.now(pytz.utc)
+            if not (due := self._pop_due(now)):
+                continue
+            try:
+                await self._flip(due, now)
+            except Exception:
+                logger.exception('Failed to update active status of tasks %s', sorted(due))
+                for task_id in due:
+                    heapq.heappush(self._heap, (now, task_id))
+                await asyncio.sleep(RETRY_DELAY_SECONDS)
+
+    async def _flip(self, task_ids: set[int], now: datetime):
+        async with get_db() as session:
+            await session.execute(update(Task).where(Task.id.in_(task_ids)).values(
+                is_active=_is_active_expression(now)).execution_options(synchronize_session=False))
+            await session.commit()
+        await collection_versions.bump('tasks')
+
+
+task_scheduler = TaskLifecycleScheduler()
@@ -1,4 +1,5 @@
 from datetime import datetime
+from enum import Enum
 
 from pydantic import BaseModel, Field
 
@@ -30,3 +31,20 @@ class TaskResponse(BaseModel):
     is_approved: bool
     is_completed: bool
     is_checked: bool
+
+
+class TaskOrdering(str, Enum):
+    start_date = 'start_date'
+    start_date_desc = '-start_date'
+    end_date = 'end_date'
+    end_date_desc = '-end_date'
+
+
+class TaskResponseOrdering(str, Enum):
+    response_time = 'response_time'
+    response_time_desc = '-response_time'
+
+
+class TaskResponseStage(str, Enum):
+    for_approval = 'for_approval'
+    for_check = 'for_check'
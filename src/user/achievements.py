@@ -0,0 +1,104 @@
+from collections import Counter, defaultdict
+from dataclasses import dataclass, asdict
+from typing import Iterable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from db.connector import get_db
+from db.crud.achievements import add_to_counters, award_achievements, add_achievements, get_achievement_rules
+
+# user counters, each domain event adds to some of them
+TASKS_SUBMITTED = 'tasks_submitted'
+TASKS_CHECKED = 'tasks_checked'
+POINTS_EARNED = 'points_earned'
+SHIFTS_APPROVED = 'shifts_approved'
+
+# achievements earned in the transaction of a session, awarded once it is committed
+_PENDING_AWARDS = 'achievement_awards'
+
+
+@dataclass(frozen=True)
+class AchievementRule:
+    """Awarded once the user counter reaches the threshold"""
+    code: str
+    name: str
+    description: str
+    counter: str
+    threshold: int
+
+
+# catalogue added to the achievements table at startup, rules already there are kept as they are
+ACHIEVEMENT_RULES = [
+    AchievementRule('first_answer', 'First answer', 'Submit an answer to a task', TASKS_SUBMITTED, 1),
+    AchievementRule('diligent', 'Diligent', 'Submit answers to 10 tasks', TASKS_SUBMITTED, 10),
+    AchievementRule('first_success', 'First success', 'Get a task checked', TASKS_CHECKED, 1),
+    AchievementRule('achiever', 'Achiever', 'Get 10 tasks checked', TASKS_CHECKED, 10),
+    AchievementRule('veteran', 'Veteran', 'Get 50 tasks checked', TASKS_CHECKED, 50),
+    AchievementRule('rising_star', 'Rising star', 'Earn 100 points for tasks', POINTS_EARNED, 100),
+    AchievementRule('champion', 'Champion', 'Earn 1000 points for tasks', POINTS_EARNED, 1000),
+    AchievementRule('camper', 'Camper', 'Get a shift reservation approved', SHIFTS_APPROVED, 1),
+    AchievementRule('old_timer', 'Old-timer', 'Get 3 shift reservations approved', SHIFTS_APPROVED, 3),
+]
+
+
+def task_submitted(user_email: str) -> Counter:
+    return Counter({(user_email, TASKS_SUBMITTED): 1})
+
+
+def tasks_checked(checked: Iterable[tuple[str, int]]) -> Counter:
+    """(user email, task points) of every checked task response"""
+    amounts = Counter()
+    for user_email, points in checked:
+        amounts[user_email, TASKS_CHECKED] += 1
+        amounts[user_email, POINTS_EARNED] += points or 0
+    return amounts
+
+
+def shift_reservations_approved(user_emails: Iterable[str]) -> Counter:
+    return Counter((user_email, SHIFTS_APPROVED) for user_email in user_emails)
+
+
+class AchievementEngine:
+    """
+    Awards achievements from domain events. An event adds to counters of its user inside the transaction of the
+    change (one upsert for all events of the transaction), and only the rules of those counters are evaluated,
+    on the totals returned by the upsert. Achievements whose threshold was crossed are awarded in one batch
+    after the change is committed.
+    """
+
+    def __init__(self, rules: list[AchievementRule]):
+        self.rules = rules
+        # counter -> (threshold, achievement id)
+        self._thresholds: defaultdict[str, list[tuple[int, int]]] = defaultdict(list)
+
+    async def load(self):
+        async with get_db() as session:
+            await add_achievements(session, (asdict(rule) for rule in self.rules))
+            self._thresholds.clear()
+            for achievement_id, counter, threshold in await get_achievement_rules(session):
+                self._thresholds[counter].append((threshold, achievement_id))
+
+    async def record(self, session: AsyncSession, amounts: Counter):
+        """Add the amounts of the events to the user counters, call before the change is committed"""
+        totals = await add_to_counters(session, {key: amount for key, amount in amounts.items() if amount})
+        awards = session.info.setdefault(_PENDING_AWARDS, set())
+        for (user_email, counter), total in totals.items():
+            previous = total - amounts[user_email, counter]
+            awards.update((user_email, achievement_id) for threshold, achievement_id in self._thresholds[counter]
+                          if previous < threshold <= total)
+
+    async def award(self, session: AsyncSession):
+        """Award what the committed transaction earned, call after the commit"""
+        if awards := session.info.pop(_PENDING_AWARDS, None):
+            await award_achievements(session, awards)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_awards(session: Session):
+    # the counters were rolled back, so nothing was earned
+    session.info.pop(_PENDING_AWARDS, None)
+
+
+achievement_engine = AchievementEngine(ACHIEVEMENT_RULES)
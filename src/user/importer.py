@@ -0,0 +1,155 @@
+import codecs
+import csv
+from collections import deque
+from typing import AsyncIterator
+
+import orjson
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from auth.hashing import password_hasher, PasswordHashingOverloadedError
+from config import settings
+from db.crud.users import get_registered_emails, add_new_users
+from user.schemas import UserImport
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    # decode the upload as it arrives, a line may span several chunks
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    tail = ''
+    async for chunk in chunks:
+        *lines, tail = (tail + decoder.decode(chunk)).split('\n')
+        for line in lines:
+            yield line.rstrip('\r')
+    if tail := (tail + decoder.decode(b'', final=True)).rstrip('\r'):
+        yield tail
+
+
+class _PendingLines:
+    """Lines read by the csv reader, a record is added once all of its lines arrived"""
+
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+
+async def _csv_rows(lines: AsyncIterator[str]) -> AsyncIterator[list[str]]:
+    # one reader for the whole upload, so a quoted value may hold line breaks
+    pending = _PendingLines()
+    reader = csv.reader(pending)
+    quoted = False
+    async for line in lines:
+        pending.lines.append(line + '\n')
+        # an odd number of quotes opens (or closes) a quoted value going on in the next line
+        quoted ^= line.count('"') % 2 == 1
+        if not quoted:
+            for values in reader:
+                yield values
+    # a quoted value left open at the end of the upload
+    for values in reader:
+        yield values
+
+
+async def _csv_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict | str]]:
+    # the first record holds the column names
+    header = None
+    row = 0
+    async for values in _csv_rows(lines):
+        if not ''.join(values).strip():
+            continue
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        row += 1
+        if len(values) != len(header):
+            yield row, 'Expected {} columns, got {}'.format(len(header), len(values))
+        else:
+            yield row, dict(zip(header, values))
+
+
+async def _ndjson_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict | str]]:
+    row = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        row += 1
+        try:
+            record = orjson.loads(line)
+        except orjson.JSONDecodeError as e:
+            yield row, 'Invalid JSON: {}'.format(e)
+            continue
+        yield row, record if isinstance(record, dict) else 'Expected a JSON object'
+
+
+RECORD_READERS = {
+    'csv': _csv_records,
+    'ndjson': _ndjson_records,
+}
+
+
+def _validation_message(error: ValidationError) -> str:
+    return '; '.join('{}: {}'.format('.'.join(map(str, e['loc'])), e['msg']) for e in error.errors())
+
+
+async def _import_batch(session: AsyncSession, batch: list[tuple[int, UserImport]], errors: list[dict]) -> int:
+    # one query for the whole batch instead of a duplicate check per user
+    registered = await get_registered_emails(session, (user.email for _, user in batch))
+    new_users = []
+    for row, user in batch:
+        if user.email in registered:
+            errors.append({'row': row, 'email': user.email, 'message': 'Email is already registered'})
+        else:
+            new_users.append((row, user))
+    if not new_users:
+        return 0
+    try:
+        hashed_passwords = await password_hasher.hash_many([user.password for _, user in new_users])
+    except PasswordHashingOverloadedError:
+        # logins and registrations come first, the rows of the batch are not imported
+        errors.extend({'row': row, 'email': user.email, 'message': 'Server is busy, import the row again later'}
+                      for row, user in new_users)
+        return 0
+    inserted = {user.email for user in await add_new_users(session, [
+        dict(first_name=user.first_name, last_name=user.last_name, username=user.username, email=user.email,
+             hashed_password=hashed_password)
+        for (_, user), hashed_password in zip(new_users, hashed_passwords)])}
+    # registered by someone else between the check and the insert
+    errors.extend({'row': row, 'email': user.email, 'message': 'Email is already registered'}
+                  for row, user in new_users if user.email not in inserted)
+    return len(inserted)
+
+
+async def import_users(session: AsyncSession, chunks: AsyncIterator[bytes], file_format: str) -> dict:
+    """Create users from a streamed CSV or NDJSON upload, returns the number of imported users and per-row errors"""
+    imported = 0
+    errors = []
+    emails = set()
+    batch = []
+    async for row, record in RECORD_READERS[file_format](_lines(chunks)):
+        if isinstance(record, str):
+            errors.append({'row': row, 'email': None, 'message': record})
+            continue
+        try:
+            user = UserImport.parse_obj(record)
+        except ValidationError as e:
+            errors.append({'row': row, 'email': record.get('email'), 'message': _validation_message(e)})
+            continue
+        if user.email in emails:
+            errors.append({'row': row, 'email': user.email, 'message': 'Email is repeated in the upload'})
+            continue
+        emails.add(user.email)
+        batch.append((row, user))
+        if len(batch) >= settings.USER_IMPORT_BATCH_SIZE:
+            imported += await _import_batch(session, batch, errors)
+            batch = []
+    if batch:
+        imported += await _import_batch(session, batch, errors)
+    errors.sort(key=lambda error: error['row'])
+    return {'imported': imported, 'failed': len(errors), 'errors': errors}
@@ -0,0 +1,279 @@
+from typing import Iterable
+
+import orjson
+from sortedcontainers import SortedList
+from sqlalchemy import select
+
+from config import settings
+from db.connector import get_db
+from db.models import User
+from shared_cache import RedisScript, get_redis
+
+# users loaded and sent to the shared cache server together
+LOAD_BATCH_SIZE = 1000
+
+
+class Leaderboard:
+    """
+    In-memory ranking of campers by points (ties broken by user id).
+    Seeded once from the database at startup and then kept up to date by the crud functions
+    that change points or users, so every operation is O(log n) and never sorts the users table.
+    """
+
+    def __init__(self):
+        # (-points, user id) so that the best camper comes first
+        self._ranking = SortedList()
+        # email -> (-points, user id)
+        self._keys: dict[str, tuple[int, int]] = {}
+        # user id -> (email, username)
+        self._profiles: dict[int, tuple[str, str]] = {}
+
+    async def load(self):
+        async with get_db() as session:
+            users = await session.execute(
+                select(User.id, User.email, User.username, User.points).filter_by(is_admin=False))
+            self._ranking.clear()
+            self._keys.clear()
+            self._profiles.clear()
+            for user_id, email, username, points in users:
+                self._add(user_id, email, username, points)
+
+    def _add(self, user_id: int, email: str, username: str, points: int | None):
+        self._remove(email)
+        key = (-(points or 0), user_id)
+        self._ranking.add(key)
+        self._keys[email] = key
+        self._profiles[user_id] = (email, username)
+
+    def _remove(self, email: str):
+        if (key := self._keys.pop(email, None)) is not None:
+            self._ranking.remove(key)
+            del self._profiles[key[1]]
+
+    async def add(self, user_id: int, email: str, username: str, points: int | None = 0):
+        self._add(user_id, email, username, points)
+
+    async def add_many(self, users: Iterable[tuple[int, str, str, int | None]]):
+        """Add (user id, email, username, points) of several users"""
+        for user in users:
+            self._add(*user)
+
+    async def remove(self, email: str):
+        self._remove(email)
+
+    async def set_points(self, email: str, points: int):
+        await self.set_points_many({email: points})
+
+    async def set_points_many(self, points: dict[str, int]):
+        for email, user_points in points.items():
+            if (key := self._keys.get(email)) is None:
+                continue
+            self._ranking.remove(key)
+            self._keys[email] = (-user_points, key[1])
+            self._ranking.add(self._keys[email])
+
+    async def set_username(self, email: str, username: str):
+        if (key := self._keys.get(email)) is not None:
+            self._profiles[key[1]] = (email, username)
+
+    def _entry(self, rank: int, key: tuple[int, int]) -> dict:
+        # campers see each other by username, emails stay private
+        _, username = self._profiles[key[1]]
+        return {'rank': rank, 'id': key[1], 'username': username, 'points': -key[0]}
+
+    def _slice(self, start: int, stop: int) -> list[dict]:
+        start = max(start, 0)
+        return [self._entry(start + offset + 1, key) for offset, key in enumerate(self._ranking.islice(start, stop))]
+
+    async def top(self, limit: int) -> list[dict]:
+        return self._slice(0, limit)
+
+    def _key_of(self, user_id: int) -> tuple[int, int] | None:
+        if (profile := self._profiles.get(user_id)) is None:
+            return None
+        return self._keys[profile[0]]
+
+    async def rank_of(self, user_id: int) -> dict | None:
+        if (key := self._key_of(user_id)) is None:
+            return None
+        return self._entry(self._ranking.index(key) + 1, key)
+
+    async def around(self, user_id: int, radius: int) -> list[dict] | None:
+        if (key := self._key_of(user_id)) is None:
+            return None
+        position = self._ranking.index(key)
+        return self._slice(position - radius, position + radius + 1)
+
+    def __len__(self):
+        return len(self._ranking)
+
+
+# KEYS: ranking, ids, profiles; ARGV: (member, email, profile, score) of every user
+_add_users = RedisScript("""
+for i = 1, #ARGV, 4 do
+    local previous = redis.call('HGET', KEYS[2], ARGV[i + 1])
+    if previous then
+        redis.call('ZREM', KEYS[1], previous)
+        redis.call('HDEL', KEYS[3], previous)
+    end
+    redis.call('ZADD', KEYS[1], ARGV[i + 3], ARGV[i])
+    redis.call('HSET', KEYS[2], ARGV[i + 1], ARGV[i])
+    redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 2])
+end
+""")
+# KEYS: ranking, ids, profiles; ARGV: email
+_remove_user = RedisScript("""
+local member = redis.call('HGET', KEYS[2], ARGV[1])
+if member then
+    redis.call('ZREM', KEYS[1], member)
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('HDEL', KEYS[3], member)
+end
+""")
+# KEYS: ranking, ids; ARGV: (email, score) of every user
+_set_scores = RedisScript("""
+for i = 1, #ARGV, 2 do
+    local member = redis.call('HGET', KEYS[2], ARGV[i])
+    if member then
+        redis.call('ZADD', KEYS[1], ARGV[i + 1], member)
+    end
+end
+""")
+# KEYS: ids, profiles; ARGV: email, profile
+_set_profile = RedisScript("""
+local member = redis.call('HGET', KEYS[1], ARGV[1])
+if member then
+    redis.call('HSET', KEYS[2], member, ARGV[2])
+end
+""")
+# KEYS: ranking, profiles; ARGV: member (empty for the top), ranks before and after it
+# returns the first position followed by (score, profile) of every entry, nil for an unknown member
+_window = RedisScript("""
+local start = 0
+local stop = tonumber(ARGV[3])
+if ARGV[1] ~= '' then
+    local rank = redis.call('ZRANK', KEYS[1], ARGV[1])
+    if not rank then
+        return false
+    end
+    start = math.max(rank - tonumber(ARGV[2]), 0)
+    stop = rank + tonumber(ARGV[3])
+end
+local result = {start}
+local members = redis.call('ZRANGE', KEYS[1], start, stop, 'WITHSCORES')
+for i = 1, #members, 2 do
+    result[#result + 1] = members[i + 1]
+    result[#result + 1] = redis.call('HGET', KEYS[2], members[i])
+end
+return result
+""")
+
+
+class RedisLeaderboard:
+    """
+    The same ranking kept on the shared cache server, so that every worker serves and updates one leaderboard.
+    Users are members of a sorted set scored by -points, their zero-padded ids make ties sort by id.
+    """
+
+    def __init__(self, prefix: str = 'leaderboard:'):
+        self._ranking = prefix + 'ranking'
+        # email -> member
+        self._ids = prefix + 'ids'
+        # member -> json [user id, email, username]
+        self._profiles = prefix + 'profiles'
+        self._ready = prefix + 'ready'
+        self._loading = prefix + 'loading'
+
+    @staticmethod
+    def _member(user_id: int) -> str:
+        return '{:012d}'.format(user_id)
+
+    @staticmethod
+    def _profile(user_id: int, email: str, username: str) -> bytes:
+        return orjson.dumps([user_id, email, username])
+
+    async def load(self):
+        redis = get_redis()
+        # the first worker to start builds the ranking, the others (and recycled workers) keep using it
+        if await redis.exists(self._ready) or not await redis.set(self._loading, 1, nx=True, ex=300):
+            return
+        keys = (self._ranking, self._ids, self._profiles)
+        ranking, ids, profiles = building = tuple(key + ':building' for key in keys)
+        try:
+            await redis.delete(*building)
+            async with get_db() as session:
+                users = await session.stream(
+                    select(User.id, User.email, User.username, User.points).filter_by(is_admin=False))
+                async for batch in users.partitions(LOAD_BATCH_SIZE):
+                    async with redis.pipeline(transaction=False) as pipeline:
+                        pipeline.zadd(ranking, {self._member(user_id): -(points or 0)
+                                                for user_id, _, _, points in batch})
+                        pipeline.hset(ids, mapping={email: self._member(user_id) for user_id, email, _, _ in batch})
+                        pipeline.hset(profiles, mapping={self._member(user_id): self._profile(user_id, email, username)
+                                                         for user_id, email, username, _ in batch})
+                        await pipeline.execute()
+            # swap the new ranking in at once (renaming fails for the keys of an empty ranking)
+            async with redis.pipeline(transaction=True) as pipeline:
+                pipeline.delete(*keys)
+                for key, building_key in zip(keys, building):
+                    pipeline.rename(building_key, key)
+                pipeline.set(self._ready, 1)
+                await pipeline.execute(raise_on_error=False)
+        finally:
+            await redis.delete(self._loading, *building)
+
+    async def add(self, user_id: int, email: str, username: str, points: int | None = 0):
+        await self.add_many([(user_id, email, username, points)])
+
+    async def add_many(self, users: Iterable[tuple[int, str, str, int | None]]):
+        """Add (user id, email, username, points) of several users"""
+        args = []
+        for user_id, email, username, points in users:
+            args += [self._member(user_id), email, self._profile(user_id, email, username), -(points or 0)]
+        if args:
+            await _add_users(keys=[self._ranking, self._ids, self._profiles], args=args)
+
+    async def remove(self, email: str):
+        await _remove_user(keys=[self._ranking, self._ids, self._profiles], args=[email])
+
+    async def set_points(self, email: str, points: int):
+        await self.set_points_many({email: points})
+
+    async def set_points_many(self, points: dict[str, int]):
+        args = []
+        for email, user_points in points.items():
+            args += [email, -user_points]
+        if args:
+            await _set_scores(keys=[self._ranking, self._ids], args=args)
+
+    async def set_username(self, email: str, username: str):
+        # the user id is only needed for the profile, the script keeps the stored one
+        if (member := await get_redis().hget(self._ids, email)) is not None:
+            await _set_profile(keys=[self._ids, self._profiles],
+                               args=[email, self._profile(int(member), email, username)])
+
+    async def _window(self, member: str, before: int, after: int) -> list[dict] | None:
+        result = await _window(keys=[self._ranking, self._profiles], args=[member, before, after])
+        if result is None:
+            return None
+        start, values = result[0], result[1:]
+        entries = []
+        for offset in range(0, len(values), 2):
+            user_id, _, username = orjson.loads(values[offset + 1])
+            entries.append({'rank': start + offset // 2 + 1, 'id': user_id, 'username': username,
+                            'points': -int(float(values[offset]))})
+        return entries
+
+    async def top(self, limit: int) -> list[dict]:
+        return await self._window('', 0, limit - 1)
+
+    async def rank_of(self, user_id: int) -> dict | None:
+        if not (entries := await self._window(self._member(user_id), 0, 0)):
+            return None
+        return entries[0]
+
+    async def around(self, user_id: int, radius: int) -> list[dict] | None:
+        return await self._window(self._member(user_id), radius, radius)
+
+
+leaderboard = RedisLeaderboard() if settings.CACHE_BACKEND == 'redis' else Leaderboard()
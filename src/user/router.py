@@ -1,50 +1,116 @@
-from fastapi import APIRouter, Depends
+from functools import partial
+
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from auth.dependencies import get_current_user, check_user_status
-from db.crud.users import get_user_by_email, update_user_by_email, get_all_users
-from user.schemas import UserInfo, UpdateUserInfo
-from utils import convert_sqlalchemy_row_to_dict, common_error_handler_decorator
+from db.connector import get_session
+from db.crud.achievements import get_user_achievements
+from db.crud.users import get_user_by_email, update_user_by_email, get_all_users, export_users as export_users_db
+from exceptions import DatabaseElementNotFoundError
+from exports import export_response
+from schemas import Page, FileFormat
+from user.importer import import_users as import_users_db
+from user.leaderboard import leaderboard
+from user.schemas import UserInfo, UpdateUserInfo, UserOrdering, LeaderboardEntry, UserImportResult, \
+    AchievementInfo
+from utils import common_error_handler_decorator, PaginationParams, serialize_page, serialize_row, \
+    serialize_rows
 
 user_router = APIRouter(tags=["Users"], prefix='/user')
 
 
 @user_router.get("/info/{email}", dependencies=[Depends(check_user_status)])
 @common_error_handler_decorator
-def get_user_info(email: str) -> UserInfo:
+async def get_user_info(email: str, session: AsyncSession = Depends(get_session)) -> UserInfo:
     """Get user info by email (required admin rights)"""
-    return UserInfo(**convert_sqlalchemy_row_to_dict(get_user_by_email(email)))
+    return ORJSONResponse(serialize_row(await get_user_by_email(session, email), UserInfo))
 
 
 @user_router.get("/all", dependencies=[Depends(check_user_status)])
-def get_all_users_info() -> list[UserInfo]:
+@common_error_handler_decorator
+async def get_all_users_info(page: PaginationParams = Depends(), ordering: UserOrdering = UserOrdering.registered_at,
+                             min_points: int | None = None,
+                             session: AsyncSession = Depends(get_session)) -> Page[UserInfo]:
     """Get all users info (required admin rights)"""
-    return [UserInfo(**convert_sqlalchemy_row_to_dict(user)) for user in get_all_users()]
+    users = await get_all_users(session, **page.dict(), ordering=ordering.value, min_points=min_points,
+                                schema=UserInfo)
+    return ORJSONResponse(serialize_page(users, UserInfo))
+
+
+@user_router.get("/export", dependencies=[Depends(check_user_status)])
+async def export_users(file_format: FileFormat = Query(default=FileFormat.csv, alias='format'),
+                       ordering: UserOrdering = UserOrdering.registered_at, min_points: int | None = None):
+    """Download all users info as CSV or NDJSON (required admin rights)"""
+    return export_response(partial(export_users_db, schema=UserInfo, ordering=ordering.value, min_points=min_points),
+                           list(UserInfo.__fields__), file_format.value, 'users')
+
+
+@user_router.post("/import", dependencies=[Depends(check_user_status)])
+async def import_users(request: Request, file_format: FileFormat = Query(default=FileFormat.csv, alias='format'),
+                       session: AsyncSession = Depends(get_session)) -> UserImportResult:
+    """Create users from a CSV (header row first) or NDJSON request body (required admin rights)"""
+    return ORJSONResponse(await import_users_db(session, request.stream(), file_format.value))
+
+
+@user_router.get("/leaderboard", dependencies=[Depends(get_current_user)])
+async def get_leaderboard(limit: int = Query(default=10, ge=1, le=100)) -> list[LeaderboardEntry]:
+    """Get top campers by points"""
+    return ORJSONResponse(await leaderboard.top(limit))
+
+
+@user_router.get("/leaderboard/me")
+@common_error_handler_decorator
+async def get_my_rank(current_user: UserInfo = Depends(get_current_user)) -> LeaderboardEntry:
+    """Get rank of current user"""
+    if not (entry := await leaderboard.rank_of(current_user.id)):
+        raise DatabaseElementNotFoundError('User with id={} not found in leaderboard'.format(current_user.id))
+    return ORJSONResponse(entry)
+
+
+@user_router.get("/leaderboard/around/{user_id}", dependencies=[Depends(get_current_user)])
+@common_error_handler_decorator
+async def get_leaderboard_around(user_id: int,
+                                 radius: int = Query(default=5, ge=0, le=50)) -> list[LeaderboardEntry]:
+    """Get campers ranked right above and below the user"""
+    if (entries := await leaderboard.around(user_id, radius)) is None:
+        raise DatabaseElementNotFoundError('User with id={} not found in leaderboard'.format(user_id))
+    return ORJSONResponse(entries)
 
 
 @user_router.get("/me")
-def get_me_info(current_user: UserInfo = Depends(get_current_user)) -> UserInfo:
+async def get_me_info(current_user: UserInfo = Depends(get_current_user)) -> UserInfo:
     """Get current user info"""
     return current_user
 
 
+@user_router.get("/me/achievements")
+async def get_my_achievements(current_user: UserInfo = Depends(get_current_user),
+                              session: AsyncSession = Depends(get_session)) -> list[AchievementInfo]:
+    """Get achievements of current user, in the order they were awarded"""
+    return ORJSONResponse(serialize_rows(await get_user_achievements(session, current_user.email), AchievementInfo))
+
+
 @user_router.put("/update-me")
-def update_my_info(user_info: UpdateUserInfo, current_user: UserInfo = Depends(get_current_user)):
+async def update_my_info(user_info: UpdateUserInfo, current_user: UserInfo = Depends(get_current_user),
+                         session: AsyncSession = Depends(get_session)):
     """Update current user info"""
     updatable_fields = {}
     for i in user_info.dict():
         if user_info.dict()[i]:
             updatable_fields.update({i: user_info.dict()[i]})
-    update_user_by_email(current_user.email, **updatable_fields)
+    await update_user_by_email(session, current_user.email, **updatable_fields)
     return {'status': 'success', 'message': 'User info updated'}
 
 
 @user_router.put("/update", dependencies=[Depends(check_user_status)])
 @common_error_handler_decorator
-def update_user(email: str, user_info: UpdateUserInfo):
+async def update_user(email: str, user_info: UpdateUserInfo, session: AsyncSession = Depends(get_session)):
     """Update user info by email (required admin rights)"""
     updatable_fields = {}
     for i in user_info.dict():
         if user_info.dict()[i]:
             updatable_fields.update({i: user_info.dict()[i]})
-    update_user_by_email(email, **updatable_fields)
+    await update_user_by_email(session, email, **updatable_fields)
     return {'status': 'success', 'message': 'User info updated'}
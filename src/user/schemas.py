@@ -1,4 +1,5 @@
 from datetime import datetime
+from enum import Enum
 
 from pydantic import BaseModel, Field, EmailStr, HttpUrl
 
@@ -19,4 +20,47 @@ class UpdateUserInfo(BaseModel):
     first_name: str = Field(max_length=30, default=None)
     last_name: str = Field(max_length=30, default=None)
     username: str = Field(max_length=30, default=None)
-    media_link: HttpUrl = Field(default=None)
\ No newline at end of file
+    media_link: HttpUrl = Field(default=None)
+
+
+class LeaderboardEntry(BaseModel):
+    rank: int
+    id: int
+    username: str
+    points: int
+
+
+class AchievementInfo(BaseModel):
+    id: int
+    code: str | None
+    name: str
+    description: str
+    awarded_at: datetime | None
+
+
+class UserOrdering(str, Enum):
+    registered_at = 'registered_at'
+    registered_at_desc = '-registered_at'
+    points = 'points'
+    points_desc = '-points'
+
+
+class UserImport(BaseModel):
+    """An imported user is a camper, an is_admin column is ignored"""
+    first_name: str = Field(max_length=30)
+    last_name: str = Field(max_length=30)
+    username: str = Field(max_length=30)
+    email: EmailStr
+    password: str
+
+
+class UserImportError(BaseModel):
+    row: int
+    email: str | None
+    message: str
+
+
+class UserImportResult(BaseModel):
+    imported: int
+    failed: int
+    errors: list[UserImportError]
@@ -1,10 +1,13 @@
-from functools import wraps
+from functools import wraps, cache
+from operator import attrgetter
+from typing import Any, Callable, Iterable
 
 from fastapi.exceptions import RequestValidationError, HTTPException
-from fastapi import status
+from fastapi import status, Query
+from pydantic import BaseModel
 from pydantic.error_wrappers import ErrorWrapper
 
-from exceptions import DatabaseElementNotFoundError
+from exceptions import DatabaseElementNotFoundError, DatabaseElementConflictError, InvalidCursorError
 
 
 def convert_sqlalchemy_row_to_dict(row) -> dict:
@@ -14,15 +17,63 @@ def convert_sqlalchemy_row_to_dict(row) -> dict:
     return d
 
 
+@cache
+def row_serializer(schema: type[BaseModel]) -> Callable[[Any], dict]:
+    """Map ORM rows straight to dicts shaped like the schema (rows come from the db, so nothing is validated)"""
+    fields = tuple(schema.__fields__)
+    getter = attrgetter(*fields)
+    if len(fields) == 1:
+        return lambda row: {fields[0]: getter(row)}
+    return lambda row: dict(zip(fields, getter(row)))
+
+
+def serialize_row(row, schema: type[BaseModel]) -> dict:
+    return row_serializer(schema)(row)
+
+
+def serialize_rows(rows: Iterable, schema: type[BaseModel]) -> list[dict]:
+    return list(map(row_serializer(schema), rows))
+
+
+def serialize_page(page, schema: type[BaseModel]) -> dict:
+    return {'items': serialize_rows(page.items, schema), 'next_cursor': page.next_cursor, 'total': page.total}
+
+
+def bulk_result(ids: Iterable[int], failures: dict[int, str]) -> dict:
+    """Per-id outcome of a bulk operation"""
+    results = [{'id': element_id, 'status': 'error', 'message': failures[element_id]} if element_id in failures
+               else {'id': element_id, 'status': 'success', 'message': None} for element_id in dict.fromkeys(ids)]
+    return {'succeeded': len(results) - len(failures), 'failed': len(failures), 'results': results}
+
+
 def common_error_handler_decorator(func):
     @wraps(func)
-    def wrapper(*args, **kwargs):
+    async def wrapper(*args, **kwargs):
         try:
-            return func(*args, **kwargs)
+            return await func(*args, **kwargs)
         except ValueError as e:
             arg = 'start_date' if 'Start date must be before end date' in str(e) else 'end_date'
             raise RequestValidationError([ErrorWrapper(e, ('body', arg))])
         except DatabaseElementNotFoundError as e:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+        except DatabaseElementConflictError as e:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+        except InvalidCursorError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
     return wrapper
+
+
+class PaginationParams:
+    """Common query parameters of paginated list endpoints"""
+
+    def __init__(self,
+                 limit: int = Query(default=50, ge=1, le=500, description='Page size'),
+                 cursor: str | None = Query(default=None, description='`next_cursor` of the previous page'),
+                 with_total: bool = Query(default=False, description='Also count all matching items')):
+        self.limit = limit
+        self.cursor = cursor
+        self.with_total = with_total
+
+    def dict(self) -> dict:
+        return {'limit': self.limit, 'cursor': self.cursor, 'with_total': self.with_total}